@@ -1,16 +1,24 @@
+import asyncio
 import os.path
 import sqlite3
 import tempfile
 from sqlite3 import Connection, Cursor
 
 import pytest
-from sqlalchemy import create_engine
+from fastapi import FastAPI
+from sqlalchemy import event, Engine
+from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import Session, sessionmaker
 from starlette.testclient import TestClient
 
 from utilities.create_test_database import create_tables, insert_data
-from web_apps.json_rest_app import get_db_session, app
+from web_apps import changes
+from web_apps.async_database import create_async_database_engine
+from web_apps.database import EngineProfile, create_database_engine
+from web_apps.json_rest_app import app, router
+from web_apps.sessions import AsyncDatabaseSession, SyncDatabaseSession, get_db_session, get_read_db_session
+from web_apps.migrations import upgrade_database
 from web_apps.models import Base
 
 
@@ -64,7 +72,8 @@ def db_populated_filename(db_cursor: Cursor) -> str:
 
 @pytest.fixture()
 def db_session(db_populated_filename: str) -> Session:
-    engine = create_engine("sqlite:///" + db_populated_filename, echo=False)
+    engine = create_database_engine("sqlite:///" + db_populated_filename, EngineProfile())
+    upgrade_database(engine)
 
     base = automap_base()
     base.prepare(autoload_with=engine)
@@ -72,32 +81,125 @@ def db_session(db_populated_filename: str) -> Session:
     # engine = create_engine("sqlite://", echo=True)
     # models.Base.metadata.create_all(engine)
 
-    with Session(engine) as session:
+    with Session(engine, expire_on_commit=False) as session:
         yield session
 
         pass
 
 
 @pytest.fixture()
-def json_app_client(db_populated_filename: str) -> TestClient:
+def executed_statements(db_session: Session) -> list[tuple[str, tuple]]:
+    """
+    Records every (statement, parameters) the db_session sends to the database
+    """
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    engine = db_session.get_bind()
+    event.listen(engine, "before_cursor_execute", record_statement)
+    yield statements
+
+    # tear down
+    event.remove(engine, "before_cursor_execute", record_statement)
+
+
+@pytest.fixture()
+def json_app_engine(db_populated_filename: str) -> Engine:
     sqlalchemy_database_url = "sqlite:///" + db_populated_filename
 
-    engine = create_engine(
-        sqlalchemy_database_url, connect_args={"check_same_thread": False}
-    )
-    testing_session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine = create_database_engine(sqlalchemy_database_url, EngineProfile())
+    upgrade_database(engine)
+    yield engine
+
+    # tear down
+    engine.dispose()
+
+
+@pytest.fixture()
+def json_app_read_engine(json_app_engine: Engine) -> Engine:
+    """
+    A read-only engine on the json_app_engine's database, for the json_app_client's read-only routes
+    """
+    engine = create_database_engine(f"sqlite:///file:{json_app_engine.url.database}?mode=ro&uri=true",
+                                    EngineProfile(), read_only=True)
+    changes.add_engine_alias(engine, json_app_engine)
+    yield engine
+
+    # tear down
+    engine.dispose()
+
+
+@pytest.fixture()
+def json_app_executed_statements(json_app_engine: Engine, json_app_read_engine: Engine) -> list[tuple[str, tuple]]:
+    """
+    Records every (statement, parameters) the json_app_client's requests send to the database
+    """
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    for engine in [json_app_engine, json_app_read_engine]:
+        event.listen(engine, "before_cursor_execute", record_statement)
+    yield statements
+
+    # tear down
+    for engine in [json_app_engine, json_app_read_engine]:
+        event.remove(engine, "before_cursor_execute", record_statement)
+
+
+@pytest.fixture()
+def json_app_client(json_app_engine: Engine, json_app_read_engine: Engine) -> TestClient:
+    engine = json_app_engine
+    testing_session_local = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+    testing_read_session_local = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False,
+                                              bind=json_app_read_engine)
 
     Base.metadata.create_all(bind=engine)
 
     def override_get_db():
         try:
             db = testing_session_local()
-            yield db
+            yield SyncDatabaseSession(db)
+        finally:
+            db.close()
+
+    def override_get_read_db():
+        try:
+            db = testing_read_session_local()
+            yield SyncDatabaseSession(db)
         finally:
             db.close()
 
     app.dependency_overrides[get_db_session] = override_get_db
+    app.dependency_overrides[get_read_db_session] = override_get_read_db
 
     client = TestClient(app)
 
     yield client
+
+
+@pytest.fixture()
+def async_app_client(json_app_engine: Engine) -> TestClient:
+    """
+    A client for the json app's endpoints on an async engine, on the same database as the json_app_client
+    """
+    engine = create_async_database_engine("sqlite+aiosqlite:///" + json_app_engine.url.database, EngineProfile())
+    changes.add_engine_alias(engine.sync_engine, json_app_engine)
+    testing_session_local = async_sessionmaker(autoflush=False, expire_on_commit=False, bind=engine)
+
+    async def override_get_async_db():
+        async with testing_session_local() as db:
+            yield AsyncDatabaseSession(db)
+
+    async_app = FastAPI()
+    async_app.include_router(router)
+    async_app.dependency_overrides[get_db_session] = override_get_async_db
+    async_app.dependency_overrides[get_read_db_session] = override_get_async_db
+
+    yield TestClient(async_app)
+
+    # tear down
+    asyncio.run(engine.dispose())
@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+from web_apps import adjacency, crud, paths, schemas
+from web_apps.schemas import ConnectionCreate, Direction
+
+
+@pytest.fixture()
+def db_adjacency(db_session):
+    engine = db_session.get_bind()
+    yield adjacency.build_adjacency(engine)
+
+    # tear down
+    adjacency.drop_adjacency(engine)
+
+
+def adjacent_rows(db_adjacency, node_ids: list[int], direction: Direction, names: list[str] | None = None) -> list:
+    name_ids = db_adjacency.name_ids_for(names) if names else None
+    return sorted(map(tuple, db_adjacency.adjacent(np.array(node_ids), direction, name_ids).tolist()))
+
+
+def sql_rows(db_session, node_ids: list[int], direction: Direction, names: list[str] | None = None) -> list:
+    return sorted(tuple(row) for row in crud.get_adjacent_connections(db_session, node_ids, direction, names))
+
+
+def assert_matches_database(db_session, db_adjacency):
+    node_ids = list(range(40))
+    for direction in Direction:
+        assert adjacent_rows(db_adjacency, node_ids, direction) == sql_rows(db_session, node_ids, direction)
+        assert adjacent_rows(db_adjacency, node_ids, direction, ["worked at"]) == sql_rows(
+            db_session, node_ids, direction, ["worked at"])
+
+
+def test_adjacent(db_session, db_adjacency):
+    assert adjacent_rows(db_adjacency, [2], Direction.outgoing) == [(2, 2, 12), (2, 14, 21), (2, 15, 24),
+                                                                    (2, 23, 32), (2, 24, 33)]
+    assert adjacent_rows(db_adjacency, [31], Direction.incoming) == [(31, 21, 1), (31, 25, 3)]
+    assert adjacent_rows(db_adjacency, [99], Direction.both) == []
+    assert_matches_database(db_session, db_adjacency)
+
+
+def test_degrees(db_adjacency):
+    degrees = db_adjacency.degrees()
+    assert degrees[1] == 6
+    assert degrees[31] == 2
+    assert db_adjacency.degrees(Direction.outgoing)[31] == 0
+
+
+def test_writes_update_adjacency(db_session, db_adjacency):
+    connection = crud.create_connection(db_session, ConnectionCreate(name="reports to", subject=2, target=1))
+    crud.upsert_connection(db_session, 1, ConnectionCreate(name="had title", subject=1, target=12))
+    crud.delete_connection(db_session, 11)
+    crud.delete_node(db_session, 3)
+    assert db_adjacency.stats().recent_edge_count == 2
+    assert_matches_database(db_session, db_adjacency)
+    assert db_adjacency.degrees()[1] == 6
+
+    db_adjacency.compact()
+    assert db_adjacency.stats().recent_edge_count == 0
+    assert db_adjacency.stats().dead_edge_count == 0
+    assert_matches_database(db_session, db_adjacency)
+
+    crud.delete_connection(db_session, connection.id)
+    assert_matches_database(db_session, db_adjacency)
+
+
+def test_many_writes_compact_adjacency(db_session, db_adjacency):
+    target_ids = [11, 12, 13, 21, 22, 23, 24, 25, 31, 32, 33, 34]
+    connections = [ConnectionCreate(name=f"knows {number}", subject=number % 3 + 1,
+                                    target=target_ids[number % len(target_ids)])
+                   for number in range(adjacency.MIN_COMPACT_EDGES + 1)]
+    crud.create_connections_bulk(db_session, connections)
+    stats = db_adjacency.stats()
+    assert stats.recent_edge_count == 0
+    assert stats.edge_count == 17 + len(connections)
+    assert_matches_database(db_session, db_adjacency)
+
+
+def test_deleting_all_connections_clears_adjacency(db_session, db_adjacency):
+    crud.delete_connections(db_session)
+    assert db_adjacency.stats().edge_count == 0
+    assert adjacent_rows(db_adjacency, [1], Direction.both) == []
+
+
+def test_shortest_paths_use_adjacency(db_session, db_adjacency, executed_statements):
+    shortest_paths = paths.find_shortest_paths(db_session, 1, 33, max_depth=6, names=["worked at"])
+    assert [[node.name for node in path.nodes] for path in shortest_paths.paths] == [
+        ["Andrew", "Warehouse Group", "Cindy", "Westpac"], ["Andrew", "Global Dairy", "Cindy", "Westpac"]]
+    assert len(executed_statements) == 2  # just loading the connections and nodes on the paths
+
+
+def test_adjacency_api(json_app_client, json_app_engine):
+    response = json_app_client.get("/adjacency/")
+    assert response.status_code == 404
+
+    response = json_app_client.post("/adjacency/rebuild")
+    assert response.status_code == 200, response.text
+    stats = schemas.AdjacencyStats(**response.json())
+    assert stats.edge_count == 17
+    assert stats.memory_bytes > 0
+
+    json_app_client.delete("/connections/1")
+    response = json_app_client.post("/adjacency/refresh")
+    assert response.json()["edge_count"] == 16
+    assert response.json()["dead_edge_count"] == 0
+    adjacency.drop_adjacency(json_app_engine)
@@ -0,0 +1,78 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from web_apps import adjacency, analytics, crud, schemas
+from web_apps.schemas import ConnectionCreate, Metric
+
+
+def top_node_names(db_session, metric: Metric, name: str | None = None, limit: int = 3) -> list[tuple[str, float]]:
+    return [(node.name, node.score) for node in analytics.get_top_nodes(db_session, metric, name, limit)]
+
+
+def test_degree_rankings(db_session):
+    assert top_node_names(db_session, Metric.degree) == [("Andrew", 6), ("Cindy", 6), ("Brian", 5)]
+    assert top_node_names(db_session, Metric.out_degree, limit=1) == [("Andrew", 6)]
+    assert top_node_names(db_session, Metric.in_degree) == [("Java", 2), ("React", 2), ("Warehouse Group", 2)]
+    assert top_node_names(db_session, Metric.in_degree, name="worked at", limit=4) == [
+        ("Warehouse Group", 2), ("Westpac", 2), ("Global Dairy", 2), ("Countdown", 1)]
+    assert top_node_names(db_session, Metric.degree, name="no such name") == []
+
+
+def test_pagerank():
+    # 0 -> 1 -> 2 -> 0 is a cycle, so every node ranks the same
+    ranks = analytics.pagerank(np.array([0, 1, 2]), np.array([1, 2, 0]), 3)
+    assert ranks == pytest.approx([1 / 3] * 3)
+
+    # 0 and 1 both point at 2, which points nowhere
+    ranks = analytics.pagerank(np.array([0, 1]), np.array([2, 2]), 3)
+    assert ranks.sum() == pytest.approx(1)
+    assert ranks[2] > ranks[0] == pytest.approx(ranks[1])
+
+
+def test_pagerank_ranking(db_session):
+    top_nodes = analytics.get_top_nodes(db_session, Metric.pagerank, limit=15)
+    assert sum(node.score for node in top_nodes) == pytest.approx(1)
+    # Java and Westpac are each linked to from the same sized nodes, and more than any others
+    assert {node.name for node in top_nodes[:2]} == {"Java", "Westpac"}
+    assert top_nodes[0].score == pytest.approx(top_nodes[1].score)
+    assert top_nodes[1].score > top_nodes[2].score
+
+
+def test_rankings_cached_until_write(db_session, executed_statements):
+    top_node_names(db_session, Metric.degree)
+    executed_statements.clear()
+    assert top_node_names(db_session, Metric.degree, limit=1) == [("Andrew", 6)]
+    assert len(executed_statements) == 1  # just loading the nodes
+
+    crud.create_connection(db_session, ConnectionCreate(name="knows", subject=3, target=2))
+    assert top_node_names(db_session, Metric.degree) == [("Cindy", 7), ("Andrew", 6), ("Brian", 6)]
+
+
+def test_rankings_cached_until_another_process_writes(db_session):
+    assert top_node_names(db_session, Metric.out_degree, limit=1) == [("Andrew", 6)]
+    db_session.commit()
+    with sqlite3.connect(db_session.get_bind().url.database) as other_connection:
+        other_connection.execute("DELETE FROM connections WHERE subject_id = 1")
+
+    assert top_node_names(db_session, Metric.out_degree, limit=1) == [("Cindy", 6)]
+
+
+def test_rankings_use_adjacency(db_session, executed_statements):
+    adjacency.build_adjacency(db_session.get_bind())
+    executed_statements.clear()
+    assert top_node_names(db_session, Metric.degree, name="has title") == [
+        ("Andrew", 1), ("Brian", 1), ("Cindy", 1)]
+    assert len(executed_statements) == 1
+    adjacency.drop_adjacency(db_session.get_bind())
+
+
+def test_top_nodes_api(json_app_client):
+    response = json_app_client.get("/analytics/top-nodes?metric=in_degree&name=has+experience+in&limit=2")
+    assert response.status_code == 200, response.text
+    assert [schemas.NodeScore(**node_json) for node_json in response.json()] == [
+        schemas.NodeScore(id=21, name="Java", score=2), schemas.NodeScore(id=23, name="React", score=2)]
+
+    response = json_app_client.get("/analytics/top-nodes?metric=closeness")
+    assert response.status_code == 422
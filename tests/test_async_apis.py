@@ -0,0 +1,70 @@
+import pytest
+
+from web_apps import identity_cache, schemas, suggest
+
+
+@pytest.mark.parametrize("url", [
+    "/nodes/", "/nodes/?like=engineer&limit=2", "/nodes/1", "/nodes/99", "/nodes/2/neighbourhood?depth=2",
+    "/nodes/1/impact", "/connections/", "/connections/?node_id=1", "/connections/?name_like=has", "/connections/3",
+    "/search/nodes?q=engineer", "/suggest/nodes?prefix=a", "/suggest/connection-names?prefix=w",
+    "/stats/?detail=true", "/analytics/top-nodes?metric=pagerank", "/paths?from=1&to=2", "/nodes/?after=nonsense",
+])
+def test_reads_match_sync_app(json_app_client, async_app_client, url):
+    sync_response = json_app_client.get(url)
+    async_response = async_app_client.get(url)
+    assert async_response.status_code == sync_response.status_code, async_response.text
+    assert async_response.json() == sync_response.json()
+    assert async_response.headers.get("X-Next-Cursor") == sync_response.headers.get("X-Next-Cursor")
+
+
+def test_node_writes(async_app_client):
+    response = async_app_client.post("/nodes/", json={"name": "Chris"})
+    assert response.status_code == 200, response.text
+    node = schemas.Node(**response.json())
+
+    response = async_app_client.post("/nodes/", json={"name": " chris "})
+    assert response.status_code == 400, response.text
+
+    response = async_app_client.put(f"/nodes/{node.id}", json={"name": "Christine"})
+    assert response.status_code == 200, response.text
+    assert response.json()["name"] == "Christine"
+
+    response = async_app_client.delete("/nodes?ids=1&ids=99")
+    assert response.json() == {"deleted_ids": [1], "missing_ids": [99], "connection_count": 6}
+    assert async_app_client.get("/nodes/1").status_code == 404
+
+
+def test_connection_writes(async_app_client):
+    connection = schemas.ConnectionCreate(name="mentors", subject=schemas.NodeCreate(name="Chris"), target=3)
+    response = async_app_client.post("/connections/", json=connection.dict())
+    assert response.status_code == 200, response.text
+    connection_id = schemas.Connection(**response.json()).id
+
+    connection = schemas.ConnectionCreate(name="mentors", subject=99, target=3)
+    response = async_app_client.post("/connections/", json=connection.dict())
+    assert response.status_code == 404, response.text
+
+    connection = schemas.ConnectionCreate(name="used to be", subject=3, target=11)
+    response = async_app_client.put("/connections/50", json=connection.dict())
+    assert response.status_code == 201, response.text
+
+    assert async_app_client.delete(f"/connections/{connection_id}").status_code == 200
+    assert async_app_client.delete(f"/connections/{connection_id}").status_code == 404
+
+
+def test_writes_shared_with_sync_engine(json_app_client, json_app_engine, async_app_client):
+    identity_cache.create_identity_cache(json_app_engine, max_size=10)
+    suggest.build_suggest_indexes(json_app_engine)
+    try:
+        assert json_app_client.get("/nodes/1").json()["name"] == "Andrew"
+        assert json_app_client.get("/suggest/nodes?prefix=chr").json() == []
+
+        assert async_app_client.put("/nodes/1", json={"name": "Chris"}).status_code == 200
+
+        # the sync engine's identity cache and suggestions followed the write made through the async one
+        assert json_app_client.get("/nodes/1").json()["name"] == "Chris"
+        assert [suggestion["id"] for suggestion in json_app_client.get("/suggest/nodes?prefix=chr").json()] == [1]
+        assert async_app_client.get("/identity-cache/").json()["node_count"] == 1
+    finally:
+        identity_cache.drop_identity_cache(json_app_engine)
+        suggest.drop_suggest_indexes(json_app_engine)
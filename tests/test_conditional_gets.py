@@ -0,0 +1,71 @@
+import sqlite3
+
+import pytest
+
+from web_apps.graph_version import etag_matches, graph_version
+
+
+@pytest.mark.parametrize("url", ["/stats/", "/nodes/", "/connections/", "/nodes/1"])
+def test_current_etag_not_modified(json_app_client, json_app_executed_statements, url):
+    response = json_app_client.get(url)
+    assert response.status_code == 200, response.text
+    etag = response.headers["ETag"]
+    assert response.headers["Last-Modified"].endswith(" GMT")
+
+    json_app_executed_statements.clear()
+    response = json_app_client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+    assert json_app_executed_statements == []
+
+
+def test_write_changes_etag(json_app_client):
+    etag = json_app_client.get("/stats/").headers["ETag"]
+
+    assert json_app_client.post("/nodes/", json={"name": "Chris"}).status_code == 200
+
+    response = json_app_client.get("/stats/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_failed_write_keeps_etag(json_app_client):
+    etag = json_app_client.get("/stats/").headers["ETag"]
+
+    assert json_app_client.put("/nodes/1", json={"name": "Brian"}).status_code == 400
+
+    assert json_app_client.get("/stats/", headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_commit_from_another_process_changes_etag(json_app_client, json_app_engine):
+    watched_file = graph_version.database_file
+    graph_version.watch(json_app_engine.url.database)
+    try:
+        etag = json_app_client.get("/nodes/1").headers["ETag"]
+        assert json_app_client.get("/nodes/1", headers={"If-None-Match": etag}).status_code == 304
+
+        # as another process would, without publishing the change to this one
+        with sqlite3.connect(json_app_engine.url.database) as other_connection:
+            other_connection.execute("UPDATE nodes SET name = 'Andy' WHERE id = 1")
+
+        response = json_app_client.get("/nodes/1", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.json()["name"] == "Andy"
+    finally:
+        graph_version.watch(watched_file)
+
+
+def test_uncached_paths(json_app_client):
+    response = json_app_client.get("/write-queue/")
+    assert "ETag" not in response.headers
+    response = json_app_client.get("/nodes/99")
+    assert response.status_code == 404
+    assert "ETag" not in response.headers
+
+
+@pytest.mark.parametrize("if_none_match, matches", [
+    (None, False), ('W/"a-1"', True), ('"a-1"', True), ('W/"a-0", W/"a-1"', True), ("*", True), ('W/"a-2"', False),
+])
+def test_etag_matches(if_none_match, matches):
+    assert etag_matches(if_none_match, 'W/"a-1"') is matches
@@ -1,3 +1,5 @@
+import pytest
+
 from web_apps import schemas
 
 
@@ -80,6 +82,20 @@ def test_get_connections_by_name(json_app_client):
     assert conn_1.name == conn_2.name == "has title"
 
 
+def test_get_connections_by_page(json_app_client):
+    response = json_app_client.get("/connections/?limit=10")
+    assert response.status_code == 200, response.text
+    first_page = [schemas.Connection(**connection_json) for connection_json in response.json()]
+
+    response = json_app_client.get("/connections/?limit=10&after=" + response.headers["X-Next-Cursor"])
+    assert response.status_code == 200, response.text
+    second_page = [schemas.Connection(**connection_json) for connection_json in response.json()]
+
+    assert len(first_page) == 10
+    assert len(second_page) == 7
+    assert first_page[-1].id < second_page[0].id
+
+
 def test_get_connections_by_node_id(json_app_client):
     response = json_app_client.get("/connections/?node_id=1")
     assert response.status_code == 200, response.text
@@ -91,6 +107,27 @@ def test_get_connections_by_node_id(json_app_client):
     assert conn_2.id == 11
 
 
+def test_get_connections_by_node_id_by_page(json_app_client):
+    response = json_app_client.get("/connections/?node_id=1&limit=4")
+    assert response.status_code == 200, response.text
+    first_page = [connection_json["id"] for connection_json in response.json()]
+
+    response = json_app_client.get("/connections/?node_id=1&limit=4&after=" + response.headers["X-Next-Cursor"])
+    assert response.status_code == 200, response.text
+    second_page = [connection_json["id"] for connection_json in response.json()]
+
+    assert len(first_page) == 4
+    assert len(second_page) == 2
+    assert "X-Next-Cursor" not in response.headers
+    assert first_page + second_page == [connection_json["id"] for connection_json in
+                                        json_app_client.get("/connections/?node_id=1").json()]
+
+
+@pytest.mark.parametrize("query", ["limit=-1", "limit=0", "limit=1001", "skip=-1", "node_id=1&limit=-1"])
+def test_get_connections_rejects_bad_pages(json_app_client, query):
+    assert json_app_client.get("/connections/?" + query).status_code == 422
+
+
 def test_delete_existing_connection(json_app_client):
     response = json_app_client.get("/stats/")
     orig_count = response.json()["connection_count"]
@@ -103,6 +140,15 @@ def test_delete_existing_connection(json_app_client):
     assert new_count == orig_count - 1
 
 
+def test_delete_connections_by_ids(json_app_client):
+    response = json_app_client.delete("/connections?ids=2&ids=99&ids=1")
+    assert response.status_code == 200, response.text
+    assert response.json() == {"deleted_ids": [1, 2], "missing_ids": [99]}
+
+    response = json_app_client.get("/connections/1")
+    assert response.status_code == 404
+
+
 def test_delete_nonexistent_connection(json_app_client):
     response = json_app_client.get("/stats/")
     orig_count = response.json()["connection_count"]
@@ -153,6 +199,12 @@ def test_stats_api(json_app_client):
     response_json = response.json()
     assert response_json["node_count"] == 15
     assert response_json["connection_count"] == 17
+    assert response_json["max_degree"] == 6
+    assert response_json["orphan_node_count"] == 0
+    assert "connection_name_counts" not in response_json
+
+    response = json_app_client.get("/stats/?detail=true")
+    assert response.json()["connection_name_counts"] == {"has experience in": 7, "has title": 3, "worked at": 7}
 
 
 def test_delete_all_connections(json_app_client):
@@ -160,3 +212,35 @@ def test_delete_all_connections(json_app_client):
     assert response.status_code == 200
     response_json = response.json()
     assert response_json["message"] == "deleted 17 connections"
+
+
+def test_delete_all_connections_rejects_ids(json_app_client):
+    response = json_app_client.delete("/connections/?ids=2")
+    assert response.status_code == 400, response.text
+    assert json_app_client.get("/stats/").json()["connection_count"] == 17
+
+
+def test_create_connections_batch_api(json_app_client):
+    connections = [schemas.ConnectionCreate(name="worked at", subject=schemas.NodeCreate(name=name), target=33)
+                   for name in ["Andrew", "Brian", "Wayne"]]
+    response = json_app_client.post("/connections/batch", json=[connection.dict() for connection in connections])
+    assert response.status_code == 200, response.text
+    assert response.json() == {"created": 2, "existing": 1}
+
+    stats = json_app_client.get("/stats/").json()
+    assert stats["node_count"] == 16
+    assert stats["connection_count"] == 19
+
+
+def test_suggest_connection_names_api(json_app_client):
+    response = json_app_client.get("/suggest/connection-names?prefix=Has")
+    assert response.status_code == 200, response.text
+    assert response.json() == [{"name": "has experience in", "count": 7}, {"name": "has title", "count": 3}]
+
+
+def test_search_connections_api(json_app_client):
+    response = json_app_client.get("/search/connections?q=title")
+    assert response.status_code == 200, response.text
+    connections = [schemas.Connection(**connection_json) for connection_json in response.json()]
+    assert [connection.id for connection in connections] == [1, 2, 3]
+    assert connections[0].subject.name == "Andrew"
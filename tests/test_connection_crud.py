@@ -1,7 +1,11 @@
+import sqlite3
+
 import pytest
+from sqlalchemy import event, select
+from sqlalchemy.exc import InvalidRequestError
 
-from web_apps import models, crud
-from web_apps.crud import ConnectionNodeNotFoundError
+from web_apps import models, crud, schemas
+from web_apps.crud import ConnectionNodeNotFoundError, DuplicateConnectionError
 from web_apps.schemas import NodeCreate, ConnectionCreate
 
 
@@ -62,6 +66,18 @@ def test_delete_nonexistent_connection(db_session):
     assert new_count == orig_count
 
 
+def test_delete_connections_by_ids(db_session):
+    orig_count = crud.get_table_size(db_session, models.Connection)
+
+    missing_ids = crud.delete_connections_by_ids(db_session, [2, 99, 1, 2])
+    assert missing_ids == [99]
+    assert crud.get_connection(db_session, 1) is None
+    assert crud.get_connection(db_session, 2) is None
+
+    new_count = crud.get_table_size(db_session, models.Connection)
+    assert new_count == orig_count - 2
+
+
 def test_delete_node_deletes_connections_to_node(db_session):
     original_node_count = crud.get_table_size(db_session, models.Node)
     original_connection_count = crud.get_table_size(db_session, models.Connection)
@@ -97,6 +113,48 @@ def test_get_connections_to_node_name_like(db_session):
     assert connection_3 in connections_to_nodes_like
 
 
+def test_get_connections_like_name_page(db_session):
+    first_page = crud.get_connections_like_name(db_session, like="worked", limit=3)
+    assert [connection.id for connection in first_page] == [21, 22, 23]
+
+    second_page = crud.get_connections_like_name(db_session, like="worked", limit=3, after_id=23)
+    assert [connection.id for connection in second_page] == [24, 25, 26]
+
+    last_page = crud.get_connections_like_name(db_session, like="worked", limit=3, after_id=26)
+    assert [connection.id for connection in last_page] == [27]
+
+
+def test_get_connections_to_node_name_like_query_count(db_session, executed_statements):
+    """
+    The number of queries doesn't grow with the number of matching nodes, and subject and target come loaded
+    """
+    for like in ["Andrew", "engineer", "e", ""]:
+        executed_statements.clear()
+        connections = crud.get_connections_to_node_like_name(db_session, like)
+        assert {connection.subject.name for connection in connections}
+        assert {connection.target.name for connection in connections}
+        assert len(executed_statements) == 1, like
+
+
+@pytest.mark.parametrize("get_connections", [
+    lambda db_session: crud.get_connections(db_session),
+    lambda db_session: crud.get_connections_like_name(db_session, like="e"),
+    lambda db_session: crud.get_connections_to_node(db_session, 1),
+    lambda db_session: [crud.get_connection(db_session, 1)],
+    lambda db_session: [crud.get_connection_by_name_target_id_and_subject_id(db_session, "has title", 1, 11)],
+])
+def test_connection_nodes_are_loaded_eagerly(db_session, executed_statements, get_connections):
+    connections = get_connections(db_session)
+    assert [(c.subject.name, c.target.name) for c in connections]
+    assert len(executed_statements) == 1
+
+
+def test_connection_nodes_are_not_lazy_loaded(db_session):
+    connection = db_session.scalars(select(models.Connection)).first()
+    with pytest.raises(InvalidRequestError):
+        connection.subject
+
+
 def test_get_connection_by_id(db_session):
     andrew_appt = crud.get_connection(db_session, 1)
     assert andrew_appt.id == 1
@@ -138,6 +196,37 @@ def test_cant_create_duplicate_connection(db_session):
     assert original_connection_count == new_connection_count
 
 
+def test_create_connection_name_substring(db_session):
+    """
+    A connection whose name is a substring of an existing one between the same nodes is a different connection
+    """
+    original_connection_count = crud.get_table_size(db_session, models.Connection)
+
+    connection = crud.create_connection(db_session, ConnectionCreate(name="has", subject=1, target=11))
+
+    assert connection.id != 1
+    assert connection.name == "has"
+    assert crud.get_table_size(db_session, models.Connection) == original_connection_count + 1
+
+
+def test_create_existing_connection_is_one_insert(db_session, executed_statements):
+    connection = crud.create_connection(db_session, ConnectionCreate(name="has title", subject=1, target=11))
+
+    assert connection.id == 1
+    statements = [statement for statement, parameters in executed_statements]
+    assert len(statements) == 4  # look up the two nodes, insert, select the existing connection
+    assert statements[2].startswith("INSERT INTO connections")
+    assert "ON CONFLICT (subject_id, name, target_id) DO NOTHING" in statements[2]
+
+
+def test_update_connection_to_existing_connection(db_session):
+    with pytest.raises(DuplicateConnectionError):
+        crud.update_connection(db_session, connection_id=2,
+                               updated_connection=ConnectionCreate(name="has title", subject=1, target=11))
+
+    assert crud.get_connection(db_session, 2).subject_id == 2
+
+
 def test_get_connection_by_name_and_node_ids(db_session):
     node_1 = crud.get_node(db_session, 1)
     node_2 = crud.get_node(db_session, 2)
@@ -171,3 +260,156 @@ def test_get_connection_names(db_session):
     assert connection_names["has title"] == 3
     assert connection_names["has experience in"] == 7
     assert connection_names["worked at"] == 7
+
+
+def test_get_connection_name_counts(db_session):
+    connection_names = crud.get_connection_name_counts(db_session, like="e")
+    assert [tuple(row) for row in connection_names] == [("has experience in", 7, 3, 5),
+                                                        ("has title", 3, 3, 3),
+                                                        ("worked at", 7, 3, 4)]
+
+
+def test_get_most_common_connection_names(db_session):
+    connection_names = crud.get_connection_name_counts(db_session, like="e", limit=2, most_common_first=True)
+    assert [(row.name, row.count) for row in connection_names] == [("has experience in", 7), ("worked at", 7)]
+
+
+@pytest.mark.parametrize("query, names", [
+    ("has*", ["has experience in", "has title"]),
+    ('"worked at"', ["worked at"]),
+    ("title has", ["has title"]),
+    ("at*", []),
+])
+def test_search_connection_name_counts(db_session, query, names):
+    assert [row.name for row in crud.search_connection_name_counts(db_session, query)] == names
+
+
+def test_create_connections_bulk(db_session, executed_statements):
+    original_node_count = crud.get_table_size(db_session, models.Node)
+    connections = [
+        ConnectionCreate(name="has title", subject=NodeCreate(name="andrew"), target=11),  # already exists
+        ConnectionCreate(name="has experience in", subject=1, target=NodeCreate(name="Kotlin")),
+        ConnectionCreate(name="has experience in", subject=NodeCreate(name="David"), target=NodeCreate(name="Kotlin")),
+        ConnectionCreate(name="has experience in", subject=NodeCreate(name="DAVID "), target=NodeCreate(name="kotlin")),
+    ]
+    executed_statements.clear()
+
+    result = crud.create_connections_bulk(db_session, connections)
+
+    assert result.created == 2
+    assert result.existing == 1
+    assert len(executed_statements) == 5  # check ids, find nodes, insert nodes, find connections, insert
+    assert crud.get_table_size(db_session, models.Node) == original_node_count + 2
+    kotlin = crud.get_node_by_name(db_session, "Kotlin")
+    assert {c.subject.name for c in crud.get_connections_to_node(db_session, kotlin.id)} == {"Andrew", "David"}
+
+
+def test_create_connections_bulk_counts_connections_another_writer_added(db_session):
+    def add_connection_first(conn, cursor, statement, parameters, context, executemany):
+        # another writer gets in between looking for the connections and inserting them
+        if statement.startswith("INSERT INTO connections"):
+            with sqlite3.connect(db_session.get_bind().url.database) as other_connection:
+                other_connection.execute("INSERT INTO connections (name, subject_id, target_id) VALUES (?, ?, ?)",
+                                         ("mentors", 1, 12))
+
+    engine = db_session.get_bind()
+    event.listen(engine, "before_cursor_execute", add_connection_first)
+    try:
+        result = crud.create_connections_bulk(db_session, [ConnectionCreate(name="mentors", subject=1, target=12),
+                                                           ConnectionCreate(name="mentors", subject=2, target=12)])
+    finally:
+        event.remove(engine, "before_cursor_execute", add_connection_first)
+
+    assert (result.created, result.existing) == (1, 1)
+    assert len(crud.get_connections_to_node(db_session, 12)) == 3
+
+
+def test_create_connections_bulk_to_nonexistent_node_ids(db_session):
+    original_node_count = crud.get_table_size(db_session, models.Node)
+
+    with pytest.raises(ConnectionNodeNotFoundError):
+        crud.create_connections_bulk(db_session, [
+            ConnectionCreate(name="bad connection", subject=NodeCreate(name="Nobody"), target=99)])
+
+    assert crud.get_table_size(db_session, models.Node) == original_node_count
+
+
+def neighbourhood_depths(neighbourhood: schemas.Neighbourhood) -> dict[str, int]:
+    return {node.name: node.depth for node in neighbourhood.nodes}
+
+
+def test_get_neighbourhood(db_session):
+    neighbourhood = crud.get_neighbourhood(db_session, 31, depth=2)  # Warehouse Group
+    assert neighbourhood_depths(neighbourhood) == {
+        "Warehouse Group": 0, "Andrew": 1, "Cindy": 1,
+        "Chief Engineer": 2, "Senior Engineer": 2, "Java": 2, "SpringBoot": 2, "React": 2, "Angular": 2,
+        "Westpac": 2, "Global Dairy": 2}
+    assert len(neighbourhood.connections) == 12
+    assert not neighbourhood.truncated
+
+    neighbourhood = crud.get_neighbourhood(db_session, 31, depth=2, direction=schemas.Direction.outgoing)
+    assert neighbourhood_depths(neighbourhood) == {"Warehouse Group": 0}
+
+    neighbourhood = crud.get_neighbourhood(db_session, 1, depth=3, names=["worked at"])
+    assert neighbourhood_depths(neighbourhood) == {
+        "Andrew": 0, "Warehouse Group": 1, "Global Dairy": 1, "Cindy": 2, "Westpac": 3}
+    assert {connection.name for connection in neighbourhood.connections} == {"worked at"}
+
+    assert crud.get_neighbourhood(db_session, 99) is None
+
+
+def test_get_neighbourhood_follows_cycles_once(db_session):
+    crud.create_connection(db_session, ConnectionCreate(name="reports to", subject=11, target=1))
+    neighbourhood = crud.get_neighbourhood(db_session, 1, depth=6, direction=schemas.Direction.outgoing)
+    assert neighbourhood_depths(neighbourhood) == {
+        "Andrew": 0, "Chief Engineer": 1, "Java": 1, "SpringBoot": 1, "React": 1, "Warehouse Group": 1,
+        "Global Dairy": 1}
+    assert len(neighbourhood.connections) == 7
+
+
+def test_get_neighbourhood_stops_at_limit(db_session):
+    neighbourhood = crud.get_neighbourhood(db_session, 1, depth=6, limit=3)
+    assert len(neighbourhood.nodes) == 3
+    assert neighbourhood.nodes[0].name == "Andrew"
+    assert neighbourhood.truncated
+
+
+def counted_database_stats(db_session) -> schemas.DatabaseStats:
+    """
+    The stats worked out from scratch, to check the ones the triggers keep
+    """
+    degrees = {}
+    for connection in crud.get_connections(db_session, limit=None):
+        for node_id in [connection.subject_id, connection.target_id]:
+            degrees[node_id] = degrees.get(node_id, 0) + 1
+    node_ids = {node.id for node in crud.get_nodes(db_session, limit=None)}
+    return schemas.DatabaseStats(
+        node_count=len(node_ids), connection_count=crud.get_table_size(db_session, models.Connection),
+        max_degree=max(degrees.values(), default=0), orphan_node_count=len(node_ids - degrees.keys()),
+        connection_name_counts={row.name: row.count for row in crud.get_connection_name_counts(db_session, "")})
+
+
+def test_database_stats_follow_writes(db_session):
+    assert crud.get_database_stats(db_session, detail=True) == counted_database_stats(db_session)
+
+    crud.create_node(db_session, NodeCreate(name="Nobody"))
+    crud.create_connection(db_session, ConnectionCreate(name="mentors", subject=3, target=NodeCreate(name="Dave")))
+    crud.create_connection(db_session, ConnectionCreate(name="knows", subject=3, target=3))
+    crud.upsert_connection(db_session, 1, ConnectionCreate(name="had title", subject=3, target=12))
+    crud.delete_connection(db_session, 11)
+    stats = crud.get_database_stats(db_session, detail=True)
+    assert stats == counted_database_stats(db_session)
+    assert stats.max_degree == 10
+    assert stats.orphan_node_count == 2  # Nobody and Chief Engineer
+
+    crud.delete_node(db_session, 3)
+    assert crud.get_database_stats(db_session, detail=True) == counted_database_stats(db_session)
+
+    crud.delete_connections(db_session)
+    stats = crud.get_database_stats(db_session, detail=True)
+    assert stats == counted_database_stats(db_session)
+    assert stats.orphan_node_count == stats.node_count
+
+    crud.delete_nodes(db_session)
+    assert crud.get_database_stats(db_session) == schemas.DatabaseStats(
+        node_count=0, connection_count=0, max_degree=0, orphan_node_count=0)
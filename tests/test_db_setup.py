@@ -1,9 +1,16 @@
-from web_apps import crud, models
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from web_apps import changes, crud, database, models, schemas
 
 
 def test_db_tables_setup(db_cursor):
     result = db_cursor.execute("SELECT name FROM sqlite_master")
-    assert result.fetchall() == [("nodes",), ("connections",)]
+    assert result.fetchall() == [("nodes",), ("ix_nodes_name_normalized",), ("connections",),
+                                 ("ix_connections_subject_id_name_target_id",),
+                                 ("ix_connections_target_id_name_subject_id",), ("ix_connections_name",)]
 
     pass
 
@@ -17,3 +24,47 @@ def test_fixture(db_session):
     assert len(connections) == 17
     assert crud.get_table_size(db_session, models.Connection) == 17
 
+
+def test_prod_profile_sets_pragmas(db_populated_filename):
+    engine = database.create_database_engine("sqlite:///" + db_populated_filename, database.get_profile("prod"))
+    with engine.connect() as db_connection:
+        pragmas = {name: db_connection.execute(text(f"PRAGMA {name}")).scalar()
+                   for name in ["journal_mode", "synchronous", "cache_size", "temp_store", "foreign_keys"]}
+    engine.dispose()
+
+    # synchronous 1 is NORMAL, temp_store 2 is MEMORY
+    assert pragmas == {"journal_mode": "wal", "synchronous": 1, "cache_size": -64000, "temp_store": 2,
+                       "foreign_keys": 1}
+    assert engine.pool.size() == database.get_profile("prod").pool_size
+
+
+def test_unknown_profile():
+    with pytest.raises(ValueError):
+        database.get_profile("fastest")
+
+
+def test_read_only_engine(json_app_engine, json_app_read_engine):
+    with Session(json_app_read_engine) as db_session:
+        assert crud.get_node(db_session, 1).name == "Andrew"
+        assert changes.engine_of(db_session) is json_app_engine
+
+        with pytest.raises(OperationalError, match="readonly"):
+            crud.create_node(db_session, schemas.NodeCreate(name="Chris"))
+
+
+def test_foreign_keys_only_on_profile_engines(db_populated_filename):
+    # the pragma is the profile's, so an engine made some other way keeps SQLite's default
+    other_engine = create_engine("sqlite:///" + db_populated_filename)
+    profile_engine = database.create_database_engine("sqlite:///" + db_populated_filename,
+                                                     database.EngineProfile(foreign_keys=False))
+    for db_engine in [other_engine, profile_engine]:
+        with db_engine.connect() as db_connection:
+            assert db_connection.execute(text("PRAGMA foreign_keys")).scalar() == 0
+        db_engine.dispose()
+
+
+def test_default_profile_is_quiet(monkeypatch):
+    monkeypatch.delenv("KNOWLEDGE_DB_PROFILE", raising=False)
+    assert database.get_profile() == database.get_profile("default")
+    assert not database.get_profile().echo
+    assert database.get_profile("dev").echo
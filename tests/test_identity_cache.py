@@ -0,0 +1,182 @@
+import sqlite3
+import time
+
+import pytest
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from web_apps import changes, crud, identity_cache, models
+from web_apps.crud import ConnectionNodeNotFoundError
+from web_apps.schemas import ConnectionCreate, NodeCreate
+
+
+@pytest.fixture()
+def db_identity_cache(db_session):
+    engine = db_session.get_bind()
+    yield identity_cache.create_identity_cache(engine, max_size=100)
+
+    # tear down
+    identity_cache.drop_identity_cache(engine)
+
+
+def node_selects(executed_statements) -> list[str]:
+    return [statement for statement, _ in executed_statements if statement.startswith("SELECT nodes.")]
+
+
+def test_lookups_are_remembered(db_session, db_identity_cache, executed_statements):
+    assert crud.get_node(db_session, 1).name == "Andrew"
+    assert crud.get_node_by_name(db_session, "chief engineer").id == 11
+    assert len(executed_statements) == 2
+
+    executed_statements.clear()
+    assert crud.get_node(db_session, 1).name == "Andrew"
+    assert crud.get_node_by_name(db_session, " ANDREW ").id == 1
+    assert crud.get_node(db_session, 11).name == "Chief Engineer"
+    assert executed_statements == []
+
+    stats = db_identity_cache.stats()
+    assert (stats.node_count, stats.hits, stats.misses) == (2, 3, 2)
+
+
+def test_connection_lookups_are_remembered(db_session, db_identity_cache, executed_statements):
+    crud.get_connection(db_session, 1)
+    executed_statements.clear()
+
+    db_connection = crud.get_connection(db_session, 1)
+    assert (db_connection.name, db_connection.subject.name, db_connection.target.name) == \
+           ("has title", "Andrew", "Chief Engineer")
+    assert executed_statements == []
+
+
+def test_writes_are_written_through(db_session, db_identity_cache, executed_statements):
+    crud.get_node(db_session, 1)
+    crud.update_node(db_session, 1, "Andy")
+    new_node = crud.create_new_node(db_session, NodeCreate(name="Chris"))
+    executed_statements.clear()
+
+    assert crud.get_node(db_session, 1).name == "Andy"
+    assert crud.get_node_by_name(db_session, "chris").id == new_node.id
+    assert executed_statements == []
+
+    assert crud.get_node_by_name(db_session, "Andrew") is None
+
+    crud.delete_node(db_session, new_node.id)
+    assert crud.get_node(db_session, new_node.id) is None
+
+
+def test_repeated_connection_nodes_are_looked_up_once(db_session, db_identity_cache, executed_statements):
+    for name in ["Dave", "Erin", "Fred"]:
+        crud.create_connection(db_session, ConnectionCreate(name="Under GM", subject=NodeCreate(name=name),
+                                                            target=NodeCreate(name="Gina")))
+        crud.create_connection(db_session, ConnectionCreate(name="Employment type", subject=NodeCreate(name=name),
+                                                            target=NodeCreate(name="Permanent")))
+    # a node that was already there is looked up the first time only
+    for subject in [1, 2, 3]:
+        crud.create_connection(db_session, ConnectionCreate(name="Under GM", subject=subject,
+                                                            target=NodeCreate(name="Chief Engineer")))
+
+    node_inserts = [statement for statement, _ in executed_statements if statement.startswith("INSERT INTO nodes")]
+    assert len(node_inserts) == 3 + 2 + 1
+    assert len(node_selects(executed_statements)) == 3 + 1
+
+
+def test_bulk_loads_skip_nodes_seen(db_session, db_identity_cache, executed_statements):
+    crud.create_connections_bulk(db_session, [
+        ConnectionCreate(name="Under GM", subject=NodeCreate(name="Dave"), target=NodeCreate(name="Andrew")),
+        ConnectionCreate(name="Under GM", subject=NodeCreate(name="Erin"), target=2)])
+    executed_statements.clear()
+
+    result = crud.create_connections_bulk(db_session, [
+        ConnectionCreate(name="Employment type", subject=NodeCreate(name="dave"), target=2),
+        ConnectionCreate(name="Employment type", subject=NodeCreate(name="Andrew"), target=2)])
+    assert result.created == 2
+    assert not any("FROM nodes" in statement for statement, _ in executed_statements)
+
+
+def test_least_recently_used_evicted(db_session, db_identity_cache):
+    db_identity_cache.max_size = 2
+    for node_id in [1, 2, 1, 3]:
+        crud.get_node(db_session, node_id)
+
+    assert list(db_identity_cache.nodes) == [1, 3]
+    assert crud.get_node_by_name(db_session, "brian").id == 2
+    assert list(db_identity_cache.nodes) == [3, 2]
+
+
+def test_rows_read_after_a_commit_not_remembered(db_session, db_identity_cache):
+    with Session(db_session.get_bind()) as other_session:
+        other_session.execute(select(1))  # begins its transaction
+        crud.update_node(db_session, 2, "Bryan")
+
+        assert crud.get_node(other_session, 3).name == "Cindy"
+    assert 3 not in db_identity_cache.nodes
+    assert db_identity_cache.nodes[2].name == "Bryan"
+
+
+def test_uncommitted_deletes_bypass_cache(db_session, db_identity_cache):
+    crud.get_node(db_session, 21)
+    db_session.execute(delete(models.Node).filter(models.Node.id == 21))
+    changes.record(db_session, changes.NodesDeleted((21,)))
+
+    assert crud.get_node(db_session, 21) is None
+    db_session.rollback()
+    assert crud.get_node(db_session, 21).name == "Java"
+
+
+def delete_nodes_unseen(db_session: Session, node_ids: list[int]) -> None:
+    """
+    Delete the nodes as another process would, without the cache hearing about it
+    """
+    db_session.commit()
+    ids = ", ".join(map(str, node_ids))
+    with sqlite3.connect(db_session.get_bind().url.database) as other_connection:
+        other_connection.execute(f"DELETE FROM connections WHERE subject_id IN ({ids}) OR target_id IN ({ids})")
+        other_connection.execute(f"DELETE FROM nodes WHERE id IN ({ids})")
+
+
+def test_writes_forget_nodes_deleted_unseen(db_session, db_identity_cache):
+    assert crud.get_node(db_session, 3).name == "Cindy"
+    assert crud.get_node_by_name(db_session, "Andrew").id == 1
+    delete_nodes_unseen(db_session, [1, 3])
+
+    with pytest.raises(ConnectionNodeNotFoundError):
+        crud.create_connection(db_session, ConnectionCreate(name="mentors", subject=3, target=2))
+    db_connection = crud.create_connection(db_session, ConnectionCreate(name="mentors",
+                                                                        subject=NodeCreate(name="Andrew"), target=2))
+    assert db_connection.subject_id != 1
+    assert db_connection.subject.name == "Andrew"
+
+
+def test_bulk_writes_forget_nodes_deleted_unseen(db_session, db_identity_cache):
+    crud.get_node(db_session, 3)
+    crud.get_node_by_name(db_session, "Andrew")
+    delete_nodes_unseen(db_session, [1, 3])
+
+    with pytest.raises(ConnectionNodeNotFoundError):
+        crud.create_connections_bulk(db_session, [ConnectionCreate(name="mentors", subject=3, target=2)])
+    result = crud.create_connections_bulk(db_session, [
+        ConnectionCreate(name="mentors", subject=NodeCreate(name="Andrew"), target=2)])
+    assert result.created == 1
+    assert crud.get_node_by_name(db_session, "Andrew").id != 1
+
+
+def test_cache_expires(db_session, db_identity_cache, executed_statements):
+    crud.get_node(db_session, 1)
+    db_identity_cache.expires = time.monotonic()
+    executed_statements.clear()
+
+    crud.get_node(db_session, 1)
+    assert len(node_selects(executed_statements)) == 1
+
+
+def test_identity_cache_stats(json_app_client, json_app_engine):
+    assert json_app_client.get("/identity-cache/").status_code == 404
+
+    identity_cache.create_identity_cache(json_app_engine, max_size=10)
+    try:
+        json_app_client.get("/nodes/1")
+        json_app_client.get("/nodes/1")
+        response = json_app_client.get("/identity-cache/")
+    finally:
+        identity_cache.drop_identity_cache(json_app_engine)
+    assert response.json() == {"node_count": 1, "connection_count": 0, "max_size": 10, "hits": 1, "misses": 1}
@@ -86,8 +86,8 @@ def test_load_time_by_task(db_session):
 
     filename = "./Utilisation report - 20230227.xlsx - TimeByTask.csv"
     lines_in_file = 5056
-    nodes_in_file = 382
-    connections_in_file = 379 + 539 + 143
+    nodes_in_file = 381  # 382 names, but two jobs only differ by a trailing space
+    connections_in_file = 379 + 539 + 143 - 1  # and one of its connections becomes a duplicate
 
     lines_processed = load_time_by_task(db_session, filename)
     assert lines_processed == lines_in_file
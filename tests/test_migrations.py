@@ -0,0 +1,52 @@
+import os
+import sqlite3
+
+from sqlalchemy.orm import Session
+
+from web_apps import crud
+from web_apps.database import EngineProfile, create_database_engine
+from web_apps.migrations import upgrade_database
+
+
+def create_legacy_database(db_filename: str):
+    with sqlite3.connect(db_filename) as db_connection:
+        db_connection.execute("CREATE TABLE nodes (id INTEGER NOT NULL, name VARCHAR NOT NULL, PRIMARY KEY (id))")
+        db_connection.execute("""
+            CREATE TABLE connections (
+                id INTEGER NOT NULL, 
+                name VARCHAR NOT NULL, 
+                subject_id INTEGER NOT NULL, 
+                target_id INTEGER NOT NULL, 
+                PRIMARY KEY (id), 
+                FOREIGN KEY(subject_id) REFERENCES nodes (id), 
+                FOREIGN KEY(target_id) REFERENCES nodes (id)
+            )
+        """)
+        db_connection.executemany("INSERT INTO nodes VALUES ( ?, ? )",
+                                  [(1, "Andrew"), (2, "Java"), (3, " andrew "), (4, "JAVA")])
+        db_connection.executemany("INSERT INTO connections VALUES ( ?, ?, ?, ? )",
+                                  [(1, "has experience in", 1, 2), (2, "has experience in", 3, 4),
+                                   (3, "has experience in", 1, 5)])  # node 5 is long gone
+
+
+def test_upgrade_legacy_database(temp_dir):
+    db_filename = temp_dir + "/legacy.db"
+    create_legacy_database(db_filename)
+    engine = create_database_engine("sqlite:///" + db_filename, EngineProfile())
+
+    upgrade_database(engine)
+    upgrade_database(engine)  # upgrading is safe to repeat
+
+    with Session(engine) as db_session:
+        assert [node.id for node in crud.get_nodes(db_session)] == [1, 2]
+        assert crud.get_node_by_name(db_session, "ANDREW").id == 1
+        # merging the nodes made the two connections the same, so only the first is kept
+        # and the connection to the missing node is dropped
+        assert [(c.id, c.subject_id, c.target_id) for c in crud.get_connections(db_session)] == [(1, 1, 2)]
+
+        # the rebuilt connections table deletes connections with their nodes
+        crud.delete_node(db_session, 2)
+        assert crud.get_connections(db_session) == []
+
+    engine.dispose()
+    os.remove(db_filename)
@@ -0,0 +1,125 @@
+import sys
+import threading
+
+import pytest
+
+from web_apps import changes, crud, name_index, schemas
+from web_apps.name_index import NameIndex, NameIndexes
+
+
+@pytest.fixture()
+def name_indexes(db_session):
+    engine = db_session.get_bind()
+    yield name_index.build_name_indexes(engine)
+
+    # tear down
+    name_index.drop_name_indexes(engine)
+
+
+def node_names(nodes) -> list[str]:
+    return [node.name for node in nodes]
+
+
+def test_search():
+    index = NameIndex(max_bytes=1024 * 1024)
+    index.add(1, "Chief Engineer")
+    index.add(2, "Engineer")
+    index.add(3, "Manager")
+    assert index.search("ENGINEER") == [1, 2]
+    assert index.search("ef en") == [1]
+    assert index.search("nothing") == []
+    assert index.search("en") is None  # shorter than a trigram
+
+    index.add(2, "Senior Manager")
+    assert index.search("engineer") == [1]
+    assert index.search("manager") == [2, 3]
+    index.remove(3)
+    assert index.search("manager") == [2]
+
+
+def test_index_over_budget_stops_answering():
+    index = NameIndex(max_bytes=1024)
+    for row_id in range(100):
+        index.add(row_id, f"name {row_id}")
+    assert index.over_budget
+    assert not index.name_by_id
+    assert index.search("name") is None
+
+
+def test_searches_during_writes():
+    name_indexes = NameIndexes(max_bytes=64 * 1024 * 1024)
+    errors = []
+    writes_done = threading.Event()
+
+    def search():
+        while not writes_done.is_set():
+            try:
+                name_indexes.nodes.search("engineer")
+            except Exception as error:
+                errors.append(error)
+                return
+
+    searcher = threading.Thread(target=search)
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads often, to catch a search part way through a write
+    searcher.start()
+    for round_number in range(200):
+        name_indexes.apply(None, [changes.NodeWritten(node_id, f"Engineer {round_number}") for node_id in range(50)])
+        name_indexes.apply(None, [changes.NodesDeleted(tuple(range(50)))])
+    writes_done.set()
+    searcher.join()
+    sys.setswitchinterval(switch_interval)
+    assert errors == []
+
+
+def test_crud_searches_match_sql(db_session, name_indexes):
+    for like in ["engineer", "ENG", "an", "nobody"]:
+        from_index = crud.get_nodes_like_name(db_session, like)
+        name_index.drop_name_indexes(db_session.get_bind())
+        from_sql = crud.get_nodes_like_name(db_session, like)
+        name_index.build_name_indexes(db_session.get_bind())
+        assert node_names(from_index) == node_names(from_sql)
+
+    for like in ["is a", "works"]:
+        from_index = crud.get_connections_like_name(db_session, like)
+        name_index.drop_name_indexes(db_session.get_bind())
+        from_sql = crud.get_connections_like_name(db_session, like)
+        name_index.build_name_indexes(db_session.get_bind())
+        assert [connection.id for connection in from_index] == [connection.id for connection in from_sql]
+
+
+def test_crud_searches_paginate(db_session, name_indexes):
+    all_nodes = crud.get_nodes_like_name(db_session, "engineer")
+    first_page = crud.get_nodes_like_name(db_session, "engineer", limit=1)
+    next_page = crud.get_nodes_like_name(db_session, "engineer", after_id=first_page[-1].id)
+    assert node_names(first_page + next_page) == node_names(all_nodes)
+
+
+def test_writes_update_index(db_session, name_indexes):
+    node = crud.create_node(db_session, schemas.NodeCreate(name="Quantum Physicist"))
+    assert name_indexes.nodes.search("quantum") == [node.id]
+
+    crud.update_node(db_session, node.id, "Quantum Chemist")
+    assert name_indexes.nodes.search("physicist") == []
+    assert name_indexes.nodes.search("chemist") == [node.id]
+
+    connection = crud.create_connection(db_session, schemas.ConnectionCreate(
+        name="mentors", subject=node.id, target=1))
+    assert name_indexes.connections.search("mentors") == [connection.id]
+
+    crud.delete_node(db_session, node.id)
+    assert name_indexes.nodes.search("quantum") == []
+    assert name_indexes.connections.search("mentors") == []
+
+
+def test_rolled_back_writes_leave_index_alone(db_session, name_indexes):
+    crud.insert_node(db_session, schemas.NodeCreate(name="Quantum Physicist"))
+    db_session.rollback()
+    assert name_indexes.nodes.search("quantum") == []
+
+
+def test_deleting_everything_clears_index(db_session, name_indexes):
+    crud.delete_connections(db_session)
+    crud.delete_nodes(db_session)
+    assert name_indexes.nodes.search("engineer") == []
+    assert name_indexes.connections.search("is a") == []
@@ -35,6 +35,25 @@ def test_read_all_nodes_api(json_app_client):
     assert node_3.name == "Cindy"
 
 
+def test_read_nodes_by_page_api(json_app_client):
+    response = json_app_client.get("/nodes/?limit=10")
+    assert response.status_code == 200, response.text
+    assert len(response.json()) == 10
+    cursor = response.headers["X-Next-Cursor"]
+
+    response = json_app_client.get(f"/nodes/?limit=10&after={cursor}")
+    assert response.status_code == 200, response.text
+    nodes_json = response.json()
+    assert len(nodes_json) == 5
+    assert schemas.Node(**nodes_json[0]).name == "SpringBoot"
+    assert "X-Next-Cursor" not in response.headers
+
+
+def test_read_nodes_with_invalid_cursor_api(json_app_client):
+    response = json_app_client.get("/nodes/?after=not-a-cursor")
+    assert response.status_code == 400
+
+
 def test_read_node_by_name_api(json_app_client):
     response = json_app_client.get("/nodes/?like=Andrew")
     assert response.status_code == 200, response.text
@@ -44,6 +63,25 @@ def test_read_node_by_name_api(json_app_client):
     assert node_1.name == "Andrew"
 
 
+def test_search_nodes_api(json_app_client):
+    response = json_app_client.get("/search/nodes?q=engineer&limit=1")
+    assert response.status_code == 200, response.text
+    nodes_json = response.json()
+    assert len(nodes_json) == 1
+    assert schemas.Node(**nodes_json[0]).name == "Chief Engineer"
+
+
+def test_suggest_nodes_api(json_app_client):
+    response = json_app_client.get("/suggest/nodes?prefix=AN")
+    assert response.status_code == 200, response.text
+    suggestions = [schemas.NodeSuggestion(**suggestion_json) for suggestion_json in response.json()]
+    assert [(suggestion.name, suggestion.degree) for suggestion in suggestions] == [
+        ("Andrew", 6), ("Android", 1), ("Angular", 1)]
+
+    response = json_app_client.get("/suggest/nodes?prefix=c&limit=2")
+    assert [suggestion_json["name"] for suggestion_json in response.json()] == ["Cindy", "Chief Engineer"]
+
+
 def test_update_node_api(json_app_client):
     full_name = "Charles James Clarkson"
     response = json_app_client.put("/nodes/1", json=schemas.NodeCreate(name=full_name).dict())
@@ -69,8 +107,78 @@ def test_delete_node_api(json_app_client):
     assert node_3.name == "Cindy"
 
 
+def test_get_node_impact_api(json_app_client):
+    response = json_app_client.get("/nodes/1/impact")
+    assert response.status_code == 200, response.text
+    assert response.json() == {"node_id": 1, "connection_count": 6}
+
+    response = json_app_client.get("/nodes/99/impact")
+    assert response.status_code == 404, response.text
+
+
+def test_delete_nodes_api(json_app_client):
+    response = json_app_client.delete("/nodes?ids=1&ids=99")
+    assert response.status_code == 200, response.text
+    assert response.json() == {"deleted_ids": [1], "missing_ids": [99], "connection_count": 6}
+
+    response = json_app_client.get("/nodes/1/neighbourhood")
+    assert response.status_code == 404, response.text
+
+    response = json_app_client.delete("/nodes")
+    assert response.status_code == 422, response.text
+
+
 def test_delete_all_nodes(json_app_client):
     response = json_app_client.delete("/nodes/")
     assert response.status_code == 200
     response_json = response.json()
     assert response_json["message"] == "deleted 15 nodes and 17 connections"
+
+
+def test_delete_all_nodes_rejects_ids(json_app_client):
+    response = json_app_client.delete("/nodes/?ids=1")
+    assert response.status_code == 400, response.text
+    assert json_app_client.get("/nodes/1").status_code == 200
+
+
+def test_get_neighbourhood_api(json_app_client):
+    response = json_app_client.get("/nodes/2/neighbourhood?depth=2&direction=out&names=has+title&names=worked+at")
+    assert response.status_code == 200, response.text
+    neighbourhood = schemas.Neighbourhood(**response.json())
+    assert [(node.name, node.depth) for node in neighbourhood.nodes] == [
+        ("Brian", 0), ("Practice Lead", 1), ("Countdown", 1), ("Westpac", 1)]
+    assert [connection.id for connection in neighbourhood.connections] == [2, 23, 24]
+
+    response = json_app_client.get("/nodes/99/neighbourhood")
+    assert response.status_code == 404
+    response = json_app_client.get("/nodes/2/neighbourhood?depth=100")
+    assert response.status_code == 422
+
+
+def test_get_shortest_paths_api(json_app_client):
+    response = json_app_client.get("/paths?from=1&to=33")  # how is Andrew related to Westpac?
+    assert response.status_code == 200, response.text
+    shortest_paths = schemas.ShortestPaths(**response.json())
+    assert not shortest_paths.exhausted
+    assert [[node.name for node in path.nodes] for path in shortest_paths.paths] == [
+        ["Andrew", "Java", "Brian", "Westpac"],
+        ["Andrew", "React", "Cindy", "Westpac"],
+        ["Andrew", "Warehouse Group", "Cindy", "Westpac"],
+        ["Andrew", "Global Dairy", "Cindy", "Westpac"]]
+    assert [connection.id for connection in shortest_paths.paths[0].connections] == [11, 14, 24]
+
+    response = json_app_client.get("/paths?from=1&to=33&names=worked+at&max_paths=1")
+    assert [[node["name"] for node in path["nodes"]] for path in response.json()["paths"]] == [
+        ["Andrew", "Warehouse Group", "Cindy", "Westpac"]]
+
+    response = json_app_client.get("/paths?from=1&to=33&max_depth=2")
+    assert response.json() == {"paths": [], "exhausted": False}
+
+    response = json_app_client.get("/paths?from=1&to=33&direction=out")
+    assert response.json() == {"paths": [], "exhausted": False}
+
+    response = json_app_client.get("/paths?from=1&to=33&max_nodes=2")
+    assert response.json() == {"paths": [], "exhausted": True}
+
+    response = json_app_client.get("/paths?from=1&to=99")
+    assert response.status_code == 404
@@ -1,4 +1,8 @@
+import pytest
+from sqlalchemy import select, text
+
 from web_apps import crud, models
+from web_apps.crud import DuplicateNodeNameError
 from web_apps.schemas import NodeCreate
 
 
@@ -22,11 +26,31 @@ def test_get_node_by_name(db_session):
     assert node.name == "Cindy"
 
 
+def test_get_node_by_name_ignores_case_and_whitespace(db_session):
+    node = crud.get_node_by_name(db_session, "  chief ENGINEER ")
+    assert node.id == 11
+
+
+def test_get_node_by_name_uses_index(db_session):
+    select_stmt = select(models.Node).filter_by(name_insensitive="Cindy")
+    compiled = select_stmt.compile(db_session.get_bind(), compile_kwargs={"literal_binds": True})
+    query_plan = db_session.execute(text(f"EXPLAIN QUERY PLAN {compiled}")).all()
+    assert "USING INDEX ix_nodes_name_normalized" in query_plan[0].detail
+
+
 def test_get_nodes(db_session):
     nodes = crud.get_nodes(db_session)
     assert len(nodes) == 15
 
 
+def test_get_nodes_page(db_session):
+    first_page = crud.get_nodes(db_session, limit=4)
+    assert [node.id for node in first_page] == [1, 2, 3, 11]
+
+    second_page = crud.get_nodes(db_session, limit=4, after_id=first_page[-1].id)
+    assert [node.id for node in second_page] == [12, 13, 21, 22]
+
+
 def test_get_node_like_name(db_session):
     nodes = crud.get_nodes_like_name(db_session, like="engineer")
     assert len(nodes) == 2
@@ -34,6 +58,34 @@ def test_get_node_like_name(db_session):
     assert chief.name == "Chief Engineer"
 
 
+def test_get_nodes_like_short_name(db_session):
+    nodes = crud.get_nodes_like_name(db_session, like="an")
+    assert [node.name for node in nodes] == ["Andrew", "Brian", "Angular", "Android"]
+
+
+def test_search_nodes_ranks_best_matches_first(db_session):
+    crud.create_node(db_session, NodeCreate(name="Java Java Java"))
+    nodes = crud.search_nodes(db_session, "java")
+    assert [node.name for node in nodes] == ["Java", "Java Java Java"]
+
+
+def test_search_nodes_query_syntax(db_session):
+    assert [node.name for node in crud.search_nodes(db_session, "engineer")] == ["Chief Engineer", "Senior Engineer"]
+    assert [node.name for node in crud.search_nodes(db_session, "eng chief")] == ["Chief Engineer"]
+    assert [node.name for node in crud.search_nodes(db_session, '"r eng"')] == ["Senior Engineer"]
+    assert [node.name for node in crud.search_nodes(db_session, "an*")] == ["Andrew", "Angular", "Android"]
+    assert [node.name for node in crud.search_nodes(db_session, "and*")] == ["Andrew", "Android"]
+
+
+def test_search_finds_updated_node_names(db_session):
+    crud.update_node(db_session, 1, updated_name="Andy")
+    crud.delete_node(db_session, 2)
+
+    assert [node.name for node in crud.search_nodes(db_session, "andy")] == ["Andy"]
+    assert crud.search_nodes(db_session, "andrew") == []
+    assert crud.search_nodes(db_session, "brian") == []
+
+
 def test_update_node(db_session):
     node = crud.update_node(db_session, 1, updated_name="Andy")
     assert node.name == "Andy"
@@ -44,6 +96,13 @@ def test_update_nonexistent_node(db_session):
     assert node is None
 
 
+def test_update_node_to_existing_name(db_session):
+    with pytest.raises(DuplicateNodeNameError):
+        crud.update_node(db_session, 1, updated_name="brian")
+
+    assert crud.get_node(db_session, 1).name == "Andrew"
+
+
 def test_delete_existing_node(db_session):
     orig_count = crud.get_table_size(db_session, models.Node)
 
@@ -56,6 +115,25 @@ def test_delete_existing_node(db_session):
     assert new_count == orig_count - 1
 
 
+def test_delete_nodes_by_ids(db_session):
+    orig_node_count = crud.get_table_size(db_session, models.Node)
+    orig_connection_count = crud.get_table_size(db_session, models.Connection)
+    impact = crud.get_node_impact(db_session, 1) + crud.get_node_impact(db_session, 11)
+
+    deleted_ids, connection_count = crud.delete_nodes_by_ids(db_session, [11, 1, 99, 11])
+    assert deleted_ids == [1, 11]
+    assert connection_count == impact - 1  # Andrew has the title
+
+    assert crud.get_table_size(db_session, models.Node) == orig_node_count - 2
+    assert crud.get_table_size(db_session, models.Connection) == orig_connection_count - connection_count
+    assert crud.get_connections_to_node(db_session, 1) == []
+
+
+def test_get_node_impact(db_session):
+    assert crud.get_node_impact(db_session, 1) == len(crud.get_connections_to_node(db_session, 1))
+    assert crud.get_node_impact(db_session, 99) == 0
+
+
 def test_delete_nonexistent_node(db_session):
     orig_count = crud.get_table_size(db_session, models.Node)
 
@@ -80,6 +158,13 @@ def test_cant_create_duplicate_node_name(db_session):
     assert new_node.name == node_1_name
 
 
+def test_create_node_is_one_statement(db_session, executed_statements):
+    crud.create_node(db_session, NodeCreate(name="Chris"))
+
+    assert len(executed_statements) == 1
+    assert "ON CONFLICT (name_normalized) DO NOTHING RETURNING" in executed_statements[0][0]
+
+
 def test_create_node_name_substring(db_session):
     """
     Test that we can create two unique nodes where one node name is a substring of the other
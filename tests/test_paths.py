@@ -0,0 +1,37 @@
+import time
+
+from web_apps import paths, schemas
+from web_apps.paths import SearchTree
+
+
+def hub_connections(node_ids: set[int], direction: schemas.Direction) -> list[tuple[int, int, int]]:
+    # node 0 is connected to nodes 1 to 10,000, and they to nothing else
+    return [(0, neighbour_id, neighbour_id) for neighbour_id in range(1, 10_001)] if 0 in node_ids else []
+
+
+def test_extend_stops_at_node_budget_within_a_level():
+    tree = SearchTree(0, schemas.Direction.both)
+    assert not tree.extend(hub_connections, max_nodes=100, deadline=time.monotonic() + 60)
+    assert len(tree.distances) == 101
+
+
+def test_extend_stops_at_deadline_between_chunks(monkeypatch):
+    tree = SearchTree(0, schemas.Direction.both)
+    tree.frontier = set(range(paths.FRONTIER_CHUNK_SIZE * 3))
+    fetched = []
+
+    def slow_connections(node_ids: set[int], direction: schemas.Direction) -> list[tuple[int, int, int]]:
+        fetched.append(len(node_ids))
+        monkeypatch.setattr(paths.time, "monotonic", lambda: float("inf"))  # the fetch took all the time there was
+        return []
+
+    assert not tree.extend(slow_connections, max_nodes=100_000, deadline=time.monotonic() + 60)
+    assert fetched == [paths.FRONTIER_CHUNK_SIZE]
+
+
+def test_extend_checks_deadline_while_taking_connections(monkeypatch):
+    tree = SearchTree(0, schemas.Direction.both)
+    deadline = time.monotonic() + 60
+    monkeypatch.setattr(paths.time, "monotonic", lambda: deadline + 1 if len(tree.distances) > 1 else 0.0)
+    assert not tree.extend(hub_connections, max_nodes=100_000, deadline=deadline)
+    assert len(tree.distances) == paths.CONNECTIONS_PER_DEADLINE_CHECK + 1
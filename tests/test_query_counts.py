@@ -0,0 +1,56 @@
+"""
+Lock in how many SQL statements each write endpoint of the json app costs
+"""
+import pytest
+
+from web_apps import schemas
+
+
+@pytest.fixture()
+def count_statements(json_app_client, json_app_executed_statements):
+    def count(method: str, url: str, expected_status_code: int = 200, json=None) -> int:
+        json_app_executed_statements.clear()
+        response = json_app_client.request(method, url, json=json)
+        assert response.status_code == expected_status_code, response.text
+        return len(json_app_executed_statements)
+
+    return count
+
+
+def test_create_node(count_statements):
+    assert count_statements("POST", "/nodes/", json={"name": "Chris"}) == 1  # insert
+    assert count_statements("POST", "/nodes/", 400, json={"name": "Chris"}) == 1
+
+
+def test_update_node(count_statements):
+    assert count_statements("PUT", "/nodes/1", json={"name": "Andy"}) == 1  # update
+    assert count_statements("PUT", "/nodes/99", 404, json={"name": "Nobody"}) == 1
+
+
+def test_delete_node(count_statements):
+    assert count_statements("DELETE", "/nodes/1") == 2  # find its connections, delete the node
+
+
+def test_create_connection(count_statements):
+    connection = schemas.ConnectionCreate(name="is a", subject=schemas.NodeCreate(name="Wayne"), target=11)
+    assert count_statements("POST", "/connections/", json=connection.dict()) == 3  # insert node, get node, insert
+
+
+def test_update_connection(count_statements):
+    connection = schemas.ConnectionCreate(name="wants to be", subject=3, target=11)
+    assert count_statements("PUT", "/connections/1", json=connection.dict()) == 3  # get nodes, update
+    connection = schemas.ConnectionCreate(name="used to be", subject=3, target=11)
+    assert count_statements("PUT", "/connections/50", 201, json=connection.dict()) == 4  # get nodes, update, insert
+
+
+def test_delete_connection(count_statements):
+    assert count_statements("DELETE", "/connections/1") == 1
+
+
+def test_delete_connections_by_ids(count_statements):
+    ids = "&".join(f"ids={connection_id}" for connection_id in range(1, 600))
+    assert count_statements("DELETE", f"/connections?{ids}") == 2  # one delete per chunk of 500
+
+
+def test_get_stats(count_statements):
+    assert count_statements("GET", "/stats/") == 2  # the counts and the highest degree, neither counting rows
@@ -0,0 +1,58 @@
+"""
+Check that the hot crud queries are answered from an index rather than a full table scan
+"""
+from sqlalchemy.orm import Session
+
+from web_apps import crud
+
+
+def query_plans(db_session: Session, executed_statements: list[tuple[str, tuple]]) -> list[str]:
+    plans = []
+    for statement, parameters in executed_statements:
+        if statement.startswith(("SELECT", "DELETE")):
+            rows = db_session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+            plans.append("\n".join(row.detail for row in rows))
+    return plans
+
+
+def assert_no_scans(plans: list[str], table_name: str):
+    assert plans
+    for plan in plans:
+        assert f"SCAN {table_name}" not in plan, plan
+
+
+def test_get_connections_to_node_uses_indexes(db_session, executed_statements):
+    crud.get_connections_to_node(db_session, 1)
+
+    plans = query_plans(db_session, executed_statements)
+    assert_no_scans(plans, "connections")
+    assert "ix_connections_subject_id_name_target_id" in plans[0]
+    assert "ix_connections_target_id_name_subject_id" in plans[0]
+
+
+def test_get_connection_by_name_target_id_and_subject_id_uses_index(db_session, executed_statements):
+    crud.get_connection_by_name_target_id_and_subject_id(db_session, name="has title", subject_id=1, target_id=11)
+
+    assert_no_scans(query_plans(db_session, executed_statements), "connections")
+
+
+def test_delete_node_uses_indexes(db_session, executed_statements):
+    crud.delete_node(db_session, 1)
+
+    plans = query_plans(db_session, executed_statements)
+    assert len(plans) == 2  # find the connections, then delete the node (which cascades to them)
+    assert_no_scans(plans, "connections")
+
+
+def test_get_nodes_like_name_uses_search_index(db_session, executed_statements):
+    crud.get_nodes_like_name(db_session, "engineer")
+
+    plans = query_plans(db_session, executed_statements)
+    assert "SEARCH nodes USING INTEGER PRIMARY KEY" in plans[0]
+    assert "SCAN nodes_fts VIRTUAL TABLE INDEX 0:M" in plans[0]  # M for MATCH
+
+
+def test_get_node_impact_uses_indexes(db_session, executed_statements):
+    crud.get_node_impact(db_session, 1)
+
+    assert_no_scans(query_plans(db_session, executed_statements), "connections")
@@ -0,0 +1,137 @@
+import sqlite3
+
+import pytest
+
+from web_apps import crud, schemas, suggest
+from web_apps.suggest import PrefixIndex
+
+
+@pytest.fixture()
+def suggest_indexes(db_session):
+    engine = db_session.get_bind()
+    yield suggest.build_suggest_indexes(engine)
+
+    # tear down
+    suggest.drop_suggest_indexes(engine)
+
+
+def suggested_names(suggestions) -> list[str]:
+    return [suggestion.name for suggestion in suggestions]
+
+
+def test_top():
+    index = PrefixIndex()
+    index.load({1: "Java", 2: "JavaScript", 3: "Jakarta", 4: "Python"}, {1: 5, 2: 9})
+    assert index.top("ja", 10) == [2, 1, 3]
+    assert index.top("jav", 1) == [2]
+    assert index.top("", 10) == [2, 1, 3, 4]
+    assert index.top("x", 10) == []
+
+    index.set(3, "Jakarta", 7)
+    assert index.top("ja", 10) == [2, 3, 1]
+    index.set(2, "TypeScript", 9)
+    assert index.top("ja", 10) == [3, 1]
+    assert index.top("ty", 10) == [2]
+    index.remove(3)
+    assert index.top("jak", 10) == []
+    assert index.top("ja", 10) == [1]
+
+
+def test_top_keeps_full_cached_lists_right():
+    index = PrefixIndex()
+    index.load({item: f"name {item}" for item in range(suggest.MAX_SUGGESTIONS * 2)},
+               {item: item for item in range(suggest.MAX_SUGGESTIONS * 2)})
+    best = list(reversed(range(suggest.MAX_SUGGESTIONS * 2)))
+    assert index.top("name", 3) == best[:3]
+
+    index.set(0, "name 0", 1000)
+    assert index.top("name", 3) == [0] + best[:2]
+    index.set(0, "name 0", -1)
+    index.add_to_score(best[0], -1000)
+    assert index.top("name", 3) == best[1:4]
+    assert index.top("name", suggest.MAX_SUGGESTIONS) == best[1:suggest.MAX_SUGGESTIONS + 1]
+
+
+def test_short_lists_ranked_again_only_when_too_short(monkeypatch):
+    index = PrefixIndex()
+    index.load({item: f"name {item}" for item in range(suggest.MAX_SUGGESTIONS * 2)},
+               {item: item for item in range(suggest.MAX_SUGGESTIONS * 2)})
+    best = list(reversed(range(suggest.MAX_SUGGESTIONS * 2)))
+    index.top("name", 3)
+    for item in best[:3]:
+        index.add_to_score(item, -1000)
+    assert "name" in index.short_prefixes
+
+    ranked = []
+    monkeypatch.setattr(index, "rank_keys", lambda keys: ranked.append(keys) or PrefixIndex.rank_keys(index, keys))
+    assert index.top("name", 10) == best[3:13]
+    assert ranked == []
+    assert index.top("name", suggest.MAX_SUGGESTIONS) == best[3:suggest.MAX_SUGGESTIONS + 3]
+    assert len(ranked) == 1
+    assert "name" not in index.short_prefixes
+
+
+def test_ranking_overtaken_by_a_write_not_kept(monkeypatch):
+    suggest_indexes = suggest.SuggestIndexes()
+    index = suggest_indexes.nodes
+    index.load({1: "Java", 2: "JavaScript", 3: "Jakarta"}, {1: 5, 2: 9})
+
+    def rank_keys_during_write(keys):
+        # a write lands while the suggestion ranks the keys it took without the lock
+        with suggest_indexes.lock:
+            index.set(3, "Jakarta", 10)
+        return PrefixIndex.rank_keys(index, keys)
+
+    monkeypatch.setattr(index, "rank_keys", rank_keys_during_write)
+    assert suggested_names(suggest_indexes.suggest_nodes("jav", 10)) == ["JavaScript", "Java"]
+    assert "jav" not in index.top_by_prefix
+    monkeypatch.undo()
+    assert suggested_names(suggest_indexes.suggest_nodes("ja", 10)) == ["Jakarta", "JavaScript", "Java"]
+
+
+def test_writes_update_suggestions(db_session, suggest_indexes):
+    node = crud.create_node(db_session, schemas.NodeCreate(name="Angela"))
+    assert suggested_names(suggest_indexes.suggest_nodes("ang", 10)) == ["Angular", "Angela"]
+
+    for target in [11, 12, 13]:
+        crud.create_connection(db_session, schemas.ConnectionCreate(name="mentors", subject=node.id, target=target))
+    assert suggested_names(suggest_indexes.suggest_nodes("ang", 10)) == ["Angela", "Angular"]
+    assert suggest_indexes.suggest_connection_names("men", 10) == [
+        schemas.ConnectionNameSuggestion(name="mentors", count=3)]
+
+    crud.update_node(db_session, node.id, "Bangle")
+    assert suggested_names(suggest_indexes.suggest_nodes("ang", 10)) == ["Angular"]
+
+    crud.delete_node(db_session, node.id)
+    assert suggest_indexes.suggest_connection_names("men", 10) == []
+    assert suggested_names(suggest_indexes.suggest_nodes("chief", 10)) == ["Chief Engineer"]
+    assert suggest_indexes.suggest_nodes("chief", 10)[0].degree == 1
+
+
+def test_rolled_back_writes_leave_suggestions_alone(db_session, suggest_indexes):
+    crud.insert_node(db_session, schemas.NodeCreate(name="Angela"))
+    db_session.rollback()
+    assert suggested_names(suggest_indexes.suggest_nodes("ang", 10)) == ["Angular"]
+
+
+@pytest.mark.parametrize("prefix", ["", "a", " AN", "c", "chief e", "j", "x"])
+def test_suggestions_from_sqlite_match_the_indexes(db_session, prefix):
+    from_sqlite = (crud.suggest_nodes(db_session, prefix, 5), crud.suggest_connection_names(db_session, prefix, 5))
+
+    suggest.build_suggest_indexes(db_session.get_bind())
+    try:
+        assert suggest.get_suggest_indexes(db_session) is not None
+        assert (crud.suggest_nodes(db_session, prefix, 5),
+                crud.suggest_connection_names(db_session, prefix, 5)) == from_sqlite
+    finally:
+        suggest.drop_suggest_indexes(db_session.get_bind())
+
+
+def test_suggestions_from_sqlite_see_other_writers(db_session):
+    assert crud.suggest_nodes(db_session, "ang", 10)[0].name == "Angular"
+    db_session.commit()
+    with sqlite3.connect(db_session.get_bind().url.database) as other_connection:
+        other_connection.execute("UPDATE nodes SET name = 'Bangular', name_normalized = 'bangular' "
+                                 "WHERE name = 'Angular'")
+
+    assert crud.suggest_nodes(db_session, "ang", 10) == []
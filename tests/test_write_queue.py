@@ -0,0 +1,130 @@
+import threading
+from io import StringIO
+
+import pytest
+from sqlalchemy.orm import Session
+
+from utilities.cvs_file_loader import load_staff_list_from_csv_buffer
+from utilities.load_test_data import load_test_data
+from web_apps import changes, crud, models, schemas, write_queue
+from web_apps.crud import DuplicateNodeNameError
+from web_apps.write_queue import WriteQueueFullError
+
+
+@pytest.fixture()
+def db_write_queue(json_app_engine):
+    # long enough for every write submitted together to land in one batch
+    yield write_queue.start_write_queue(json_app_engine, max_batch_size=50, max_latency=0.2)
+
+    # tear down
+    write_queue.stop_write_queue(json_app_engine)
+
+
+def test_writes_submitted_together_commit_together(db_write_queue, json_app_engine):
+    futures = [db_write_queue.submit(crud.create_new_node, schemas.NodeCreate(name=f"Node {number}"))
+               for number in range(20)]
+    nodes = [future.result() for future in futures]
+    assert [node.name for node in nodes] == [f"Node {number}" for number in range(20)]
+
+    stats = db_write_queue.stats()
+    assert stats.write_count == 20
+    assert stats.batch_count == 1
+    assert stats.largest_batch == 20
+    assert stats.queue_depth == 0
+    assert stats.max_queue_depth >= 1
+
+    with Session(json_app_engine) as db_session:
+        assert [crud.get_node(db_session, node.id).name for node in nodes] == [node.name for node in nodes]
+
+
+def test_failed_write_only_undoes_itself(db_write_queue, json_app_engine):
+    before = db_write_queue.submit(crud.create_new_node, schemas.NodeCreate(name="Before"))
+    duplicate = db_write_queue.submit(crud.update_node, 1, "Before")
+    after = db_write_queue.submit(crud.update_node, 2, "After")
+
+    before_node = before.result()
+    with pytest.raises(DuplicateNodeNameError):
+        duplicate.result()
+    assert after.result().name == "After"
+    assert db_write_queue.stats().batch_count == 1
+
+    with Session(json_app_engine) as db_session:
+        assert crud.get_node(db_session, before_node.id).name == "Before"
+        assert crud.get_node(db_session, 1).name != "Before"
+        assert crud.get_node(db_session, 2).name == "After"
+
+
+def test_listeners_see_committed_changes(db_write_queue, json_app_engine):
+    published = []
+
+    def listener(engine, engine_changes):
+        published.append((engine, engine_changes))
+
+    changes.add_listener(listener)
+    try:
+        node = db_write_queue.submit(crud.create_new_node, schemas.NodeCreate(name="Chris")).result()
+        with pytest.raises(DuplicateNodeNameError):
+            db_write_queue.submit(crud.update_node, 1, "Chris").result()
+    finally:
+        changes.remove_listener(listener)
+
+    assert published == [(json_app_engine, [changes.NodeWritten(node.id, "Chris")])]
+
+
+def test_full_queue_refuses_writes(json_app_engine):
+    db_write_queue = write_queue.start_write_queue(json_app_engine, max_batch_size=1, max_latency=0,
+                                                   max_queue_size=1)
+    writer_busy = threading.Event()
+    release_writer = threading.Event()
+
+    def wait(db_session):
+        writer_busy.set()
+        release_writer.wait()
+
+    try:
+        db_write_queue.submit(wait)
+        writer_busy.wait()
+        queued = db_write_queue.submit(crud.update_node, 1, "Queued")
+        with pytest.raises(WriteQueueFullError):
+            db_write_queue.submit(crud.update_node, 2, "Refused")
+        release_writer.set()
+        assert queued.result().name == "Queued"
+    finally:
+        release_writer.set()
+        write_queue.stop_write_queue(json_app_engine)
+
+
+def test_apis_write_through_the_queue(db_write_queue, json_app_client):
+    assert json_app_client.post("/nodes/", json={"name": "Chris"}).status_code == 200
+    assert json_app_client.put("/nodes/1", json={"name": "chris"}).status_code == 400
+    assert json_app_client.delete("/connections?ids=1&ids=99").json() == {"deleted_ids": [1], "missing_ids": [99]}
+
+    response = json_app_client.get("/write-queue/")
+    assert response.status_code == 200, response.text
+    stats = schemas.WriteQueueStats(**response.json())
+    assert stats.write_count == 3
+    assert stats.max_batch_size == 50
+
+
+def test_async_apis_write_through_the_queue(db_write_queue, async_app_client):
+    assert async_app_client.post("/nodes/", json={"name": "Chris"}).status_code == 200
+    assert async_app_client.put("/nodes/1", json={"name": "chris"}).status_code == 400
+
+    assert db_write_queue.stats().write_count == 2
+
+
+def test_bulk_loads_run_as_one_write(db_write_queue, json_app_engine):
+    assert db_write_queue.submit(crud.delete_nodes).result() == 15
+    db_write_queue.submit(load_test_data).result()
+
+    staff_list = StringIO("header\n" * 8 + "Dave, Gina, Permanent\nErin, Gina, Contractor\n")
+    assert db_write_queue.submit(load_staff_list_from_csv_buffer, staff_list).result() == 2
+    assert db_write_queue.stats().write_count == 3
+
+    with Session(json_app_engine) as db_session:
+        assert crud.get_table_size(db_session, models.Node) == 15 + 5
+        assert crud.get_table_size(db_session, models.Connection) == 17 + 4
+
+
+def test_write_queue_stats_not_started(json_app_client):
+    assert json_app_client.get("/write-queue/").status_code == 404
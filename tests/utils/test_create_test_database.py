@@ -13,7 +13,7 @@ def test_create_test_database():
     db_filename = create_test_database(temp_dir)
 
     assert path.exists(db_filename)
-    assert path.getsize(db_filename) == 12288
+    assert path.getsize(db_filename) == 28672
 
     with sqlite3.connect(db_filename) as connection:
         cursor = connection.cursor()
@@ -0,0 +1,93 @@
+"""
+Compare the json app on the sync engines with it on the async ones (KNOWLEDGE_ASYNC_DB) under concurrent clients.
+
+Each client loops over a mix of reads (a node, a node's connections, a page of nodes) and, every tenth request, a
+write, for a fixed time. The clients are coroutines calling the app in-process through httpx's ASGI transport, so
+the sync sessions' calls queue for Starlette's threadpool just as they would under uvicorn, without any network noise.
+
+Usage: python -m utilities.benchmark_async [--clients 50 200 1000] [--seconds 5]
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import httpx
+
+from utilities.create_test_database import create_test_database
+
+NODE_IDS = [1, 2, 3, 11, 12, 13, 21, 22, 23, 24, 25, 31, 32, 33, 34]
+
+
+async def run_client(client: httpx.AsyncClient, client_number: int, deadline: float, latencies: list[float],
+                     errors: list[str]) -> None:
+    request_number = 0
+    while time.perf_counter() < deadline:
+        node_id = random.choice(NODE_IDS)
+        start = time.perf_counter()
+        if request_number % 10 == 9:
+            response = await client.put(f"/nodes/{node_id}",
+                                        json={"name": f"Node {client_number} {request_number}"})
+        elif request_number % 3 == 0:
+            response = await client.get(f"/nodes/{node_id}")
+        elif request_number % 3 == 1:
+            response = await client.get(f"/connections/?node_id={node_id}")
+        else:
+            response = await client.get("/nodes/?limit=10")
+        if response.status_code >= 500:
+            errors.append(response.text)
+        else:
+            latencies.append(time.perf_counter() - start)
+        request_number += 1
+
+
+async def benchmark(app, clients: int, seconds: float) -> tuple[float, float, float, int]:
+    """
+    Successful requests per second, their median and 99th percentile latency in milliseconds, and the number of
+    requests that failed
+    """
+    latencies = []
+    errors = []
+    # failures (e.g. timing out waiting for a pooled connection) come back as 500s rather than stopping the run
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(run_client(client, client_number, start + seconds, latencies, errors)
+                               for client_number in range(clients)))
+        elapsed = time.perf_counter() - start
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [float("nan")] * 99
+    return len(latencies) / elapsed, percentiles[49] * 1000, percentiles[98] * 1000, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, nargs="+", default=[50, 200, 1000])
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    # the apps pick up the database when first imported
+    os.environ["KNOWLEDGE_DB_FILE"] = create_test_database(tempfile.mkdtemp(dir="/tmp"))
+    from web_apps import async_database, json_rest_app
+
+    async def run_benchmarks():
+        print(f"{'clients':>8} {'engines':>10} {'requests/s':>11} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}",
+              flush=True)
+        for clients in args.clients:
+            for engines, async_db in [("sync", "0"), ("async", "1")]:
+                # the apps' sessions are opened on the engines KNOWLEDGE_ASYNC_DB picks, per request
+                os.environ["KNOWLEDGE_ASYNC_DB"] = async_db
+                requests_per_second, p50, p99, errors = await benchmark(json_rest_app.app, clients, args.seconds)
+                print(f"{clients:>8} {engines:>10} {requests_per_second:>11.0f} {p50:>8.1f} {p99:>8.1f} {errors:>7}",
+                      flush=True)
+        for async_db_engine in [async_database.async_engine, async_database.async_read_engine]:
+            await async_db_engine.dispose()
+
+    # one event loop throughout, as the async engine's pooled connections belong to the loop they were opened on
+    asyncio.run(run_benchmarks())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Compare the database engine profiles (database.PROFILES) on the crud workload.
+
+For each profile a fresh copy of the test database gets, one crud call (and so one commit) at a time: nodes
+created, connections created, nodes renamed, a mix of reads and connections deleted. Then several threads share
+the engine for a mixed read / write run. The dev profile's statement log goes to /dev/null, so its cost counts but
+doesn't fill the screen.
+
+Usage: python -m utilities.benchmark_profiles [--profiles default dev prod] [--operations 500] [--threads 8] [--seconds 5]
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from typing import Callable
+
+from sqlalchemy.orm import Session, sessionmaker
+
+from utilities.create_test_database import create_test_database
+from web_apps import crud, database, schemas
+from web_apps.migrations import upgrade_database
+
+
+def read(db_session: Session, node_id: int) -> None:
+    crud.get_node(db_session, node_id)
+    crud.get_connections_to_node(db_session, node_id)
+    crud.get_nodes_like_name(db_session, "engineer", limit=10)
+
+
+def run_operations(local_session: sessionmaker[Session], operations: int) -> dict[str, float]:
+    """
+    Operations per second of each crud call, each made in its own session
+    """
+    def timed(operation: Callable[[Session, int], object]) -> float:
+        start = time.perf_counter()
+        for number in range(operations):
+            with local_session() as db_session:
+                operation(db_session, number)
+        return operations / (time.perf_counter() - start)
+
+    node_ids = []
+    connection_ids = []
+    return {
+        "create node": timed(lambda db_session, number: node_ids.append(
+            crud.create_node(db_session, schemas.NodeCreate(name=f"Node {number}")).id)),
+        "create connection": timed(lambda db_session, number: connection_ids.append(crud.create_connection(
+            db_session, schemas.ConnectionCreate(name="knows", subject=node_ids[number], target=1)).id)),
+        "rename node": timed(lambda db_session, number: crud.update_node(
+            db_session, node_ids[number], f"Renamed {number}")),
+        "read": timed(lambda db_session, number: read(db_session, random.choice(node_ids))),
+        "delete connection": timed(lambda db_session, number: crud.delete_connection(
+            db_session, connection_ids[number])),
+    }
+
+
+def run_threads(local_session: sessionmaker[Session], threads: int, seconds: float) -> float:
+    """
+    Operations per second of threads each making reads and, one time in ten, a rename
+    """
+    counts = [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    def work(thread_number: int) -> None:
+        while time.perf_counter() < deadline:
+            with local_session() as db_session:
+                if counts[thread_number] % 10 == 9:
+                    crud.update_node(db_session, 1, f"Andrew {thread_number} {counts[thread_number]}")
+                else:
+                    read(db_session, random.choice([1, 2, 3, 11, 12, 13, 21]))
+            counts[thread_number] += 1
+
+    workers = [threading.Thread(target=work, args=(thread_number,)) for thread_number in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--profiles", nargs="+", default=list(database.PROFILES))
+    parser.add_argument("--operations", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    results = {}
+    with open(os.devnull, "w") as devnull:
+        for profile_name in args.profiles:
+            db_filename = create_test_database(tempfile.mkdtemp(dir="/tmp"))
+            engine = database.create_database_engine("sqlite:///" + db_filename, database.get_profile(profile_name))
+            for handler in logging.getLogger("sqlalchemy.engine.Engine").handlers:
+                handler.setStream(devnull)
+
+            local_session = sessionmaker(autoflush=False, expire_on_commit=False, bind=engine)
+            upgrade_database(engine)
+            results[profile_name] = run_operations(local_session, args.operations)
+            results[profile_name][f"{args.threads} threads mixed"] = run_threads(local_session, args.threads,
+                                                                                 args.seconds)
+            engine.dispose()
+
+    print(f"{'operations/s':<20}" + "".join(f"{profile_name:>10}" for profile_name in results))
+    for operation in next(iter(results.values())):
+        print(f"{operation:<20}" + "".join(f"{result[operation]:>10.0f}" for result in results.values()))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,19 @@ import os
 import sqlite3
 from sqlite3 import Cursor
 
+from web_apps.models import normalize_name
+
 
 def create_tables(db_cursor: Cursor):
     db_cursor.execute("""
         CREATE TABLE nodes (
             id INTEGER NOT NULL, 
             name VARCHAR NOT NULL, 
+            name_normalized VARCHAR NOT NULL, 
             PRIMARY KEY (id)
         )
     """)
+    db_cursor.execute("CREATE UNIQUE INDEX ix_nodes_name_normalized ON nodes (name_normalized)")
     db_cursor.execute("""
         CREATE TABLE connections (
             id INTEGER NOT NULL, 
@@ -18,13 +22,21 @@ def create_tables(db_cursor: Cursor):
             subject_id INTEGER NOT NULL, 
             target_id INTEGER NOT NULL, 
             PRIMARY KEY (id), 
-            FOREIGN KEY(subject_id) REFERENCES nodes (id), 
-            FOREIGN KEY(target_id) REFERENCES nodes (id)
+            FOREIGN KEY(subject_id) REFERENCES nodes (id) ON DELETE CASCADE, 
+            FOREIGN KEY(target_id) REFERENCES nodes (id) ON DELETE CASCADE
         )
     """)
+    db_cursor.execute(
+        "CREATE UNIQUE INDEX ix_connections_subject_id_name_target_id ON connections (subject_id, name, target_id)")
+    db_cursor.execute(
+        "CREATE INDEX ix_connections_target_id_name_subject_id ON connections (target_id, name, subject_id)")
+    db_cursor.execute("CREATE INDEX ix_connections_name ON connections (name)")
 
 
-def insert_data(db_cursor: Cursor):
+def test_data() -> tuple[list[tuple[int, str, str]], list[tuple[int, str, int, int]]]:
+    """
+    The test database's (id, name, name_normalized) nodes and (id, name, subject_id, target_id) connections
+    """
     names = [
         (1, "Andrew"),
         (2, "Brian"),
@@ -84,10 +96,16 @@ def insert_data(db_cursor: Cursor):
     nodes = [tuple([next(id_generator), node_name]) for node_name in names + roles + skills + customers]
     """
 
-    db_cursor.executemany("INSERT INTO nodes VALUES ( ?, ? )", names + titles + skills + customers)
+    nodes = [(node_id, name, normalize_name(name)) for node_id, name in names + titles + skills + customers]
+    return nodes, appointments + experiences + assignments
+
+
+def insert_data(db_cursor: Cursor):
+    nodes, connections = test_data()
+    db_cursor.executemany("INSERT INTO nodes VALUES ( ?, ?, ? )", nodes)
     db_cursor.connection.commit()
 
-    db_cursor.executemany("INSERT INTO connections VALUES ( ?, ?, ?, ?)", appointments + experiences + assignments)
+    db_cursor.executemany("INSERT INTO connections VALUES ( ?, ?, ?, ?)", connections)
     db_cursor.connection.commit()
 
 
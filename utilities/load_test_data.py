@@ -1,14 +1,24 @@
-from sqlite3 import Cursor
-
-from sqlalchemy import Connection
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 
-from utilities.create_test_database import insert_data
+from utilities.create_test_database import test_data
+from web_apps import changes
 
 
 def load_test_data(db_session: Session) -> None:
-    db_connection: Connection = db_session.connection()
-
-    cursor: Cursor = db_connection.connection.cursor()
+    """
+    Insert the test database's rows through the session (so on any of the apps' engines, or by the write queue)
+    and commit them
+    """
+    nodes, connections = test_data()
+    db_session.execute(text("INSERT INTO nodes (id, name, name_normalized) VALUES (:id, :name, :name_normalized)"),
+                       [{"id": node_id, "name": name, "name_normalized": name_normalized}
+                        for node_id, name, name_normalized in nodes])
+    db_session.execute(text("INSERT INTO connections (id, name, subject_id, target_id) "
+                            "VALUES (:id, :name, :subject_id, :target_id)"),
+                       [{"id": connection_id, "name": name, "subject_id": subject_id, "target_id": target_id}
+                        for connection_id, name, subject_id, target_id in connections])
 
-    insert_data(cursor)
+    # the rows went in without crud, so anything following the database has to catch up
+    changes.record(db_session, changes.DatabaseReloaded())
+    db_session.commit()
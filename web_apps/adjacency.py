@@ -0,0 +1,282 @@
+"""
+Optional in-memory adjacency of the connections table as NumPy compressed sparse row (CSR) arrays.
+
+Every connection is an edge with its id, subject, target and interned name id, held in parallel arrays. The out
+CSR lists the edges of each subject node contiguously (out_offsets[n]:out_offsets[n + 1] of out_edges) and the in
+CSR does the same for targets, so a node's edges, a whole frontier's edges or every node's degree are array slices
+and reductions rather than SQL.
+
+The arrays are loaded in one bulk SELECT by build_adjacency() (the apps do this at startup when
+KNOWLEDGE_ADJACENCY is set) and then follow the changes crud publishes: a new or changed edge is appended after
+the CSR part and indexed in small per-node lists, and a deleted one is marked dead. Once enough edges have piled up
+outside the CSR the arrays are compacted and the CSR rebuilt, in memory.
+"""
+import os
+from threading import RLock
+from weakref import WeakKeyDictionary
+
+import numpy as np
+from sqlalchemy import Engine, select
+from sqlalchemy.orm import Session
+
+from . import changes, models, schemas
+
+ID_DTYPE = np.int64
+NAME_ID_DTYPE = np.int32
+
+# compact once the edges outside the CSR are more than this fraction of those in it (or MIN_COMPACT_EDGES)
+COMPACT_FRACTION = 0.05
+MIN_COMPACT_EDGES = 1000
+
+# rough cost of an entry in the Python dicts and lists kept for edges outside the CSR, and of an interned name
+BYTES_PER_RECENT_EDGE = 200
+BYTES_PER_NAME = 100
+
+
+def adjacency_enabled() -> bool:
+    return os.environ.get("KNOWLEDGE_ADJACENCY", default="0").lower() in ("1", "true", "yes", "on")
+
+
+def empty(dtype) -> np.ndarray:
+    return np.zeros(0, dtype=dtype)
+
+
+def concatenated_ranges(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)]) without the loop
+    """
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return empty(ID_DTYPE)
+    shifts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return shifts + np.arange(total, dtype=ID_DTYPE)
+
+
+class Adjacency:
+    def __init__(self):
+        self.lock = RLock()
+        self.clear()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.names: list[str] = []
+            self.name_ids: dict[str, int] = {}
+            self._set_edges(empty(ID_DTYPE), empty(ID_DTYPE), empty(ID_DTYPE), empty(NAME_ID_DTYPE))
+
+    def intern(self, name: str) -> int:
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def load(self, engine: Engine) -> None:
+        """
+        Replace everything with the connections in the database
+        """
+        with self.lock, Session(engine) as db_session:
+            self.names = []
+            self.name_ids = {}
+            rows = db_session.execute(select(models.Connection.id, models.Connection.subject_id,
+                                             models.Connection.target_id, models.Connection.name).order_by(
+                models.Connection.id)).all()
+            self._set_edges(np.fromiter((row[0] for row in rows), ID_DTYPE, len(rows)),
+                            np.fromiter((row[1] for row in rows), ID_DTYPE, len(rows)),
+                            np.fromiter((row[2] for row in rows), ID_DTYPE, len(rows)),
+                            np.fromiter((self.intern(row[3]) for row in rows), NAME_ID_DTYPE, len(rows)))
+
+    def _set_edges(self, ids: np.ndarray, subjects: np.ndarray, targets: np.ndarray, name_ids: np.ndarray) -> None:
+        """
+        Take these edges (sorted by id) as the CSR part, with nothing after it
+        """
+        self.ids, self.subjects, self.targets, self.edge_name_ids = ids, subjects, targets, name_ids
+        self.alive = np.ones(len(ids), dtype=bool)
+        self.count = self.csr_count = len(ids)
+        self.recent_positions: dict[int, int] = {}  # connection id -> position, for edges after the CSR part
+        self.recent_out: dict[int, list[int]] = {}  # node id -> positions of edges after the CSR part
+        self.recent_in: dict[int, list[int]] = {}
+
+        node_count = int(max(subjects.max(initial=-1), targets.max(initial=-1))) + 1
+        self.out_offsets, self.out_edges = self._csr(subjects, node_count)
+        self.in_offsets, self.in_edges = self._csr(targets, node_count)
+
+    @staticmethod
+    def _csr(node_ids: np.ndarray, node_count: int) -> tuple[np.ndarray, np.ndarray]:
+        offsets = np.zeros(node_count + 1, dtype=ID_DTYPE)
+        np.cumsum(np.bincount(node_ids, minlength=node_count), out=offsets[1:])
+        return offsets, np.argsort(node_ids, kind="stable").astype(ID_DTYPE)
+
+    def compact(self) -> None:
+        """
+        Drop dead edges and rebuild the CSR arrays so they hold every edge
+        """
+        with self.lock:
+            positions = np.flatnonzero(self.alive[:self.count])
+            positions = positions[np.argsort(self.ids[positions], kind="stable")]
+            self._set_edges(self.ids[positions], self.subjects[positions], self.targets[positions],
+                            self.edge_name_ids[positions])
+
+    def _position(self, connection_id: int) -> int | None:
+        position = self.recent_positions.get(connection_id)
+        if position is None:
+            position = int(np.searchsorted(self.ids[:self.csr_count], connection_id))
+            if position == self.csr_count or self.ids[position] != connection_id:
+                return None
+        return position if self.alive[position] else None
+
+    def _append(self, connection_id: int, name: str, subject_id: int, target_id: int) -> None:
+        if self.count == len(self.ids):
+            capacity = max(2 * len(self.ids), MIN_COMPACT_EDGES)
+            for array_name in ["ids", "subjects", "targets", "edge_name_ids", "alive"]:
+                array = getattr(self, array_name)
+                grown = np.zeros(capacity, dtype=array.dtype)
+                grown[:self.count] = array[:self.count]
+                setattr(self, array_name, grown)
+
+        position = self.count
+        self.ids[position], self.subjects[position], self.targets[position] = connection_id, subject_id, target_id
+        self.edge_name_ids[position] = self.intern(name)
+        self.alive[position] = True
+        self.count += 1
+        self.recent_positions[connection_id] = position
+        self.recent_out.setdefault(subject_id, []).append(position)
+        self.recent_in.setdefault(target_id, []).append(position)
+
+    def _remove(self, connection_id: int) -> None:
+        position = self._position(connection_id)
+        if position is not None:
+            self.alive[position] = False
+            self.recent_positions.pop(connection_id, None)
+
+    def apply(self, engine: Engine, database_changes: list[changes.Change]) -> None:
+        with self.lock:
+            for change in database_changes:
+                match change:
+                    case changes.ConnectionWritten(connection_id, name, subject_id, target_id):
+                        position = self._position(connection_id)
+                        if position is not None and (self.subjects[position], self.targets[position],
+                                                     self.names[self.edge_name_ids[position]]) == (
+                                subject_id, target_id, name):
+                            continue
+                        self._remove(connection_id)
+                        self._append(connection_id, name, subject_id, target_id)
+                    case changes.ConnectionsDeleted(connection_ids):
+                        for connection_id in connection_ids:
+                            self._remove(connection_id)
+                    case changes.TableCleared("connections"):
+                        self.clear()
+                    case changes.DatabaseReloaded():
+                        self.load(engine)
+
+            if self.count - self.csr_count > max(MIN_COMPACT_EDGES, COMPACT_FRACTION * self.csr_count):
+                self.compact()
+
+    def _edge_positions(self, node_ids: np.ndarray, outgoing: bool) -> np.ndarray:
+        offsets, edges = (self.out_offsets, self.out_edges) if outgoing else (self.in_offsets, self.in_edges)
+        in_csr = node_ids[(node_ids >= 0) & (node_ids < len(offsets) - 1)]
+        positions = edges[concatenated_ranges(offsets[in_csr], offsets[in_csr + 1])]
+
+        recent = self.recent_out if outgoing else self.recent_in
+        if recent:
+            recent_positions = [position for node_id in node_ids.tolist() for position in recent.get(node_id, ())]
+            positions = np.concatenate([positions, np.array(recent_positions, dtype=ID_DTYPE)])
+        return positions[self.alive[positions]]
+
+    def name_ids_for(self, names: list[str]) -> np.ndarray:
+        return np.array([self.name_ids[name] for name in names if name in self.name_ids], dtype=NAME_ID_DTYPE)
+
+    def adjacent(self, node_ids: np.ndarray, direction: schemas.Direction,
+                 name_ids: np.ndarray | None = None) -> np.ndarray:
+        """
+        (node_id, connection_id, neighbour_id) rows for each edge from one of the nodes in the direction given,
+        optionally only edges with one of the name ids
+        """
+        node_ids = np.asarray(node_ids, dtype=ID_DTYPE)
+        with self.lock:
+            blocks = []
+            for outgoing in [True, False]:
+                if direction == (schemas.Direction.incoming if outgoing else schemas.Direction.outgoing):
+                    continue
+                positions = self._edge_positions(node_ids, outgoing)
+                if name_ids is not None:
+                    positions = positions[np.isin(self.edge_name_ids[positions], name_ids)]
+                ends = (self.subjects[positions], self.targets[positions])
+                node_column, neighbour_column = ends if outgoing else ends[::-1]
+                blocks.append(np.column_stack([node_column, self.ids[positions], neighbour_column]))
+            return np.concatenate(blocks) if blocks else np.zeros((0, 3), dtype=ID_DTYPE)
+
+    def edges(self, name: str | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The (subjects, targets) of every edge, or every edge with the name
+        """
+        with self.lock:
+            alive = self.alive[:self.count].copy()
+            if name is not None:
+                alive &= self.edge_name_ids[:self.count] == self.name_ids.get(name, -1)
+            return self.subjects[:self.count][alive], self.targets[:self.count][alive]
+
+    def degrees(self, direction: schemas.Direction = schemas.Direction.both) -> np.ndarray:
+        """
+        The degree of every node, indexed by node id (nodes past the end of the array have none)
+        """
+        with self.lock:
+            alive = self.alive[:self.count]
+            subjects, targets = self.subjects[:self.count][alive], self.targets[:self.count][alive]
+            node_count = int(max(subjects.max(initial=-1), targets.max(initial=-1))) + 1
+            degrees = np.zeros(node_count, dtype=ID_DTYPE)
+            if direction != schemas.Direction.incoming:
+                degrees += np.bincount(subjects, minlength=node_count)
+            if direction != schemas.Direction.outgoing:
+                degrees += np.bincount(targets, minlength=node_count)
+            return degrees
+
+    @property
+    def memory_bytes(self) -> int:
+        arrays = [self.ids, self.subjects, self.targets, self.edge_name_ids, self.alive,
+                  self.out_offsets, self.out_edges, self.in_offsets, self.in_edges]
+        return (sum(array.nbytes for array in arrays) + len(self.recent_positions) * BYTES_PER_RECENT_EDGE
+                + sum(len(name) + BYTES_PER_NAME for name in self.names))
+
+    def stats(self) -> schemas.AdjacencyStats:
+        with self.lock:
+            edge_count = int(self.alive[:self.count].sum())
+            return schemas.AdjacencyStats(edge_count=edge_count, csr_edge_count=self.csr_count,
+                                          recent_edge_count=self.count - self.csr_count,
+                                          dead_edge_count=self.count - edge_count, name_count=len(self.names),
+                                          memory_bytes=self.memory_bytes)
+
+
+_adjacencies: WeakKeyDictionary[Engine, Adjacency] = WeakKeyDictionary()
+
+
+def build_adjacency(engine: Engine) -> Adjacency:
+    """
+    Load the adjacency for this engine's database (replacing any already built) and keep it up to date
+    """
+    adjacency = Adjacency()
+    adjacency.load(engine)
+    _adjacencies[engine] = adjacency
+    return adjacency
+
+
+def build_adjacency_if_enabled(engine: Engine) -> None:
+    if adjacency_enabled() and engine not in _adjacencies:
+        build_adjacency(engine)
+
+
+def drop_adjacency(engine: Engine) -> None:
+    _adjacencies.pop(engine, None)
+
+
+def get_adjacency(db_session: Session) -> Adjacency | None:
+    return _adjacencies.get(changes.engine_of(db_session))
+
+
+def _apply_changes(engine: Engine, database_changes: list[changes.Change]) -> None:
+    adjacency = _adjacencies.get(engine)
+    if adjacency is not None:
+        adjacency.apply(engine, database_changes)
+
+
+changes.add_listener(_apply_changes)
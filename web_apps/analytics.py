@@ -0,0 +1,140 @@
+"""
+Node rankings (degree, in/out degree and PageRank) computed with NumPy over the whole edge list.
+
+The edges come from the adjacency arrays if they've been built (see adjacency.py), otherwise from one bulk SELECT.
+Only nodes in at least one of the edges are ranked. Each ranking is cached per engine, metric and connection name
+until the next write to that database, whether this process publishes it (see changes.py) or not (the rankings
+watch the database file's data_version, see graph_version.DataVersionWatcher).
+"""
+from threading import RLock
+from weakref import WeakKeyDictionary
+
+import numpy as np
+from sqlalchemy import Engine, select
+from sqlalchemy.orm import Session
+
+from . import changes, crud, models, schemas
+from .adjacency import get_adjacency
+from .graph_version import DataVersionWatcher
+
+PAGERANK_DAMPING = 0.85
+PAGERANK_TOLERANCE = 1e-9
+PAGERANK_MAX_ITERATIONS = 100
+
+
+def get_edges(db_session: Session, name: str | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The (subjects, targets) of every connection, or every connection with the name
+    """
+    db_adjacency = get_adjacency(db_session)
+    if db_adjacency is not None:
+        return db_adjacency.edges(name)
+
+    select_stmt = select(models.Connection.subject_id, models.Connection.target_id)
+    if name is not None:
+        select_stmt = select_stmt.filter(models.Connection.name == name)
+    rows = db_session.execute(select_stmt).all()
+    return (np.fromiter((row[0] for row in rows), np.int64, len(rows)),
+            np.fromiter((row[1] for row in rows), np.int64, len(rows)))
+
+
+def pagerank(subjects: np.ndarray, targets: np.ndarray, node_count: int) -> np.ndarray:
+    """
+    PageRank of nodes 0..node_count-1 by power iteration, with connections pointing from subject to target.
+    Nodes with no outgoing connections share their rank among all the nodes.
+    """
+    out_degrees = np.bincount(subjects, minlength=node_count).astype(float)
+    dangling = out_degrees == 0
+    ranks = np.full(node_count, 1 / node_count)
+    for _ in range(PAGERANK_MAX_ITERATIONS):
+        passed_on = np.bincount(targets, weights=ranks[subjects] / out_degrees[subjects], minlength=node_count)
+        new_ranks = (1 - PAGERANK_DAMPING) / node_count + PAGERANK_DAMPING * (
+                passed_on + ranks[dangling].sum() / node_count)
+        converged = np.abs(new_ranks - ranks).sum() < PAGERANK_TOLERANCE
+        ranks = new_ranks
+        if converged:
+            break
+    return ranks
+
+
+def rank_nodes(subjects: np.ndarray, targets: np.ndarray, metric: schemas.Metric) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The (node ids, scores) of every node in the edges, highest score first (then lowest id)
+    """
+    node_ids, node_indexes = np.unique(np.concatenate([subjects, targets]), return_inverse=True)
+    subject_indexes, target_indexes = node_indexes[:len(subjects)], node_indexes[len(subjects):]
+    node_count = len(node_ids)
+
+    match metric:
+        case schemas.Metric.degree:
+            scores = np.bincount(subject_indexes, minlength=node_count) + np.bincount(target_indexes,
+                                                                                      minlength=node_count)
+        case schemas.Metric.in_degree:
+            scores = np.bincount(target_indexes, minlength=node_count)
+        case schemas.Metric.out_degree:
+            scores = np.bincount(subject_indexes, minlength=node_count)
+        case schemas.Metric.pagerank:
+            scores = pagerank(subject_indexes, target_indexes, node_count) if node_count else np.zeros(0)
+
+    order = np.lexsort((node_ids, -scores))
+    return node_ids[order], scores[order].astype(float)
+
+
+class Rankings:
+    def __init__(self, database_file: str | None = None):
+        self.lock = RLock()
+        self.generation = 0  # bumped by every write, so a ranking worked out during one isn't kept
+        self.rankings: dict[tuple[schemas.Metric, str | None], tuple[np.ndarray, np.ndarray]] = {}
+        # an in-memory database has no other writers to watch for
+        self.watcher = DataVersionWatcher(database_file) if database_file not in (None, "", ":memory:") else None
+
+    def get(self, db_session: Session, metric: schemas.Metric,
+            name: str | None) -> tuple[np.ndarray, np.ndarray]:
+        with self.lock:
+            if self.watcher is not None and self.watcher.changed():
+                self.clear()
+            ranking = self.rankings.get((metric, name))
+            generation = self.generation
+        if ranking is None:
+            ranking = rank_nodes(*get_edges(db_session, name), metric)
+            with self.lock:
+                if generation == self.generation:
+                    self.rankings[(metric, name)] = ranking
+        return ranking
+
+    def clear(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.rankings.clear()
+
+
+_rankings: WeakKeyDictionary[Engine, Rankings] = WeakKeyDictionary()
+_registry_lock = RLock()
+
+
+def get_top_nodes(db_session: Session, metric: schemas.Metric = schemas.Metric.degree, name: str | None = None,
+                  limit: int = 10) -> list[schemas.NodeScore]:
+    """
+    The limit nodes with the highest score for the metric, counting only connections with the name if given
+    """
+    engine = changes.engine_of(db_session)
+    with _registry_lock:
+        rankings = _rankings.get(engine)
+        if rankings is None:
+            rankings = _rankings[engine] = Rankings(engine.url.database)
+    node_ids, scores = rankings.get(db_session, metric, name)
+    top_ids = node_ids[:limit].tolist()
+
+    nodes = {node.id: node for node in crud.get_by_ids(db_session, select(models.Node), models.Node.id,
+                                                       sorted(top_ids))}
+    return [schemas.NodeScore(id=node_id, name=nodes[node_id].name, score=score)
+            for node_id, score in zip(top_ids, scores[:limit].tolist()) if node_id in nodes]
+
+
+def _apply_changes(engine: Engine, database_changes: list[changes.Change]) -> None:
+    rankings = _rankings.get(engine)
+    if rankings is not None:
+        rankings.clear()
+
+
+changes.add_listener(_apply_changes)
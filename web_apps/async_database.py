@@ -0,0 +1,43 @@
+"""
+The async engines and session factories, used by the apps' endpoints (see sessions.py) when KNOWLEDGE_ASYNC_DB is set.
+
+The async engines talk to the same database file as database.py's engines, through aiosqlite, so a request waiting on
+SQLite awaits rather than holding one of Starlette's threadpool threads. They share the sync engine's in-memory
+indexes and caches (see changes.add_engine_alias), which follow the writes made through any of them.
+"""
+import os
+
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+from . import changes
+from .database import EngineProfile, db_file, engine, get_profile, profile, set_pragmas_on_connect
+
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///" + db_file
+ASYNC_READ_ONLY_DATABASE_URL = f"sqlite+aiosqlite:///file:{db_file}?mode=ro&uri=true"
+
+
+def async_database_enabled() -> bool:
+    return os.environ.get("KNOWLEDGE_ASYNC_DB", default="0").lower() in ("1", "true", "yes", "on")
+
+
+def create_async_database_engine(database_url: str = ASYNC_SQLALCHEMY_DATABASE_URL,
+                                 profile: EngineProfile | None = None, read_only: bool = False) -> AsyncEngine:
+    """
+    An async engine set up by the profile, like database.create_database_engine
+    """
+    profile = profile or get_profile()
+    db_engine = create_async_engine(database_url, echo=profile.echo, pool_size=profile.pool_size,
+                                    max_overflow=profile.max_overflow, pool_timeout=profile.pool_timeout)
+    set_pragmas_on_connect(db_engine.sync_engine, profile, read_only)
+    return db_engine
+
+
+async_engine: AsyncEngine = create_async_database_engine(profile=profile)
+async_read_engine: AsyncEngine = create_async_database_engine(ASYNC_READ_ONLY_DATABASE_URL, profile, read_only=True)
+for async_db_engine in [async_engine, async_read_engine]:
+    changes.add_engine_alias(async_db_engine.sync_engine, engine)
+
+AsyncLocalSession: async_sessionmaker[AsyncSession] = async_sessionmaker(autoflush=False, expire_on_commit=False,
+                                                                         bind=async_engine)
+AsyncReadLocalSession: async_sessionmaker[AsyncSession] = async_sessionmaker(autoflush=False, expire_on_commit=False,
+                                                                             bind=async_read_engine)
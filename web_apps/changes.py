@@ -0,0 +1,144 @@
+"""
+Lets in-process indexes and caches follow the database.
+
+The crud write functions record each change they make on the session, and once the session commits the changes are
+passed to every registered listener along with the session's engine (see engine_of). Changes in a transaction that
+is rolled back are dropped, so listeners only ever see what is in the database.
+"""
+from dataclasses import dataclass
+from typing import Callable
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import Connection, Engine, event
+from sqlalchemy.orm import Session
+
+
+@dataclass(frozen=True)
+class NodeWritten:
+    """
+    A node was created or renamed
+    """
+    node_id: int
+    name: str
+
+
+@dataclass(frozen=True)
+class NodesDeleted:
+    node_ids: tuple[int, ...]
+
+
+@dataclass(frozen=True)
+class ConnectionWritten:
+    """
+    A connection was created or changed
+    """
+    connection_id: int
+    name: str
+    subject_id: int
+    target_id: int
+
+
+@dataclass(frozen=True)
+class ConnectionsDeleted:
+    connection_ids: tuple[int, ...]
+
+
+@dataclass(frozen=True)
+class TableCleared:
+    """
+    Every row of the table was deleted
+    """
+    table_name: str
+
+
+@dataclass(frozen=True)
+class DatabaseReloaded:
+    """
+    The database was changed some other way (e.g. loaded directly), so anything derived from it should be rebuilt
+    """
+    pass
+
+
+Change = NodeWritten | NodesDeleted | ConnectionWritten | ConnectionsDeleted | TableCleared | DatabaseReloaded
+Listener = Callable[[Engine, list[Change]], None]
+
+_listeners: list[Listener] = []
+
+_PENDING_CHANGES = "pending_changes"
+_DEFERRED_CHANGES = "deferred_changes"
+
+# another engine on a database (e.g. read-only or async) -> the engine whose indexes and caches it shares
+_aliased_engines: WeakKeyDictionary[Engine, Engine] = WeakKeyDictionary()
+
+
+def add_listener(listener: Listener) -> None:
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+
+def remove_listener(listener: Listener) -> None:
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def add_engine_alias(alias_engine: Engine, engine: Engine) -> None:
+    """
+    Have sessions on alias_engine, another engine on the same database (e.g. a read-only or async one), share the
+    engine's indexes and caches, and publish the changes they commit as the engine's
+    """
+    _aliased_engines[alias_engine] = engine
+
+
+def engine_of(db_session: Session) -> Engine:
+    """
+    The engine the session's indexes and caches are kept for: its own, unless it's an alias of another
+    """
+    engine = db_session.get_bind()
+    if isinstance(engine, Connection):
+        engine = engine.engine
+    return _aliased_engines.get(engine, engine)
+
+
+def record(db_session: Session, *changes: Change) -> None:
+    """
+    Record changes made in the session's current transaction, to be published when it commits
+    """
+    db_session.info.setdefault(_PENDING_CHANGES, []).extend(changes)
+
+
+def pending_changes(db_session: Session) -> list[Change]:
+    """
+    The changes made in the session's transaction that aren't committed yet, including those of earlier sessions
+    in the same transaction when its publishing is deferred
+    """
+    return db_session.info.get(_DEFERRED_CHANGES, []) + db_session.info.get(_PENDING_CHANGES, [])
+
+
+def defer_publishing(db_session: Session, deferred_changes: list[Change]) -> None:
+    """
+    Have the session add its committed changes to deferred_changes rather than publish them, for a session whose
+    commits are part of a larger transaction (the caller publishes them once that commits)
+    """
+    db_session.info[_DEFERRED_CHANGES] = deferred_changes
+
+
+def publish(engine: Engine, changes: list[Change]) -> None:
+    for listener in list(_listeners):
+        listener(engine, changes)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_pending_changes(db_session: Session) -> None:
+    changes = db_session.info.pop(_PENDING_CHANGES, None)
+    if not changes:
+        return
+    deferred_changes = db_session.info.get(_DEFERRED_CHANGES)
+    if deferred_changes is not None:
+        deferred_changes.extend(changes)
+    else:
+        publish(engine_of(db_session), changes)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _drop_pending_changes(db_session: Session, previous_transaction) -> None:
+    db_session.info.pop(_PENDING_CHANGES, None)
@@ -1,69 +1,216 @@
-from sqlalchemy import select, update, delete, Result, func, table, or_
-from sqlalchemy.orm import Session
+import json
+from bisect import bisect_right
+from typing import Iterable, Iterator
 
-from . import models, schemas
+from sqlalchemy import select, update, delete, Result, Row, Select, column, func, literal, table, union_all, or_, \
+    tuple_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import changes, identity_cache, models, name_index, schemas, search, suggest
 
 
 def create_node(db_session: Session, node: schemas.NodeCreate) -> models.Node:
-    existing_node = get_node_by_name(db_session, node.name)
-    if existing_node:
-        return existing_node
-    else:
-        # print(f"{node.name}")
-        new_node = models.Node(name=node.name)
-        db_session.add(new_node)
-        db_session.commit()
-        db_session.refresh(new_node)
-        return new_node
+    db_node = get_or_insert_node(db_session, node)
+    db_session.commit()
+    return db_node
+
+
+def create_new_node(db_session: Session, node: schemas.NodeCreate) -> models.Node | None:
+    """
+    Create the node, or return None if one with the same normalized name already exists
+    """
+    db_node = insert_node(db_session, node)
+    db_session.commit()
+    return db_node
+
+
+def get_or_insert_node(db_session: Session, node: schemas.NodeCreate) -> models.Node:
+    """
+    Insert the node unless one with the same normalized name exists, and return whichever is in the database.
+    Doesn't commit.
+    """
+    cache = identity_cache.for_session(db_session)
+    db_node = cache.node_by_name(node.name) if cache else None
+    if db_node is None:
+        db_node = insert_node(db_session, node)
+    if db_node is None:
+        # it exists, but wasn't in the cache
+        db_node = db_session.scalars(select(models.Node).filter_by(name_insensitive=node.name)).first()
+        if cache:
+            cache.remember(nodes=[db_node])
+    return db_node
+
+
+def insert_node(db_session: Session, node: schemas.NodeCreate) -> models.Node | None:
+    """
+    Insert the node and return it, or None if one with the same normalized name already exists. Doesn't commit.
+    """
+    # insert-if-absent in one statement, so concurrent creates of the same name can't race
+    insert_stmt = insert(models.Node).values(
+        name=node.name, name_normalized=models.normalize_name(node.name)
+    ).on_conflict_do_nothing(index_elements=[models.Node.name_normalized]).returning(models.Node)
+    new_node = db_session.scalars(insert_stmt).first()
+    if new_node is not None:
+        changes.record(db_session, changes.NodeWritten(new_node.id, new_node.name))
+    return new_node
 
 
 def get_node(db_session: Session, node_id: int) -> models.Node | None:
-    select_stmt = select(models.Node).filter(models.Node.id == node_id)
-    return db_session.scalars(select_stmt).first()
+    cache = identity_cache.for_session(db_session)
+    db_node = cache.node(node_id) if cache else None
+    if db_node is None:
+        select_stmt = select(models.Node).filter(models.Node.id == node_id)
+        db_node = db_session.scalars(select_stmt).first()
+        if cache and db_node is not None:
+            cache.remember(nodes=[db_node])
+    return db_node
 
 
 def get_node_by_name(db_session: Session, name: str) -> models.Node | None:
-    # select_stmt = select(models.Node).filter(models.Node.name.contains(name))
-    select_stmt = select(models.Node).filter_by(name_insensitive=name)
-    return db_session.scalars(select_stmt).first()
+    cache = identity_cache.for_session(db_session)
+    db_node = cache.node_by_name(name) if cache else None
+    if db_node is None:
+        # select_stmt = select(models.Node).filter(models.Node.name.contains(name))
+        select_stmt = select(models.Node).filter_by(name_insensitive=name)
+        db_node = db_session.scalars(select_stmt).first()
+        if cache and db_node is not None:
+            cache.remember(nodes=[db_node])
+    return db_node
+
+
+def paginate(select_stmt: Select, id_column, skip: int, limit: int | None, after_id: int | None) -> Select:
+    """
+    Order by id and return the page starting after the row with id after_id (if given), then skipping skip rows
+    """
+    if after_id is not None:
+        select_stmt = select_stmt.filter(id_column > after_id)
+    return select_stmt.order_by(id_column).offset(skip).limit(limit)
 
 
-def get_nodes(db_session: Session, skip: int = 0, limit: int = 100) -> list[models.Node]:
-    select_stmt = select(models.Node)
+def get_nodes(db_session: Session, skip: int = 0, limit: int | None = 100,
+              after_id: int | None = None) -> list[models.Node]:
+    select_stmt = paginate(select(models.Node), models.Node.id, skip, limit, after_id)
     return list(db_session.scalars(select_stmt).all())
 
 
-def get_nodes_like_name(db_session: Session, like: str, skip: int = 0, limit: int = 100) -> list[models.Node]:
-    select_stmt = select(models.Node).filter(models.Node.name.ilike(f"%{like}%"))
+def page_of_ids(ids: list[int], skip: int, limit: int | None, after_id: int | None) -> list[int]:
+    """
+    The same page of the sorted ids as paginate() would select
+    """
+    start = bisect_right(ids, after_id) if after_id is not None else 0
+    start += skip
+    return ids[start:] if limit is None else ids[start:start + limit]
+
+
+def get_by_ids(db_session: Session, select_stmt: Select, id_column, ids: list[int]) -> list:
+    """
+    Fetch the rows with these (sorted) ids by primary key, in id order
+    """
+    rows = []
+    for chunk in chunked(ids):
+        rows.extend(db_session.scalars(select_stmt.filter(id_column.in_(chunk)).order_by(id_column)))
+    return rows
+
+
+def get_nodes_like_name(db_session: Session, like: str, skip: int = 0, limit: int | None = 100,
+                        after_id: int | None = None) -> list[models.Node]:
+    name_indexes = name_index.get_name_indexes(db_session)
+    node_ids = name_indexes.nodes.search(like) if name_indexes else None
+    if node_ids is not None:
+        return get_by_ids(db_session, select(models.Node), models.Node.id,
+                          page_of_ids(node_ids, skip, limit, after_id))
+
+    select_stmt = select(models.Node).filter(models.Node.id.in_(node_ids_like_name(like)))
+    select_stmt = paginate(select_stmt, models.Node.id, skip, limit, after_id)
+    return list(db_session.scalars(select_stmt).all())
+
+
+def node_ids_like_name(like: str) -> Select:
+    return select(search.nodes_fts.c.rowid).filter(search.name_contains(search.nodes_fts, like))
+
+
+def search_nodes(db_session: Session, query: str, limit: int | None = 100) -> list[models.Node]:
+    """
+    Nodes with names matching the search query (see search.search_condition), best matches first
+    """
+    condition, ranked = search.search_condition(search.nodes_fts, query)
+    select_stmt = select(models.Node).join(search.nodes_fts, search.nodes_fts.c.rowid == models.Node.id).filter(
+        condition)
+    if ranked:
+        select_stmt = select_stmt.order_by(search.nodes_fts.c.rank)
+    select_stmt = select_stmt.order_by(models.Node.id).limit(limit)
     return list(db_session.scalars(select_stmt).all())
 
 
+class DuplicateNodeNameError(Exception):
+    pass
+
+
 def update_node(db_session: Session, node_id: int, updated_name: str) -> models.Node | None:
-    db_node = get_node(db_session, node_id)
-    if db_node is None:
-        return None
-    update_stmt = update(models.Node).where(models.Node.id == node_id).values(name=updated_name)
-    db_session.execute(update_stmt)
-    db_session.commit()
-    return get_node(db_session, node_id)
+    update_stmt = update(models.Node).where(models.Node.id == node_id).values(
+        name=updated_name, name_normalized=models.normalize_name(updated_name)).returning(models.Node)
+    try:
+        db_node = db_session.scalars(update_stmt).first()
+        if db_node is not None:
+            changes.record(db_session, changes.NodeWritten(db_node.id, db_node.name))
+        db_session.commit()
+    except IntegrityError:
+        db_session.rollback()
+        raise DuplicateNodeNameError(f"name: {updated_name}")
+    return db_node
 
 
 def delete_node(db_session: Session, node_id: int) -> int:
-    # delete the node
-    delete_stmt = delete(models.Node).where(models.Node.id == node_id)
-    result: Result = db_session.execute(delete_stmt)
-
-    if result.rowcount:
-        # delete any connections to the node
-        delete_stmt = delete(models.Connection).where(
-            models.Connection.subject_id == node_id)
-        db_session.execute(delete_stmt)
-        delete_stmt = delete(models.Connection).where(
-            models.Connection.target_id == node_id)
-        db_session.execute(delete_stmt)
+    deleted_node_ids, _ = delete_nodes_by_ids(db_session, [node_id])
+    return len(deleted_node_ids)
+
+
+def connection_ids_to_nodes(node_ids: Select) -> Select:
+    # a UNION of one lookup per end of the connection lets each branch use its own index, where an OR would scan
+    return union_all(
+        select(models.Connection.id).filter(models.Connection.subject_id.in_(node_ids)),
+        select(models.Connection.id).filter(models.Connection.target_id.in_(node_ids),
+                                            models.Connection.subject_id.not_in(node_ids)))
+
+
+def get_node_impact(db_session: Session, node_id: int) -> int:
+    """
+    How many connections deleting the node would delete with it, counted from the indexes
+    """
+    return db_session.scalar(select(func.count()).select_from(
+        connection_ids_to_nodes(select(literal(node_id))).subquery()))
+
+
+def delete_nodes_by_ids(db_session: Session, node_ids: list[int]) -> tuple[list[int], int]:
+    """
+    Delete the nodes and (by the foreign keys' ON DELETE CASCADE) their connections, in one transaction.
+    Returns the ids of the nodes deleted and how many connections went with them.
+    """
+    deleted_node_ids = []
+    connection_count = 0
+    for chunk in chunked(sorted(set(node_ids))):
+        # the cascade doesn't say which connections it deletes, so find them first for the change listeners
+        connection_ids = db_session.scalars(connection_ids_to_nodes(select_ids(chunk))).all()
+        chunk_node_ids = db_session.scalars(
+            delete(models.Node).filter(models.Node.id.in_(chunk)).returning(models.Node.id)).all()
+        deleted_node_ids += chunk_node_ids
+        connection_count += len(connection_ids)
+        changes.record(db_session, changes.NodesDeleted(tuple(chunk_node_ids)),
+                       changes.ConnectionsDeleted(tuple(connection_ids)))
 
     db_session.commit()
-    return result.rowcount
+    return sorted(deleted_node_ids), connection_count
+
+
+# every query returning connections loads their subject and target nodes up front, as the relationships are
+# lazy="raise"
+CONNECTION_NODES = (joinedload(models.Connection.subject), joinedload(models.Connection.target))
+
+# a connection is unique by its subject, name and target
+CONNECTION_UNIQUE_COLUMNS = [models.Connection.subject_id, models.Connection.name, models.Connection.target_id]
 
 
 class ConnectionNodeNotFoundError(Exception):
@@ -76,19 +223,32 @@ def get_or_create_connection_node(db_session: Session, node: schemas.NodeCreate
         if db_node is None:
             raise ConnectionNodeNotFoundError(f"node_id: {node}")
     else:
-        # db_node = get_node_by_name(db_session, node.name)
-        # if not db_node:
-        db_node = create_node(db_session, node)
+        db_node = get_or_insert_node(db_session, node)
 
     return db_node
 
 
+def connection_written(db_connection: models.Connection) -> changes.ConnectionWritten:
+    return changes.ConnectionWritten(db_connection.id, db_connection.name, db_connection.subject_id,
+                                     db_connection.target_id)
+
+
+def with_nodes(db_connection: models.Connection, subject_node: models.Node,
+               target_node: models.Node) -> models.Connection:
+    """
+    Attach already loaded subject and target nodes to a connection, without going back to the database
+    """
+    set_committed_value(db_connection, "subject", subject_node)
+    set_committed_value(db_connection, "target", target_node)
+    return db_connection
+
+
 def get_connection_by_name_target_id_and_subject_id(db_session: Session, name: str, subject_id: int,
                                                     target_id: int) -> models.Connection | None:
-    select_stmt = select(models.Connection).filter(models.Connection.name.contains(name),
-                                                   # TODO changes this to use comparator
-                                                   models.Connection.subject_id == subject_id,
-                                                   models.Connection.target_id == target_id)
+    select_stmt = select(models.Connection).options(*CONNECTION_NODES).filter(
+        models.Connection.subject_id == subject_id,
+        models.Connection.name == name,
+        models.Connection.target_id == target_id)
 
     return db_session.scalars(select_stmt).first()
 
@@ -97,78 +257,368 @@ def create_connection(db_session: Session, connection: schemas.ConnectionCreate)
     subject_node: models.Node = get_or_create_connection_node(db_session, connection.subject)
     target_node: models.Node = get_or_create_connection_node(db_session, connection.target)
 
-    existing_connection = get_connection_by_name_target_id_and_subject_id(
-        db_session, name=connection.name, subject_id=subject_node.id, target_id=target_node.id)
-    if not existing_connection:
-        db_connection = models.Connection(name=connection.name, subject=subject_node, target=target_node)
-        db_session.add(db_connection)
-        db_session.commit()
-        db_session.refresh(db_connection)
-        return db_connection
+    insert_stmt = insert(models.Connection).values(
+        name=connection.name, subject_id=subject_node.id, target_id=target_node.id
+    ).on_conflict_do_nothing(index_elements=CONNECTION_UNIQUE_COLUMNS).returning(models.Connection)
+    try:
+        db_connection = db_session.scalars(insert_stmt).first()
+    except IntegrityError as error:
+        db_session.rollback()
+        if identity_cache.forget_deleted_nodes(db_session, error, [subject_node.id, target_node.id]):
+            return create_connection(db_session, connection)
+        raise
+
+    if db_connection is None:
+        db_connection = get_connection_by_name_target_id_and_subject_id(
+            db_session, name=connection.name, subject_id=subject_node.id, target_id=target_node.id)
     else:
-        return existing_connection
+        changes.record(db_session, connection_written(db_connection))
+    db_session.commit()
+    return with_nodes(db_connection, subject_node, target_node)
+
+
+# keep the number of bound parameters in one statement well below SQLite's limit
+BULK_CHUNK_SIZE = 500
+
+
+def chunked(items: list, size: int = BULK_CHUNK_SIZE) -> Iterator[list]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def get_or_create_node_ids_by_name(db_session: Session, names: Iterable[str]) -> dict[str, int]:
+    """
+    Look up the ids of nodes by (normalized) name, inserting any that don't exist yet. Doesn't commit.
+    :return: a dict of normalized name to node id
+    """
+    names_by_normalized_name = {}
+    for name in names:
+        names_by_normalized_name.setdefault(models.normalize_name(name), name)
+
+    cache = identity_cache.for_session(db_session)
+    node_ids: dict[str, int] = cache.node_ids_by_normalized_name(names_by_normalized_name) if cache else {}
+    node_ids.update(get_node_ids_by_normalized_name(db_session, [
+        name_normalized for name_normalized in names_by_normalized_name if name_normalized not in node_ids]))
+
+    new_nodes = [{"name": name, "name_normalized": name_normalized}
+                 for name_normalized, name in names_by_normalized_name.items() if name_normalized not in node_ids]
+    if new_nodes:
+        insert_stmt = insert(models.Node).on_conflict_do_nothing(
+            index_elements=[models.Node.name_normalized]).returning(models.Node.name_normalized, models.Node.id)
+        inserted_node_ids = dict(db_session.execute(insert_stmt, new_nodes).all())
+        node_ids.update(inserted_node_ids)
+        changes.record(db_session, *(changes.NodeWritten(node_id, names_by_normalized_name[name_normalized])
+                                     for name_normalized, node_id in inserted_node_ids.items()))
+
+        # any not returned were created by someone else since we looked
+        raced_names = [new_node["name_normalized"] for new_node in new_nodes
+                       if new_node["name_normalized"] not in node_ids]
+        node_ids.update(get_node_ids_by_normalized_name(db_session, raced_names))
+
+    return node_ids
+
+
+def get_node_ids_by_normalized_name(db_session: Session, names_normalized: list[str]) -> dict[str, int]:
+    cache = identity_cache.for_session(db_session)
+    node_ids = {}
+    for chunk in chunked(names_normalized):
+        select_stmt = select(models.Node.name_normalized, models.Node.id, models.Node.name).filter(
+            models.Node.name_normalized.in_(chunk))
+        rows = db_session.execute(select_stmt).all()
+        node_ids.update((row.name_normalized, row.id) for row in rows)
+        if cache:
+            cache.remember(nodes=rows)
+    return node_ids
+
+
+def check_node_ids_exist(db_session: Session, node_ids: Iterable[int]) -> None:
+    cache = identity_cache.for_session(db_session)
+    node_ids = set(node_ids)
+    found_node_ids = {node_id for node_id in node_ids if cache.has_node(node_id)} if cache else set()
+    for chunk in chunked(list(node_ids - found_node_ids)):
+        rows = db_session.execute(select(models.Node.id, models.Node.name).filter(models.Node.id.in_(chunk))).all()
+        found_node_ids.update(row.id for row in rows)
+        if cache:
+            cache.remember(nodes=rows)
+
+    missing_node_ids = node_ids - found_node_ids
+    if missing_node_ids:
+        raise ConnectionNodeNotFoundError(f"node_ids: {sorted(missing_node_ids)}")
+
+
+def create_connections_bulk(db_session: Session,
+                            connections: list[schemas.ConnectionCreate]) -> schemas.ConnectionBatchResult:
+    """
+    Create many connections in one transaction, creating any nodes they name.
+    Connections that already exist, or are repeated in the batch, are only counted once, as existing or created.
+    """
+    nodes = [node for connection in connections for node in (connection.subject, connection.target)]
+    check_node_ids_exist(db_session, [node for node in nodes if isinstance(node, int)])
+    node_ids_by_name = get_or_create_node_ids_by_name(db_session,
+                                                      [node.name for node in nodes if not isinstance(node, int)])
+
+    def node_id(node: schemas.NodeCreate | int) -> int:
+        return node if isinstance(node, int) else node_ids_by_name[models.normalize_name(node.name)]
+
+    # (subject_id, name, target_id) of each connection, without repeats
+    edges = list(dict.fromkeys(
+        (node_id(connection.subject), connection.name, node_id(connection.target)) for connection in connections))
+
+    existing_edges = set()
+    for chunk in chunked(edges, BULK_CHUNK_SIZE // 3):
+        select_stmt = select(*CONNECTION_UNIQUE_COLUMNS).filter(tuple_(*CONNECTION_UNIQUE_COLUMNS).in_(chunk))
+        existing_edges.update(tuple(edge) for edge in db_session.execute(select_stmt))
+
+    new_connections = [{"subject_id": subject_id, "name": name, "target_id": target_id}
+                       for subject_id, name, target_id in edges if (subject_id, name, target_id) not in existing_edges]
+    inserted_connections = []
+    if new_connections:
+        insert_stmt = insert(models.Connection).on_conflict_do_nothing(
+            index_elements=CONNECTION_UNIQUE_COLUMNS).returning(models.Connection.id, *CONNECTION_UNIQUE_COLUMNS)
+        try:
+            inserted_connections = db_session.execute(insert_stmt, new_connections).all()
+        except IntegrityError as error:
+            db_session.rollback()
+            used_node_ids = {node_id for subject_id, _, target_id in edges for node_id in (subject_id, target_id)}
+            if identity_cache.forget_deleted_nodes(db_session, error, used_node_ids):
+                return create_connections_bulk(db_session, connections)
+            raise
+        changes.record(db_session, *(changes.ConnectionWritten(connection_id, name, subject_id, target_id)
+                                     for connection_id, subject_id, name, target_id in inserted_connections))
+    db_session.commit()
+
+    # another writer may have added some of the new connections since they were looked for, and the insert skipped them
+    skipped_count = len(new_connections) - len(inserted_connections)
+    return schemas.ConnectionBatchResult(created=len(inserted_connections),
+                                         existing=len(existing_edges) + skipped_count)
+
+
+def get_connections(db_session: Session, skip: int = 0, limit: int | None = 100,
+                    after_id: int | None = None) -> list[models.Connection]:
+    select_stmt = paginate(select(models.Connection).options(*CONNECTION_NODES), models.Connection.id, skip, limit,
+                           after_id)
+    return list(db_session.scalars(select_stmt).all())
+
 
+def get_connections_like_name(db_session: Session, like: str, skip: int = 0, limit: int | None = 100,
+                              after_id: int | None = None) -> list[models.Connection]:
+    name_indexes = name_index.get_name_indexes(db_session)
+    connection_ids = name_indexes.connections.search(like) if name_indexes else None
+    if connection_ids is not None:
+        return get_by_ids(db_session, select(models.Connection).options(*CONNECTION_NODES), models.Connection.id,
+                          page_of_ids(connection_ids, skip, limit, after_id))
 
-def get_connections(db_session: Session, skip: int = 0, limit: int = 100) -> list[models.Connection]:
-    select_stmt = select(models.Connection)
+    select_stmt = select(models.Connection).options(*CONNECTION_NODES).filter(
+        models.Connection.id.in_(connection_ids_like_name(like)))
+    select_stmt = paginate(select_stmt, models.Connection.id, skip, limit, after_id)
     return list(db_session.scalars(select_stmt).all())
 
 
-def get_connections_like_name(db_session: Session, like: str, skip: int = 0, limit: int = 100) -> list[
-    models.Connection]:
-    select_stmt = select(models.Connection).filter(models.Connection.name.ilike(f"%{like}%"))
+def connection_ids_like_name(like: str) -> Select:
+    return select(search.connections_fts.c.rowid).filter(search.name_contains(search.connections_fts, like))
+
+
+def search_connections(db_session: Session, query: str, limit: int | None = 100) -> list[models.Connection]:
+    """
+    Connections with names matching the search query (see search.search_condition), best matches first
+    """
+    condition, ranked = search.search_condition(search.connections_fts, query)
+    select_stmt = select(models.Connection).options(*CONNECTION_NODES).join(
+        search.connections_fts, search.connections_fts.c.rowid == models.Connection.id).filter(condition)
+    if ranked:
+        select_stmt = select_stmt.order_by(search.connections_fts.c.rank)
+    select_stmt = select_stmt.order_by(models.Connection.id).limit(limit)
     return list(db_session.scalars(select_stmt).all())
 
 
 def delete_connection(db_session: Session, connection_id: int) -> int:
     delete_stmt = delete(models.Connection).where(models.Connection.id == connection_id)
     result: Result = db_session.execute(delete_stmt)
+    if result.rowcount:
+        changes.record(db_session, changes.ConnectionsDeleted((connection_id,)))
     db_session.commit()
     return result.rowcount
 
 
-def get_connections_to_node(db_session: Session, node_id: int) -> list[models.Connection]:
-    select_stmt = select(models.Connection).filter(
-        or_(models.Connection.subject_id == node_id, models.Connection.target_id == node_id))
-    connections = list(db_session.scalars(select_stmt).all())
-    return connections
+def delete_connections_by_ids(db_session: Session, connection_ids: list[int]) -> list[int]:
+    """
+    Delete the connections in one transaction, a chunk of ids per statement.
+    Returns the ids that weren't found.
+    """
+    connection_ids = sorted(set(connection_ids))
+    deleted_ids = set()
+    for chunk in chunked(connection_ids):
+        chunk_deleted_ids = db_session.scalars(delete(models.Connection).filter(models.Connection.id.in_(chunk))
+                                               .returning(models.Connection.id)).all()
+        deleted_ids.update(chunk_deleted_ids)
+        changes.record(db_session, changes.ConnectionsDeleted(tuple(chunk_deleted_ids)))
+
+    db_session.commit()
+    return [connection_id for connection_id in connection_ids if connection_id not in deleted_ids]
+
+
+def get_connections_to_node(db_session: Session, node_id: int, skip: int = 0, limit: int | None = None,
+                            after_id: int | None = None) -> list[models.Connection]:
+    # a UNION of one lookup per end of the connection lets each branch use its own index, where an OR would scan
+    connections_to_node = union_all(
+        select(models.Connection).filter(models.Connection.subject_id == node_id),
+        select(models.Connection).filter(models.Connection.target_id == node_id,
+                                         models.Connection.subject_id != node_id)
+    ).subquery()
+    connection = aliased(models.Connection, connections_to_node)
+    select_stmt = paginate(select(connection).options(joinedload(connection.subject), joinedload(connection.target)),
+                           connection.id, skip, limit, after_id)
+    return list(db_session.scalars(select_stmt).all())
+
+
+def select_ids(ids: Iterable[int]) -> Select:
+    """
+    Select the ids, passed to SQLite as a single JSON parameter however many there are
+    """
+    return select(func.json_each(json.dumps(list(ids))).table_valued("value").c.value)
+
+
+def neighbourhood_walk(node_id: int, depth: int, direction: schemas.Direction, names: list[str] | None,
+                       limit: int) -> Select:
+    """
+    (node_id, depth) of each node reached from the node in at most depth steps along connections (with one of the
+    names, if given), nearest first, stopping after limit rows.
+
+    The recursive CTE's UNION drops a (node, depth) pair already reached, so a cycle can't be followed round
+    more than depth times, and SQLite stops walking as soon as the outer LIMIT is met.
+    """
+    walk = select(literal(node_id).label("node_id"), literal(0).label("depth")).cte("walk", recursive=True)
+
+    steps = []
+    if direction != schemas.Direction.incoming:
+        steps.append((models.Connection.subject_id, models.Connection.target_id))
+    if direction != schemas.Direction.outgoing:
+        steps.append((models.Connection.target_id, models.Connection.subject_id))
+
+    step_selects = []
+    for from_column, to_column in steps:
+        step_select = select(to_column, walk.c.depth + 1).join(walk, from_column == walk.c.node_id).filter(
+            walk.c.depth < depth)
+        if names:
+            step_select = step_select.filter(models.Connection.name.in_(names))
+        step_selects.append(step_select)
+
+    walk = walk.union(*step_selects)
+    return select(walk.c.node_id, walk.c.depth).limit(limit)
+
+
+def get_neighbourhood(db_session: Session, node_id: int, depth: int = 1,
+                      direction: schemas.Direction = schemas.Direction.both, names: list[str] | None = None,
+                      limit: int = 1000) -> schemas.Neighbourhood | None:
+    """
+    The nodes within depth connections of the node, and the connections between them, in two statements.
+    Returns None if the node doesn't exist.
+    """
+    visited = neighbourhood_walk(node_id, depth, direction, names, limit).subquery("visited")
+    nearest = select(visited.c.node_id, func.min(visited.c.depth).label("depth"), func.count().label("visits")) \
+        .group_by(visited.c.node_id).subquery("nearest")
+    rows = db_session.execute(select(models.Node, nearest.c.depth, nearest.c.visits).join(
+        nearest, nearest.c.node_id == models.Node.id).order_by(nearest.c.depth, models.Node.id)).all()
+    if not rows or rows[0][1] != 0:
+        return None
+
+    nodes = {node.id: node for node, _, _ in rows}
+    # the ids go in as one parameter, as the walk would be run to completion if it were repeated as a subquery
+    visited_ids = select_ids(nodes)
+    select_stmt = select(models.Connection).filter(models.Connection.subject_id.in_(visited_ids),
+                                                   models.Connection.target_id.in_(visited_ids))
+    if names:
+        select_stmt = select_stmt.filter(models.Connection.name.in_(names))
+    connections = [with_nodes(db_connection, nodes[db_connection.subject_id], nodes[db_connection.target_id])
+                   for db_connection in db_session.scalars(select_stmt.order_by(models.Connection.id))]
+
+    return schemas.Neighbourhood(
+        nodes=[schemas.NeighbourhoodNode(id=node.id, name=node.name, depth=node_depth)
+               for node, node_depth, _ in rows],
+        connections=connections,
+        truncated=sum(visits for _, _, visits in rows) >= limit)
+
+
+def get_adjacent_connections(db_session: Session, node_ids: Iterable[int], direction: schemas.Direction,
+                             names: list[str] | None = None) -> list[Row]:
+    """
+    (node_id, connection_id, neighbour_id) for each connection from one of the nodes in the direction given,
+    in one statement however many nodes there are
+    """
+    node_ids = select_ids(node_ids)
+    ends = []
+    if direction != schemas.Direction.incoming:
+        ends.append((models.Connection.subject_id, models.Connection.target_id))
+    if direction != schemas.Direction.outgoing:
+        ends.append((models.Connection.target_id, models.Connection.subject_id))
+
+    selects = []
+    for node_id, neighbour_id in ends:
+        select_stmt = select(node_id.label("node_id"), models.Connection.id.label("connection_id"),
+                             neighbour_id.label("neighbour_id")).filter(node_id.in_(node_ids))
+        if names:
+            select_stmt = select_stmt.filter(models.Connection.name.in_(names))
+        selects.append(select_stmt)
+    return list(db_session.execute(union_all(*selects)).all())
 
 
 def get_connection(db_session: Session, connection_id: int) -> models.Connection | None:
-    select_stmt = select(models.Connection).filter(models.Connection.id == connection_id)
-    return db_session.scalars(select_stmt).first()
+    cache = identity_cache.for_session(db_session)
+    db_connection = cache.connection(connection_id) if cache else None
+    if db_connection is None:
+        select_stmt = select(models.Connection).options(*CONNECTION_NODES).filter(
+            models.Connection.id == connection_id)
+        db_connection = db_session.scalars(select_stmt).first()
+        if cache and db_connection is not None:
+            cache.remember(connections=[db_connection])
+    return db_connection
+
+
+class DuplicateConnectionError(Exception):
+    pass
 
 
 def update_connection(db_session: Session, connection_id: int,
                       updated_connection: schemas.ConnectionCreate) -> models.Connection:
+    db_connection, created = upsert_connection(db_session, connection_id, updated_connection)
+    return db_connection
+
+
+def upsert_connection(db_session: Session, connection_id: int,
+                      updated_connection: schemas.ConnectionCreate) -> tuple[models.Connection, bool]:
+    """
+    Update the connection with this id, or create it if there isn't one
+    :return: the connection, and whether it was created
+    """
     subject_node = get_or_create_connection_node(db_session, updated_connection.subject)
     target_node = get_or_create_connection_node(db_session, updated_connection.target)
+    values = {"name": updated_connection.name, "subject_id": subject_node.id, "target_id": target_node.id}
 
-    if get_connection(db_session, connection_id) is None:
-        db_connection = models.Connection(id=connection_id, name=updated_connection.name, subject=subject_node,
-                                          target=target_node)
-        db_session.add(db_connection)
-        db_session.commit()
-        db_session.refresh(db_connection)
-    else:
+    try:
         update_stmt = update(models.Connection).where(models.Connection.id == connection_id).values(
-            name=updated_connection.name, subject_id=subject_node.id, target_id=target_node.id)
-        db_session.execute(update_stmt)
+            **values).returning(models.Connection)
+        db_connection = db_session.scalars(update_stmt).first()
+        created = db_connection is None
+        if created:
+            insert_stmt = insert(models.Connection).values(id=connection_id, **values).returning(models.Connection)
+            db_connection = db_session.scalars(insert_stmt).first()
+        changes.record(db_session, connection_written(db_connection))
         db_session.commit()
-        db_connection = get_connection(db_session, connection_id)
-    return db_connection
+    except IntegrityError as error:
+        db_session.rollback()
+        if identity_cache.forget_deleted_nodes(db_session, error, [subject_node.id, target_node.id]):
+            return upsert_connection(db_session, connection_id, updated_connection)
+        raise DuplicateConnectionError(f"connection: {updated_connection.name}")
 
+    return with_nodes(db_connection, subject_node, target_node), created
 
-def get_connections_to_node_like_name(db_session: Session, like: str) -> list[models.Connection]:
-    nodes_like: list[models.Node] = get_nodes_like_name(db_session, like)
-    connections: set[models.Connection] = set()
-
-    for node in nodes_like:
-        connections_to_node: list[models.Connection] = get_connections_to_node(db_session, node.id)
-        for connection in connections_to_node:
-            connections.add(connection)
 
-    return list(connections)
+def get_connections_to_node_like_name(db_session: Session, like: str) -> list[models.Connection]:
+    node_ids_like = node_ids_like_name(like)
+    select_stmt = select(models.Connection).filter(
+        or_(models.Connection.subject_id.in_(node_ids_like), models.Connection.target_id.in_(node_ids_like))
+    ).options(*CONNECTION_NODES).order_by(models.Connection.id)
+    return list(db_session.scalars(select_stmt).all())
 
 
 def get_table_size(db_session, table_class: table) -> int:
@@ -176,9 +626,74 @@ def get_table_size(db_session, table_class: table) -> int:
     return length
 
 
+# kept up to date by triggers, see migrations.add_database_stats_tables
+database_stats = table("database_stats", column("name"), column("value"))
+connection_name_counts = table("connection_name_counts", column("name"), column("count"))
+node_degrees = table("node_degrees", column("node_id"), column("degree"))
+
+
+def suggest_nodes(db_session: Session, prefix: str, limit: int = 10) -> list[schemas.NodeSuggestion]:
+    """
+    The nodes whose name starts with the prefix (ignoring case), most connected first,
+    from the suggest indexes if there are any (see suggest.py)
+    """
+    suggest_indexes = suggest.get_suggest_indexes(db_session)
+    if suggest_indexes is not None:
+        return suggest_indexes.suggest_nodes(prefix, limit)
+
+    prefix = suggest.normalize_prefix(prefix)
+    degree = func.coalesce(node_degrees.c.degree, 0).label("degree")
+    select_stmt = select(models.Node.id, models.Node.name, degree).outerjoin(
+        node_degrees, node_degrees.c.node_id == models.Node.id
+    ).filter(
+        # a range of the normalized names' index
+        models.Node.name_normalized >= prefix, models.Node.name_normalized < prefix + suggest.LAST_CHARACTER
+    ).order_by(degree.desc(), models.Node.name_normalized, models.Node.id).limit(min(limit, suggest.MAX_SUGGESTIONS))
+    return [schemas.NodeSuggestion(id=row.id, name=row.name, degree=row.degree)
+            for row in db_session.execute(select_stmt)]
+
+
+def suggest_connection_names(db_session: Session, prefix: str,
+                             limit: int = 10) -> list[schemas.ConnectionNameSuggestion]:
+    """
+    The connection names starting with the prefix (ignoring case), most used first,
+    from the suggest indexes if there are any (see suggest.py)
+    """
+    suggest_indexes = suggest.get_suggest_indexes(db_session)
+    if suggest_indexes is not None:
+        return suggest_indexes.suggest_connection_names(prefix, limit)
+
+    select_stmt = select(connection_name_counts.c.name, connection_name_counts.c.count).filter(
+        connection_name_counts.c.name.istartswith(suggest.normalize_prefix(prefix), autoescape=True)
+    ).order_by(connection_name_counts.c.count.desc(), func.lower(connection_name_counts.c.name),
+               connection_name_counts.c.name).limit(min(limit, suggest.MAX_SUGGESTIONS))
+    return [schemas.ConnectionNameSuggestion(name=row.name, count=row.count)
+            for row in db_session.execute(select_stmt)]
+
+
+def get_database_stats(db_session: Session, detail: bool = False) -> schemas.DatabaseStats:
+    """
+    Node and connection counts from the stats tables, without counting any rows.
+    In detail, also the number of connections with each name.
+    """
+    values = dict(db_session.execute(select(database_stats.c.name, database_stats.c.value)).all())
+    max_degree = db_session.scalar(select(func.max(node_degrees.c.degree)))
+    stats = schemas.DatabaseStats(node_count=values["node_count"], connection_count=values["connection_count"],
+                                  max_degree=max_degree or 0,
+                                  orphan_node_count=values["node_count"] - values["connected_node_count"])
+    if detail:
+        stats.connection_name_counts = dict(db_session.execute(
+            select(connection_name_counts.c.name, connection_name_counts.c.count).order_by(
+                connection_name_counts.c.name)).all())
+    return stats
+
+
 def delete_nodes(db_session: Session) -> int:
     delete_stmt = delete(models.Node)
     result: Result = db_session.execute(delete_stmt)
+    # the connections go too, by the foreign keys' ON DELETE CASCADE
+    changes.record(db_session, changes.TableCleared(models.Connection.__tablename__),
+                   changes.TableCleared(models.Node.__tablename__))
     db_session.commit()
     return result.rowcount
 
@@ -186,16 +701,49 @@ def delete_nodes(db_session: Session) -> int:
 def delete_connections(db_session: Session) -> int:
     delete_stmt = delete(models.Connection)
     result: Result = db_session.execute(delete_stmt)
+    changes.record(db_session, changes.TableCleared(models.Connection.__tablename__))
     db_session.commit()
     return result.rowcount
 
 
-def get_connection_names(db_session: Session, like: str) -> dict[str:int]:
-    connections = get_connections_like_name(db_session, like)
-    connection_names = {}
+def get_connection_name_counts(db_session: Session, like: str, limit: int | None = None,
+                               most_common_first: bool = False) -> list[Row]:
+    """
+    Count the connections with each name like the given one.
+    Each row has the name, count, subject_count (distinct subjects) and target_count (distinct targets).
+    Rows are ordered by name, or by count (highest first) if most_common_first.
+    """
+    return count_connection_names(db_session, connection_ids_like_name(like), limit, most_common_first)
+
+
+def search_connection_name_counts(db_session: Session, query: str, limit: int | None = None,
+                                  most_common_first: bool = False) -> list[Row]:
+    """
+    get_connection_name_counts for the connections with names matching the search query (see
+    search.search_condition), the way search_nodes matches nodes
+    """
+    condition, _ = search.search_condition(search.connections_fts, query)
+    return count_connection_names(db_session, select(search.connections_fts.c.rowid).filter(condition), limit,
+                                  most_common_first)
+
+
+def count_connection_names(db_session: Session, connection_ids: Select, limit: int | None,
+                           most_common_first: bool) -> list[Row]:
+    count = func.count(models.Connection.id).label("count")
+    select_stmt = select(
+        models.Connection.name,
+        count,
+        func.count(models.Connection.subject_id.distinct()).label("subject_count"),
+        func.count(models.Connection.target_id.distinct()).label("target_count")
+    ).filter(models.Connection.id.in_(connection_ids)).group_by(models.Connection.name)
+
+    if most_common_first:
+        select_stmt = select_stmt.order_by(count.desc(), models.Connection.name)
+    else:
+        select_stmt = select_stmt.order_by(models.Connection.name)
 
-    for connection in connections:
-        count = connection_names.get(connection.name, 0)
-        connection_names[connection.name] = count + 1
+    return list(db_session.execute(select_stmt.limit(limit)).all())
 
-    return connection_names
+
+def get_connection_names(db_session: Session, like: str) -> dict[str:int]:
+    return {row.name: row.count for row in get_connection_name_counts(db_session, like)}
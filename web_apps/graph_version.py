@@ -0,0 +1,135 @@
+"""
+A version number for the graph, so the apps can answer conditional GETs without querying the database.
+
+Every change the crud writes publish (see changes.py) bumps the version. It's kept for the process rather than per
+engine, as all of the apps' engines (sync, read-only and async) are on the one database. Commits the process doesn't
+publish, from other processes serving the same database or from anything else writing to it, bump it too: the
+version watches the apps' database file with a DataVersionWatcher. The GET responses carry the version as their
+ETag, along with when it last changed as their Last-Modified, and a GET whose If-None-Match has the current ETag gets
+a 304 straight away.
+"""
+import sqlite3
+import time
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from threading import RLock
+
+from fastapi import FastAPI, Request, Response
+from sqlalchemy import Engine
+
+from . import changes
+
+
+class DataVersionWatcher:
+    """
+    Notices commits to a database file, through a read-only connection of its own whose PRAGMA data_version changes
+    whenever any other connection (in this process or another) commits. Not thread-safe, so callers hold a lock.
+    """
+
+    def __init__(self, database_file: str):
+        # never waits for a lock, see changed
+        self.connection = sqlite3.connect(f"file:{database_file}?mode=ro", uri=True, timeout=0,
+                                          check_same_thread=False)
+        self.data_version: int | None = None
+        self.changed()
+
+    def changed(self) -> bool:
+        """
+        Whether anything has committed to the database since last asked
+        """
+        try:
+            data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+        except sqlite3.OperationalError:
+            # another connection has the database locked while it commits, so assume it's changing
+            data_version = None
+        changed = data_version is None or data_version != self.data_version
+        self.data_version = data_version
+        return changed
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class GraphVersion:
+    def __init__(self):
+        self.lock = RLock()
+        # the number starts again at 0 in each process, so the ETags include when it started
+        self.epoch = format(time.time_ns(), "x")
+        self.number = 0
+        self.modified = datetime.now(timezone.utc)
+        self.database_file: str | None = None
+        self.watcher: DataVersionWatcher | None = None
+
+    def watch(self, database_file: str | None) -> None:
+        """
+        Bump the version whenever anything commits to the database file (or stop watching, given None)
+        """
+        with self.lock:
+            if self.watcher is not None:
+                self.watcher.close()
+                self.watcher = None
+            self.database_file = database_file
+            if database_file is not None:
+                self.watcher = DataVersionWatcher(database_file)
+                self.bump()
+
+    def bump(self) -> None:
+        with self.lock:
+            self.number += 1
+            self.modified = datetime.now(timezone.utc)
+
+    def current(self) -> tuple[str, datetime]:
+        """
+        The current version's ETag and when it became current
+        """
+        with self.lock:
+            if self.watcher is not None and self.watcher.changed():
+                self.bump()
+            return f'W/"{self.epoch}-{self.number}"', self.modified
+
+
+graph_version = GraphVersion()
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """
+    Whether an If-None-Match header lists the ETag (comparing weakly, as a GET should)
+    """
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in (tag.removeprefix("W/") for tag in tags)
+
+
+def add_conditional_gets(app: FastAPI, database_file: str, uncached_path_prefixes: tuple[str, ...] = ()) -> None:
+    """
+    Tag the app's successful GET responses with the version of the graph in the database file, and answer GETs for the
+    current version with 304. GETs whose path starts with one of the uncached prefixes are left alone, for responses
+    that change without the graph changing (or GETs that change it).
+    """
+    if graph_version.database_file != database_file:
+        graph_version.watch(database_file)
+
+    @app.middleware("http")
+    async def conditional_get(request: Request, call_next):
+        if request.method not in ("GET", "HEAD") or request.url.path.startswith(uncached_path_prefixes):
+            return await call_next(request)
+
+        # taken before the response is made, so a write made meanwhile can only make the ETag older than it
+        etag, modified = graph_version.current()
+        headers = {"ETag": etag, "Last-Modified": format_datetime(modified, usegmt=True), "Cache-Control": "no-cache"}
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+
+        response = await call_next(request)
+        if response.status_code == 200:
+            for name, value in headers.items():
+                response.headers.setdefault(name, value)
+        return response
+
+
+def _apply_changes(engine: Engine, database_changes: list[changes.Change]) -> None:
+    graph_version.bump()
+
+
+changes.add_listener(_apply_changes)
@@ -2,34 +2,47 @@ import datetime
 from io import BytesIO, TextIOWrapper
 from typing import List
 
-from fastapi import Depends, FastAPI, HTTPException, Request, UploadFile, File, Form
-from fastapi.responses import HTMLResponse
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, UploadFile, File, Form
+from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
 
 import utilities
 from utilities.cvs_file_loader import load_staff_list_from_csv_buffer
 from utilities.load_test_data import load_test_data
-from . import models, crud
-from .crud import get_connection_names
-from .database import LocalSession, engine
-from .json_rest_app import get_node, get_nodes, get_connections, create_connection, delete_all_nodes, \
-    get_database_stats, get_connection
-from .schemas import NodeCreate, ConnectionCreate, Connection
+from . import models, crud, identity_cache
+from .adjacency import build_adjacency_if_enabled
+from .database import db_file, engine
+from .graph_version import add_conditional_gets
+from .json_rest_app import get_node, create_connection, delete_all_nodes, get_database_stats, get_connection, \
+    get_after_id, suggest_nodes, suggest_connection_names
+from .migrations import upgrade_database
+from .name_index import build_name_indexes_if_enabled
+from .pagination import next_cursor
+from .schemas import NodeCreate, ConnectionCreate, Connection, NodeSuggestion, ConnectionNameSuggestion
+from .sessions import DatabaseSession, get_db_session, get_read_db_session
+from .suggest import MAX_SUGGESTIONS, build_suggest_indexes_if_enabled
+from .write_queue import start_write_queue_if_enabled, WriteQueueFullError
 
 models.Base.metadata.create_all(bind=engine)
+upgrade_database(engine)
+build_name_indexes_if_enabled(engine)
+build_adjacency_if_enabled(engine)
+build_suggest_indexes_if_enabled(engine)
+identity_cache.create_identity_cache_if_enabled(engine)
+start_write_queue_if_enabled(engine)
 
 app = FastAPI()
+# deleting a connection is a GET, which mustn't be skipped, and the home page shows today's date
+add_conditional_gets(app, db_file, uncached_path_prefixes=("/delete-connection/", "/home"))
 templates = Jinja2Templates(directory="templates")
 
+CONNECTIONS_PAGE_SIZE = 100
 
-# Dependency
-def get_db_session():
-    db_session = LocalSession()
-    try:
-        yield db_session
-    finally:
-        db_session.close()
+
+@app.exception_handler(WriteQueueFullError)
+async def write_queue_full(request: Request, error: WriteQueueFullError):
+    return JSONResponse(status_code=503, content={"detail": "Too many writes queued, try again"})
 
 
 @app.get('/', response_class=HTMLResponse)
@@ -43,16 +56,17 @@ def file_upload_page(request: Request):
 
 
 @app.post('/upload')
-def upload(file: UploadFile = File(...), db_session: Session = Depends(get_db_session)):
+async def upload(file: UploadFile = File(...), db_session: DatabaseSession = Depends(get_db_session)):
     try:
-        file_contents = file.file.read()
+        file_contents = await file.read()
         text_buffer = TextIOWrapper(BytesIO(file_contents))
-        lines_processed = load_staff_list_from_csv_buffer(db_session, text_buffer)
+        # one call to the write queue, if there is one, so it doesn't compete with the writer for the database
+        lines_processed = await db_session.write(load_staff_list_from_csv_buffer, text_buffer)
     except:
         raise HTTPException(status_code=500, detail='Something went wrong')
     finally:
         text_buffer.close()
-        file.file.close()
+        await file.close()
 
     return {"message": "OK", "lines processed": lines_processed}
 
@@ -70,9 +84,10 @@ def home(request: Request):
 
 
 @app.get("/connections-to-node/{node_id}", response_class=HTMLResponse)
-def connection_results(request: Request, node_id: int, db_session: Session = Depends(get_db_session)):
-    node = get_node(node_id=node_id, db_session=db_session)
-    connections = get_connections(node_id=node_id, db_session=db_session)
+async def connection_results(request: Request, node_id: int,
+                             db_session: DatabaseSession = Depends(get_read_db_session)):
+    node = await get_node(node_id=node_id, db_session=db_session)
+    connections = await db_session.run(crud.get_connections_to_node, node_id)
     return templates.TemplateResponse("connections-to-node-results.html",
                                       {"request": request, "node": node, "connections": connections})
 
@@ -83,38 +98,59 @@ def add_new_connection(request: Request, connection: Connection = None):
 
 
 @app.post("/add-connection", response_class=HTMLResponse)
-def create_connection_in_database(request: Request, subject: str = Form(), conn_name: str = Form(),
-                                  target: str = Form(), db_session: Session = Depends(get_db_session)):
+async def create_connection_in_database(request: Request, subject: str = Form(), conn_name: str = Form(),
+                                        target: str = Form(), db_session: DatabaseSession = Depends(get_db_session)):
     connection = ConnectionCreate(subject=NodeCreate(name=subject), name=conn_name, target=NodeCreate(name=target))
 
-    connection = create_connection(db_session=db_session, connection=connection)
+    connection = await create_connection(db_session=db_session, connection=connection)
     return templates.TemplateResponse("/add-connection.html", {"request": request, "connection": connection})
 
 
+# used by the pages' typeahead fields
+@app.get("/suggest/nodes", response_model=list[NodeSuggestion])
+async def node_suggestions(prefix: str, limit: int = Query(10, ge=1, le=MAX_SUGGESTIONS),
+                           db_session: DatabaseSession = Depends(get_read_db_session)):
+    return await suggest_nodes(prefix=prefix, limit=limit, db_session=db_session)
+
+
+@app.get("/suggest/connection-names", response_model=list[ConnectionNameSuggestion])
+async def connection_name_suggestions(prefix: str, limit: int = Query(10, ge=1, le=MAX_SUGGESTIONS),
+                                      db_session: DatabaseSession = Depends(get_read_db_session)):
+    return await suggest_connection_names(prefix=prefix, limit=limit, db_session=db_session)
+
+
 @app.get("/purge-database", response_class=HTMLResponse)
 def show_purge_database_page(request: Request):
     return templates.TemplateResponse("/purge-database.html", {"request": request})
 
 
 @app.post("/purge-database", response_class=HTMLResponse)
-def purge_database(request: Request, db_session: Session = Depends(get_db_session)):
-    delete_all_nodes(db_session)
-    stats = get_database_stats(db_session)
+async def purge_database(request: Request, db_session: DatabaseSession = Depends(get_db_session)):
+    await delete_all_nodes(db_session)
+    stats = await get_database_stats(db_session)
     return templates.TemplateResponse("/database-stats.html", {"request": request, "stats": stats})
 
 
 @app.get("/database-stats", response_class=HTMLResponse)
-def show_database_stats_page(request: Request, db_session: Session = Depends(get_db_session)):
-    stats = get_database_stats(db_session)
+async def show_database_stats_page(request: Request, db_session: DatabaseSession = Depends(get_read_db_session)):
+    stats = await get_database_stats(db_session)
     return templates.TemplateResponse("/database-stats.html", {"request": request, "stats": stats})
 
 
-@app.get("/connections/", response_class=HTMLResponse)
-def get_connections_by_name(request: Request, name_like: str, db_session: Session = Depends(get_db_session)):
-    connections: list[Connection] = get_connections(name_like=name_like, db_session=db_session)
+async def show_connection_results(request: Request, name_like: str, db_session: DatabaseSession,
+                                  after: str | None = None):
+    connections: list[Connection] = await db_session.run(
+        crud.get_connections_like_name, like=name_like, limit=CONNECTIONS_PAGE_SIZE, after_id=get_after_id(after))
 
     return templates.TemplateResponse("/connection-results.html",
-                                      {"request": request, "name_like": name_like, "connections": connections})
+                                      {"request": request, "name_like": name_like, "connections": connections,
+                                       "next_cursor": next_cursor(connections, CONNECTIONS_PAGE_SIZE)})
+
+
+@app.get("/connections/", response_class=HTMLResponse)
+async def get_connections_by_name(request: Request, name_like: str, after: str | None = None,
+                                  db_session: DatabaseSession = Depends(get_read_db_session)):
+    return await show_connection_results(request, name_like, db_session, after)
 
 
 @app.get("/search", response_class=HTMLResponse)
@@ -123,9 +159,9 @@ def show_search_page(request: Request):
 
 
 @app.get("/search-results", response_class=HTMLResponse)
-def search_results(request: Request, like: str, db_session: Session = Depends(get_db_session)):
-    nodes = get_nodes(like=like, db_session=db_session)
-    connection_names: dict[str:int] = get_connection_names(like=like, db_session=db_session)
+async def search_results(request: Request, like: str, db_session: DatabaseSession = Depends(get_read_db_session)):
+    nodes = await db_session.run(crud.search_nodes, query=like, limit=None)
+    connection_names = await db_session.run(crud.search_connection_name_counts, query=like)
     return templates.TemplateResponse("search-results.html", {"request": request, "like": like, "nodes": nodes,
                                                               "connection_names": connection_names})
 
@@ -136,63 +172,56 @@ def show_load_test_data_page(request: Request):
 
 
 @app.post("/load-test-data", response_class=HTMLResponse)
-def load_test_data(request: Request, db_session: Session = Depends(get_db_session)):
-    utilities.load_test_data.load_test_data(db_session)
+async def load_test_data(request: Request, db_session: DatabaseSession = Depends(get_db_session)):
+    await db_session.write(utilities.load_test_data.load_test_data)
 
-    stats = get_database_stats(db_session)
+    stats = await get_database_stats(db_session)
     return templates.TemplateResponse("/database-stats.html", {"request": request, "stats": stats})
 
 
 @app.get("/delete-connection/{connection_id}", response_class=HTMLResponse)
-def delete_connection(request: Request, connection_id: int, name_like: str,
-                      db_session: Session = Depends(get_db_session)):
-    if not crud.delete_connection(db_session, connection_id):
+async def delete_connection(request: Request, connection_id: int, name_like: str,
+                            db_session: DatabaseSession = Depends(get_db_session)):
+    if not await db_session.write(crud.delete_connection, connection_id):
         raise HTTPException(status_code=404)
 
-    connections: list[Connection] = get_connections(name_like=name_like, db_session=db_session)
-
-    return templates.TemplateResponse("/connection-results.html",
-                                      {"request": request, "name_like": name_like, "connections": connections})
+    return await show_connection_results(request, name_like, db_session)
 
 
 @app.post("/delete-connections/", response_class=HTMLResponse)
-def delete_connections(request: Request, name_like: str = Form(...),
-                       conn_id: List[int] = Form(list()), db_session: Session = Depends(get_db_session)):
+async def delete_connections(request: Request, name_like: str = Form(...),
+                             conn_id: List[int] = Form(list()), db_session: DatabaseSession = Depends(get_db_session)):
     """
     This handles a dynamic number of conn_id items in the form
     :param conn_id: list of connection ids to be deleted, can be empty
     """
     print(f"name_like={name_like}")
     print("conn_id list", conn_id)
-    for id in conn_id:
-        if not crud.delete_connection(db_session, connection_id=id):
-            raise HTTPException(status_code=404)
+    if await db_session.write(crud.delete_connections_by_ids, conn_id):
+        raise HTTPException(status_code=404)
 
-    connections: list[Connection] = get_connections(name_like=name_like, db_session=db_session)
-
-    return templates.TemplateResponse("/connection-results.html",
-                                      {"request": request, "name_like": name_like, "connections": connections})
+    return await show_connection_results(request, name_like, db_session)
 
 
 @app.get("/edit-connection/{connection_id}", response_class=HTMLResponse)
-def show_edit_connection_page(request: Request, connection_id: int,
-                              db_session: Session = Depends(get_db_session)):
-    connection = get_connection(connection_id=connection_id, db_session=db_session)
+async def show_edit_connection_page(request: Request, connection_id: int,
+                                    db_session: DatabaseSession = Depends(get_read_db_session)):
+    connection = await get_connection(connection_id=connection_id, db_session=db_session)
     return templates.TemplateResponse("/edit-connection.html", {"request": request, "conn_id": connection_id,
                                                                 "connection_name": connection.name})
 
 
 @app.post("/edit-connection", response_class=HTMLResponse)
-def edit_connection_in_database(request: Request, conn_name: str = Form(), conn_id: int = Form(),
-                                db_session: Session = Depends(get_db_session)):
-    connection: Connection = crud.get_connection(db_session, conn_id)
+async def edit_connection_in_database(request: Request, conn_name: str = Form(), conn_id: int = Form(),
+                                      db_session: DatabaseSession = Depends(get_db_session)):
+    connection: Connection = await db_session.run(crud.get_connection, conn_id)
     if connection is None:
         assert False  # TODO fix this with a proper error page
 
-    connection.name = conn_name
-    connection = crud.update_connection(db_session, conn_id, updated_connection=connection)
-
-    connections: list[Connection] = crud.get_connections_like_name(db_session=db_session, like=conn_name)
+    updated_connection = ConnectionCreate(name=conn_name, subject=connection.subject_id, target=connection.target_id)
+    try:
+        await db_session.write(crud.update_connection, conn_id, updated_connection=updated_connection)
+    except crud.DuplicateConnectionError:
+        raise HTTPException(status_code=400, detail="Connection already exists")
 
-    return templates.TemplateResponse("/connection-results.html",
-                                      {"request": request, "name_like": conn_name, "connections": connections})
+    return await show_connection_results(request, conn_name, db_session)
@@ -0,0 +1,380 @@
+"""
+An optional, bounded, least-recently-used cache of the nodes and connections crud has looked up, by id and (for
+nodes) by normalized name.
+
+With KNOWLEDGE_IDENTITY_CACHE set, the apps create one for their engine, shared by every session on it. crud's point
+lookups (get_node, get_node_by_name, get_connection and the node lookups made when creating connections) answer from
+it when they can, and remember what they read when they can't. Loading connections then stops looking up the nodes
+it has already seen, e.g. the same GM on every row of a staff list. It holds KNOWLEDGE_IDENTITY_CACHE_SIZE nodes
+(10,000 unless set) and as many connections.
+
+The cache holds immutable snapshots, from which the lookups make detached ORM objects. It follows the crud writes
+(see changes.py): each committed change is written through to the cache of the engine that made it, and evicted from
+any other engine's. A lookup doesn't use (or remember) rows its own uncommitted transaction has written, nor any at all
+once the transaction has deleted rows, and rows read are only remembered if nothing has been committed since the
+transaction began, so the cache never holds anything this process hasn't seen in the database.
+
+Writes it can't see, made by other processes (or by anything not going through crud), can leave it out of date, so
+it empties itself every KNOWLEDGE_IDENTITY_CACHE_TTL seconds (60 unless set). Until then a lookup can return a node
+that has since been renamed or deleted. A crud write given a deleted node by the cache fails its foreign key check,
+and then has the cache forget the nodes it used (see forget_deleted_nodes) and tries again without them.
+"""
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import RLock
+from typing import Iterable
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import Engine, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import changes, models, schemas
+
+_GENERATION = "identity_cache_generation"
+
+
+def identity_cache_enabled() -> bool:
+    return os.environ.get("KNOWLEDGE_IDENTITY_CACHE", default="0").lower() in ("1", "true", "yes", "on")
+
+
+def identity_cache_max_size() -> int:
+    return int(os.environ.get("KNOWLEDGE_IDENTITY_CACHE_SIZE", default=10_000))
+
+
+def identity_cache_ttl() -> float:
+    return float(os.environ.get("KNOWLEDGE_IDENTITY_CACHE_TTL", default=60))
+
+
+@dataclass(frozen=True)
+class NodeSnapshot:
+    id: int
+    name: str
+    name_normalized: str
+
+
+@dataclass(frozen=True)
+class ConnectionSnapshot:
+    id: int
+    name: str
+    subject_id: int
+    target_id: int
+
+
+def snapshot_node(node) -> NodeSnapshot:
+    """
+    A snapshot of a node, or of any row with its id and name
+    """
+    return NodeSnapshot(node.id, node.name, models.normalize_name(node.name))
+
+
+def detached_node(snapshot: NodeSnapshot) -> models.Node:
+    db_node = models.Node(id=snapshot.id, name=snapshot.name)
+    make_transient_to_detached(db_node)
+    return db_node
+
+
+class IdentityCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl  # seconds
+        self.expires = time.monotonic() + ttl
+        self.lock = RLock()
+        self.nodes: OrderedDict[int, NodeSnapshot] = OrderedDict()  # least recently used first
+        self.node_ids: dict[str, int] = {}  # normalized name -> id, of the nodes above
+        self.connections: OrderedDict[int, ConnectionSnapshot] = OrderedDict()
+        # bumped by every change, so rows read before it can't be remembered after it
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def expire(self) -> None:
+        """
+        Empty the cache if it's been ttl seconds since it was last emptied
+        """
+        now = time.monotonic()
+        if now >= self.expires:
+            self.clear()
+            self.expires = now + self.ttl
+
+    def clear(self) -> None:
+        with self.lock:
+            self.nodes.clear()
+            self.node_ids.clear()
+            self.connections.clear()
+
+    def node(self, node_id: int) -> NodeSnapshot | None:
+        with self.lock:
+            self.expire()
+            snapshot = self.nodes.get(node_id)
+            if snapshot is None:
+                self.misses += 1
+            else:
+                self.nodes.move_to_end(node_id)
+                self.hits += 1
+            return snapshot
+
+    def node_by_name(self, name_normalized: str) -> NodeSnapshot | None:
+        with self.lock:
+            self.expire()
+            node_id = self.node_ids.get(name_normalized)
+            if node_id is None:
+                self.misses += 1
+                return None
+            return self.node(node_id)
+
+    def connection(self, connection_id: int) -> ConnectionSnapshot | None:
+        with self.lock:
+            self.expire()
+            snapshot = self.connections.get(connection_id)
+            if snapshot is None:
+                self.misses += 1
+            else:
+                self.connections.move_to_end(connection_id)
+                self.hits += 1
+            return snapshot
+
+    def remember(self, generation: int, nodes: Iterable[NodeSnapshot] = (),
+                 connections: Iterable[ConnectionSnapshot] = ()) -> None:
+        """
+        Add rows read in a transaction that began at the generation, unless something has changed since
+        """
+        with self.lock:
+            if generation != self.generation:
+                return
+            for snapshot in nodes:
+                self.put_node(snapshot)
+            for snapshot in connections:
+                self.put_connection(snapshot)
+
+    def put_node(self, snapshot: NodeSnapshot) -> None:
+        self.drop_node(snapshot.id)
+        # a node holding the name before has since been renamed
+        self.drop_node(self.node_ids.get(snapshot.name_normalized))
+        self.nodes[snapshot.id] = snapshot
+        self.node_ids[snapshot.name_normalized] = snapshot.id
+        while len(self.nodes) > self.max_size:
+            _, evicted = self.nodes.popitem(last=False)
+            del self.node_ids[evicted.name_normalized]
+
+    def drop_node(self, node_id: int | None) -> None:
+        snapshot = self.nodes.pop(node_id, None)
+        if snapshot is not None:
+            del self.node_ids[snapshot.name_normalized]
+
+    def put_connection(self, snapshot: ConnectionSnapshot) -> None:
+        self.connections[snapshot.id] = snapshot
+        self.connections.move_to_end(snapshot.id)
+        while len(self.connections) > self.max_size:
+            self.connections.popitem(last=False)
+
+    def apply(self, database_changes: list[changes.Change], write_through: bool) -> None:
+        """
+        Write the committed changes through to the cache, or if they were made through another engine, only evict
+        the rows they changed
+        """
+        with self.lock:
+            self.generation += 1
+            for change in database_changes:
+                match change:
+                    case changes.NodeWritten(node_id, name):
+                        if write_through:
+                            self.put_node(NodeSnapshot(node_id, name, models.normalize_name(name)))
+                        else:
+                            self.drop_node(node_id)
+                            self.drop_node(self.node_ids.get(models.normalize_name(name)))
+                    case changes.NodesDeleted(node_ids):
+                        for node_id in node_ids:
+                            self.drop_node(node_id)
+                    case changes.ConnectionWritten(connection_id, name, subject_id, target_id):
+                        if write_through:
+                            self.put_connection(ConnectionSnapshot(connection_id, name, subject_id, target_id))
+                        else:
+                            self.connections.pop(connection_id, None)
+                    case changes.ConnectionsDeleted(connection_ids):
+                        for connection_id in connection_ids:
+                            self.connections.pop(connection_id, None)
+                    case changes.TableCleared("nodes"):
+                        self.nodes.clear()
+                        self.node_ids.clear()
+                    case changes.TableCleared("connections"):
+                        self.connections.clear()
+                    case changes.DatabaseReloaded():
+                        self.clear()
+
+    def stats(self) -> schemas.IdentityCacheStats:
+        with self.lock:
+            return schemas.IdentityCacheStats(node_count=len(self.nodes), connection_count=len(self.connections),
+                                              max_size=self.max_size, hits=self.hits, misses=self.misses)
+
+
+class SessionIdentityCache:
+    """
+    The identity cache as one session sees it, making detached ORM objects from its snapshots
+    """
+    def __init__(self, cache: IdentityCache, db_session: Session):
+        self.cache = cache
+        self.db_session = db_session
+
+    def written_ids(self) -> tuple[set[int], set[int]] | None:
+        """
+        The ids of the nodes and connections the session's transaction has written, whose snapshots it can't use,
+        or None if it has deleted rows and can't use any
+        """
+        node_ids = set()
+        connection_ids = set()
+        for change in changes.pending_changes(self.db_session):
+            match change:
+                case changes.NodeWritten(node_id, _):
+                    node_ids.add(node_id)
+                case changes.ConnectionWritten(connection_id, _, _, _):
+                    connection_ids.add(connection_id)
+                case _:
+                    return None
+        return node_ids, connection_ids
+
+    def node(self, node_id: int) -> models.Node | None:
+        written_ids = self.written_ids()
+        if written_ids is None or node_id in written_ids[0]:
+            return None
+        snapshot = self.cache.node(node_id)
+        return detached_node(snapshot) if snapshot is not None else None
+
+    def node_by_name(self, name: str) -> models.Node | None:
+        written_ids = self.written_ids()
+        if written_ids is None:
+            return None
+        snapshot = self.cache.node_by_name(models.normalize_name(name))
+        if snapshot is None or snapshot.id in written_ids[0]:
+            return None
+        return detached_node(snapshot)
+
+    def node_ids_by_normalized_name(self, names_normalized: Iterable[str]) -> dict[str, int]:
+        """
+        The ids of the nodes with these names that are in the cache
+        """
+        written_ids = self.written_ids()
+        if written_ids is None:
+            return {}
+        node_ids = {}
+        for name_normalized in names_normalized:
+            snapshot = self.cache.node_by_name(name_normalized)
+            if snapshot is not None and snapshot.id not in written_ids[0]:
+                node_ids[name_normalized] = snapshot.id
+        return node_ids
+
+    def has_node(self, node_id: int) -> bool:
+        written_ids = self.written_ids()
+        return written_ids is not None and node_id not in written_ids[0] and self.cache.node(node_id) is not None
+
+    def connection(self, connection_id: int) -> models.Connection | None:
+        """
+        The connection, with its subject and target nodes, if they're all in the cache
+        """
+        written_ids = self.written_ids()
+        if written_ids is None or connection_id in written_ids[1]:
+            return None
+        with self.cache.lock:
+            snapshot = self.cache.connection(connection_id)
+            if snapshot is None or {snapshot.subject_id, snapshot.target_id} & written_ids[0]:
+                return None
+            subject_node = self.cache.node(snapshot.subject_id)
+            target_node = self.cache.node(snapshot.target_id)
+        if subject_node is None or target_node is None:
+            return None
+
+        db_connection = models.Connection(id=snapshot.id, name=snapshot.name, subject_id=snapshot.subject_id,
+                                          target_id=snapshot.target_id)
+        make_transient_to_detached(db_connection)
+        set_committed_value(db_connection, "subject", detached_node(subject_node))
+        set_committed_value(db_connection, "target", detached_node(target_node))
+        return db_connection
+
+    def forget_nodes(self, node_ids: Iterable[int]) -> bool:
+        """
+        Drop the nodes, found not to be in the database after all, and say whether the cache had any of them
+        """
+        with self.cache.lock:
+            cached_node_ids = [node_id for node_id in node_ids if node_id in self.cache.nodes]
+            for node_id in cached_node_ids:
+                self.cache.drop_node(node_id)
+        return bool(cached_node_ids)
+
+    def remember(self, nodes: Iterable = (), connections: Iterable[models.Connection] = ()) -> None:
+        """
+        Remember nodes (or rows with their id and name) and connections (with their nodes) the session has read,
+        those its transaction hasn't written itself, as they were committed when it began
+        """
+        generation = self.db_session.info.get(_GENERATION)
+        written_ids = self.written_ids()
+        if generation is None or written_ids is None:
+            return
+        written_node_ids, written_connection_ids = written_ids
+        connections = [db_connection for db_connection in connections
+                       if db_connection.id not in written_connection_ids
+                       and not {db_connection.subject_id, db_connection.target_id} & written_node_ids]
+        nodes = list(nodes) + [node for db_connection in connections
+                               for node in (db_connection.subject, db_connection.target)]
+        self.cache.remember(generation, [snapshot_node(node) for node in nodes if node.id not in written_node_ids], [
+            ConnectionSnapshot(db_connection.id, db_connection.name, db_connection.subject_id,
+                               db_connection.target_id) for db_connection in connections])
+
+
+_identity_caches: WeakKeyDictionary[Engine, IdentityCache] = WeakKeyDictionary()
+
+
+def create_identity_cache(engine: Engine, max_size: int | None = None, ttl: float | None = None) -> IdentityCache:
+    """
+    Start caching lookups made through this engine (replacing any cache it had)
+    """
+    cache = _identity_caches[engine] = IdentityCache(identity_cache_max_size() if max_size is None else max_size,
+                                                     identity_cache_ttl() if ttl is None else ttl)
+    return cache
+
+
+def create_identity_cache_if_enabled(engine: Engine) -> None:
+    if identity_cache_enabled() and engine not in _identity_caches:
+        create_identity_cache(engine)
+
+
+def drop_identity_cache(engine: Engine) -> None:
+    _identity_caches.pop(engine, None)
+
+
+def get_identity_cache(db_session: Session) -> IdentityCache | None:
+    return _identity_caches.get(changes.engine_of(db_session))
+
+
+def for_session(db_session: Session) -> SessionIdentityCache | None:
+    cache = get_identity_cache(db_session)
+    return SessionIdentityCache(cache, db_session) if cache is not None else None
+
+
+def forget_deleted_nodes(db_session: Session, error: IntegrityError, node_ids: Iterable[int]) -> bool:
+    """
+    Whether a write failed because the cache gave it nodes since deleted by a write it couldn't see, in which case
+    the cache forgets them so the write can be tried again
+    """
+    cache = for_session(db_session)
+    # the only foreign keys are the connections' to their nodes
+    return cache is not None and "FOREIGN KEY constraint failed" in str(error.orig) and cache.forget_nodes(node_ids)
+
+
+@event.listens_for(Session, "after_begin")
+def _note_generation(db_session: Session, transaction, connection) -> None:
+    if transaction.nested:
+        return
+    cache = get_identity_cache(db_session)
+    if cache is not None:
+        db_session.info[_GENERATION] = cache.generation
+
+
+def _apply_changes(engine: Engine, database_changes: list[changes.Change]) -> None:
+    for cache_engine, cache in list(_identity_caches.items()):
+        cache.apply(database_changes, write_through=cache_engine is engine)
+
+
+changes.add_listener(_apply_changes)
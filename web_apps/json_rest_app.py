@@ -1,131 +1,320 @@
-from fastapi import Depends, FastAPI, HTTPException, Response, status
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request, Response, status
+from fastapi.responses import JSONResponse
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
-
-from . import crud, models, schemas
-from .crud import ConnectionNodeNotFoundError
-from .database import LocalSession, engine
+from starlette.concurrency import run_in_threadpool
+
+from . import adjacency, analytics, crud, identity_cache, models, paths, schemas, suggest, write_queue
+from .crud import ConnectionNodeNotFoundError, DuplicateNodeNameError, DuplicateConnectionError
+from .database import db_file, engine
+from .graph_version import add_conditional_gets
+from .migrations import upgrade_database
+from .name_index import build_name_indexes_if_enabled
+from .pagination import decode_cursor, next_cursor, InvalidCursorError, NEXT_CURSOR_HEADER
+from .schemas import MAX_DELETE_IDS, MAX_NEIGHBOURHOOD_DEPTH, MAX_NEIGHBOURHOOD_LIMIT, MAX_PAGE_LIMIT, MAX_PATH_DEPTH, \
+    MAX_PATH_TIMEOUT_MS
+from .sessions import DatabaseSession, get_db_session, get_read_db_session
+from .write_queue import start_write_queue_if_enabled, WriteQueueFullError
 
 models.Base.metadata.create_all(bind=engine)
+upgrade_database(engine)
+build_name_indexes_if_enabled(engine)
+adjacency.build_adjacency_if_enabled(engine)
+suggest.build_suggest_indexes_if_enabled(engine)
+identity_cache.create_identity_cache_if_enabled(engine)
+start_write_queue_if_enabled(engine)
 
 app = FastAPI()
+# the adjacency's, identity cache's and write queue's stats change without the graph changing
+add_conditional_gets(app, db_file, uncached_path_prefixes=("/adjacency/", "/identity-cache/", "/write-queue/"))
+# the endpoints, included in the app below (and in apps of their own by the tests)
+router = APIRouter()
+
 templates = Jinja2Templates(directory="templates")
 
 
-# Dependency
-def get_db_session():
-    db_session = LocalSession()
-    try:
-        yield db_session
-    finally:
-        db_session.close()
+@app.exception_handler(WriteQueueFullError)
+async def write_queue_full(request: Request, error: WriteQueueFullError):
+    return JSONResponse(status_code=503, content={"detail": "Too many writes queued, try again"})
 
 
-@app.post("/nodes/", response_model=schemas.Node)
-def create_node(node: schemas.NodeCreate, db_session: Session = Depends(get_db_session)):
-    db_node = crud.get_node_by_name(db_session, name=node.name)
-    if db_node:
+@router.post("/nodes/", response_model=schemas.Node)
+async def create_node(node: schemas.NodeCreate, db_session: DatabaseSession = Depends(get_db_session)):
+    db_node = await db_session.write(crud.create_new_node, node=node)
+    if db_node is None:
         raise HTTPException(status_code=400, detail="Node already exists")
-    return crud.create_node(db_session=db_session, node=node)
+    return db_node
+
+
+def get_after_id(after: str | None) -> int | None:
+    try:
+        return decode_cursor(after)
+    except InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 
-@app.get("/nodes/", response_model=list[schemas.Node])
-def get_nodes(like: str = "*", skip: int = 0, limit: int = 100, db_session: Session = Depends(get_db_session)):
+@router.get("/nodes/", response_model=list[schemas.Node])
+async def get_nodes(response: Response, like: str = "*", after: str | None = None, skip: int = Query(0, ge=0),
+                    limit: int = Query(100, ge=1, le=MAX_PAGE_LIMIT),
+                    db_session: DatabaseSession = Depends(get_read_db_session)):
+    after_id = get_after_id(after)
     if like == "*":
-        nodes = crud.get_nodes(db_session, skip=skip, limit=limit)
+        nodes = await db_session.run(crud.get_nodes, skip=skip, limit=limit, after_id=after_id)
     else:
-        nodes = crud.get_nodes_like_name(db_session, like=like, skip=skip, limit=limit)
+        nodes = await db_session.run(crud.get_nodes_like_name, like=like, skip=skip, limit=limit, after_id=after_id)
 
+    cursor = next_cursor(nodes, limit)
+    if cursor:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
     return nodes
 
 
-@app.get("/nodes/{node_id}", response_model=schemas.Node)
-def get_node(node_id: int, db_session: Session = Depends(get_db_session)):
-    db_node = crud.get_node(db_session, node_id=node_id)
+@router.get("/search/nodes", response_model=list[schemas.Node])
+async def search_nodes(q: str, limit: int = Query(100, ge=1, le=MAX_PAGE_LIMIT),
+                       db_session: DatabaseSession = Depends(get_read_db_session)):
+    return await db_session.run(crud.search_nodes, query=q, limit=limit)
+
+
+@router.get("/search/connections", response_model=list[schemas.Connection])
+async def search_connections(q: str, limit: int = Query(100, ge=1, le=MAX_PAGE_LIMIT),
+                             db_session: DatabaseSession = Depends(get_read_db_session)):
+    return await db_session.run(crud.search_connections, query=q, limit=limit)
+
+
+@router.get("/suggest/nodes", response_model=list[schemas.NodeSuggestion])
+async def suggest_nodes(prefix: str, limit: int = Query(10, ge=1, le=suggest.MAX_SUGGESTIONS),
+                        db_session: DatabaseSession = Depends(get_read_db_session)):
+    return await db_session.run(crud.suggest_nodes, prefix, limit)
+
+
+@router.get("/suggest/connection-names", response_model=list[schemas.ConnectionNameSuggestion])
+async def suggest_connection_names(prefix: str, limit: int = Query(10, ge=1, le=suggest.MAX_SUGGESTIONS),
+                                   db_session: DatabaseSession = Depends(get_read_db_session)):
+    return await db_session.run(crud.suggest_connection_names, prefix, limit)
+
+
+@router.get("/nodes/{node_id}", response_model=schemas.Node)
+async def get_node(node_id: int, db_session: DatabaseSession = Depends(get_read_db_session)):
+    db_node = await db_session.run(crud.get_node, node_id=node_id)
     if db_node is None:
         raise HTTPException(status_code=404, detail="Node not found")
     return db_node
 
 
-@app.put("/nodes/{node_id}", response_model=schemas.Node)
-def update_node(node_id: int, node: schemas.NodeCreate, db_session: Session = Depends(get_db_session)):
-    db_node = crud.update_node(db_session, node_id, updated_name=node.name)
+@router.get("/nodes/{node_id}/neighbourhood", response_model=schemas.Neighbourhood)
+async def get_neighbourhood(node_id: int, depth: int = Query(1, ge=1, le=MAX_NEIGHBOURHOOD_DEPTH),
+                            direction: schemas.Direction = schemas.Direction.both,
+                            names: list[str] | None = Query(None),
+                            limit: int = Query(1000, ge=1, le=MAX_NEIGHBOURHOOD_LIMIT),
+                            db_session: DatabaseSession = Depends(get_read_db_session)):
+    neighbourhood = await db_session.run(crud.get_neighbourhood, node_id, depth=depth, direction=direction,
+                                         names=names, limit=limit)
+    if neighbourhood is None:
+        raise HTTPException(status_code=404, detail="Node not found")
+    return neighbourhood
+
+
+@router.put("/nodes/{node_id}", response_model=schemas.Node)
+async def update_node(node_id: int, node: schemas.NodeCreate, db_session: DatabaseSession = Depends(get_db_session)):
+    try:
+        db_node = await db_session.write(crud.update_node, node_id, updated_name=node.name)
+    except DuplicateNodeNameError:
+        raise HTTPException(status_code=400, detail="Node already exists")
     if db_node is None:
         raise HTTPException(status_code=404, detail="Can't update, Node not found")
     return db_node
 
 
-@app.delete("/nodes/{node_id}")
-def delete_node(node_id: int, db_session: Session = Depends(get_db_session)):
-    crud.delete_node(db_session, node_id)
+@router.delete("/nodes/{node_id}")
+async def delete_node(node_id: int, db_session: DatabaseSession = Depends(get_db_session)):
+    await db_session.write(crud.delete_node, node_id)
     return f"deleted, id={node_id}"
 
 
-@app.post("/connections/", response_model=schemas.Connection)
-def create_connection(connection: schemas.ConnectionCreate, db_session: Session = Depends(get_db_session)):
+@router.get("/nodes/{node_id}/impact", response_model=schemas.NodeImpact)
+async def get_node_impact(node_id: int, db_session: DatabaseSession = Depends(get_read_db_session)):
+    if await db_session.run(crud.get_node, node_id=node_id) is None:
+        raise HTTPException(status_code=404, detail="Node not found")
+    return schemas.NodeImpact(node_id=node_id, connection_count=await db_session.run(crud.get_node_impact, node_id))
+
+
+@router.delete("/nodes", response_model=schemas.DeletedNodes)
+async def delete_nodes(ids: list[int] = Query(..., max_items=MAX_DELETE_IDS),
+                       db_session: DatabaseSession = Depends(get_db_session)):
+    deleted_ids, connection_count = await db_session.write(crud.delete_nodes_by_ids, ids)
+    return schemas.DeletedNodes(deleted_ids=deleted_ids, missing_ids=sorted(set(ids).difference(deleted_ids)),
+                                connection_count=connection_count)
+
+
+@router.get("/analytics/top-nodes", response_model=list[schemas.NodeScore])
+async def get_top_nodes(metric: schemas.Metric = schemas.Metric.degree, name: str | None = None,
+                        limit: int = Query(10, ge=1, le=1000),
+                        db_session: DatabaseSession = Depends(get_read_db_session)):
+    return await db_session.run(analytics.get_top_nodes, metric=metric, name=name, limit=limit)
+
+
+@router.get("/paths", response_model=schemas.ShortestPaths)
+async def get_shortest_paths(from_id: int = Query(alias="from"), to_id: int = Query(alias="to"),
+                             max_depth: int = Query(6, ge=1, le=MAX_PATH_DEPTH),
+                             direction: schemas.Direction = schemas.Direction.both,
+                             names: list[str] | None = Query(None),
+                             max_paths: int = Query(10, ge=1, le=100), max_nodes: int = Query(100_000, ge=1),
+                             timeout_ms: int = Query(1000, ge=1, le=MAX_PATH_TIMEOUT_MS),
+                             db_session: DatabaseSession = Depends(get_read_db_session)):
+    for node_id in [from_id, to_id]:
+        if await db_session.run(crud.get_node, node_id) is None:
+            raise HTTPException(status_code=404, detail=f"Node not found, id={node_id}")
+    return await db_session.run(paths.find_shortest_paths, from_id, to_id, max_depth=max_depth, direction=direction,
+                                names=names, max_paths=max_paths, max_nodes=max_nodes, timeout=timeout_ms / 1000)
+
+
+@router.post("/connections/", response_model=schemas.Connection)
+async def create_connection(connection: schemas.ConnectionCreate,
+                            db_session: DatabaseSession = Depends(get_db_session)):
     try:
-        db_connection = crud.create_connection(db_session, connection)
+        db_connection = await db_session.write(crud.create_connection, connection)
     except ConnectionNodeNotFoundError:
         raise HTTPException(status_code=404, detail="Connection node not found")
     return db_connection
 
 
-@app.get("/connections/", response_model=list[schemas.Connection])
-def get_connections(name_like: str = "*", node_id: int = 0, skip: int = 0, limit: int = 100,
-                    db_session: Session = Depends(get_db_session)):
+@router.post("/connections/batch", response_model=schemas.ConnectionBatchResult)
+async def create_connections(connections: list[schemas.ConnectionCreate],
+                             db_session: DatabaseSession = Depends(get_db_session)):
+    try:
+        return await db_session.write(crud.create_connections_bulk, connections)
+    except ConnectionNodeNotFoundError:
+        raise HTTPException(status_code=404, detail="Connection node not found")
+
+
+@router.get("/connections/", response_model=list[schemas.Connection])
+async def get_connections(response: Response, name_like: str = "*", node_id: int = 0, after: str | None = None,
+                          skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_LIMIT),
+                          db_session: DatabaseSession = Depends(get_read_db_session)):
+    after_id = get_after_id(after)
     if node_id > 0:
-        connections = crud.get_connections_to_node(db_session, node_id)
+        connections = await db_session.run(crud.get_connections_to_node, node_id, skip=skip, limit=limit,
+                                           after_id=after_id)
+    elif name_like == "*":
+        connections = await db_session.run(crud.get_connections, skip=skip, limit=limit, after_id=after_id)
     else:
-        if name_like == "*":
-            connections = crud.get_connections(db_session, skip=skip, limit=limit)
-        else:
-            connections = crud.get_connections_like_name(db_session, like=name_like, skip=skip, limit=limit)
-            pass
+        connections = await db_session.run(crud.get_connections_like_name, like=name_like, skip=skip, limit=limit,
+                                           after_id=after_id)
+
+    cursor = next_cursor(connections, limit)
+    if cursor:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
     return connections
 
 
-@app.get("/connections/{connection_id}", response_model=schemas.Connection)
-def get_connection(connection_id: int, db_session: Session = Depends(get_db_session)):
-    db_connection = crud.get_connection(db_session, connection_id=connection_id)
+@router.get("/connections/{connection_id}", response_model=schemas.Connection)
+async def get_connection(connection_id: int, db_session: DatabaseSession = Depends(get_read_db_session)):
+    db_connection = await db_session.run(crud.get_connection, connection_id=connection_id)
     if db_connection is None:
         raise HTTPException(status_code=404, detail="Connection not found")
     return db_connection
 
 
-@app.delete("/connections/{connection_id}", status_code=200)
-def delete_connection(connection_id: int, response: Response, db_session: Session = Depends(get_db_session)):
-    if crud.delete_connection(db_session, connection_id):
+@router.delete("/connections/{connection_id}", status_code=200)
+async def delete_connection(connection_id: int, response: Response,
+                            db_session: DatabaseSession = Depends(get_db_session)):
+    if await db_session.write(crud.delete_connection, connection_id):
         return
     else:
         raise HTTPException(status_code=404)
 
 
-@app.put("/connections/{connection_id}", status_code=200)
-def update_connection(connection_id: int, connection: schemas.ConnectionCreate, response: Response,
-                      db_session: Session = Depends(get_db_session)) -> int:
-    if crud.get_connection(db_session, connection_id) is None:
+@router.put("/connections/{connection_id}", status_code=200)
+async def update_connection(connection_id: int, connection: schemas.ConnectionCreate, response: Response,
+                            db_session: DatabaseSession = Depends(get_db_session)) -> int:
+    try:
+        db_connection, created = await db_session.write(crud.upsert_connection, connection_id,
+                                                        updated_connection=connection)
+    except DuplicateConnectionError:
+        raise HTTPException(status_code=400, detail="Connection already exists")
+    if created:
         response.status_code = status.HTTP_201_CREATED
-    db_connection = crud.update_connection(db_session, connection_id, updated_connection=connection)
     return db_connection.id
 
 
-@app.get("/stats/", status_code=200)
-def get_database_stats(db_session: Session = Depends(get_db_session)):
-    stats = {"node_count": crud.get_table_size(db_session, models.Node),
-             "connection_count": crud.get_table_size(db_session, models.Connection)}
+@router.get("/stats/", status_code=200, response_model=schemas.DatabaseStats, response_model_exclude_none=True)
+async def get_database_stats(db_session: DatabaseSession = Depends(get_read_db_session), detail: bool = False):
+    return await db_session.run(crud.get_database_stats, detail=detail)
+
+
+def get_adjacency(db_session: DatabaseSession) -> adjacency.Adjacency:
+    db_adjacency = adjacency.get_adjacency(db_session.sync_session)
+    if db_adjacency is None:
+        raise HTTPException(status_code=404, detail="Adjacency not built")
+    return db_adjacency
+
+
+@router.get("/adjacency/", response_model=schemas.AdjacencyStats)
+async def get_adjacency_stats(db_session: DatabaseSession = Depends(get_read_db_session)):
+    return get_adjacency(db_session).stats()
+
 
-    return stats
+@router.post("/adjacency/rebuild", response_model=schemas.AdjacencyStats)
+async def rebuild_adjacency(db_session: DatabaseSession = Depends(get_db_session)):
+    """
+    Load the adjacency from the database, building it if it hasn't been
+    """
+    return (await run_in_threadpool(adjacency.build_adjacency, db_session.engine)).stats()
 
 
-@app.delete("/connections/", status_code=200)
-def delete_all_connections(db_session: Session = Depends(get_db_session)):
-    num_connections_deleted = crud.delete_connections(db_session)
+@router.post("/adjacency/refresh", response_model=schemas.AdjacencyStats)
+async def refresh_adjacency(db_session: DatabaseSession = Depends(get_db_session)):
+    """
+    Compact the adjacency's recent writes into its CSR arrays
+    """
+    db_adjacency = get_adjacency(db_session)
+    await run_in_threadpool(db_adjacency.compact)
+    return db_adjacency.stats()
+
+
+@router.get("/identity-cache/", response_model=schemas.IdentityCacheStats)
+async def get_identity_cache_stats(db_session: DatabaseSession = Depends(get_read_db_session)):
+    cache = identity_cache.get_identity_cache(db_session.sync_session)
+    if cache is None:
+        raise HTTPException(status_code=404, detail="Identity cache not created")
+    return cache.stats()
+
+
+@router.get("/write-queue/", response_model=schemas.WriteQueueStats)
+async def get_write_queue_stats(db_session: DatabaseSession = Depends(get_read_db_session)):
+    db_write_queue = write_queue.get_write_queue(db_session.sync_session)
+    if db_write_queue is None:
+        raise HTTPException(status_code=404, detail="Write queue not started")
+    return db_write_queue.stats()
+
+
+def reject_ids(request: Request, ids: list[int] | None = Query(None, include_in_schema=False)) -> None:
+    """
+    For the routes deleting every row, which differ from those deleting the given ids only by their trailing slash
+    """
+    if ids is not None:
+        raise HTTPException(status_code=400,
+                            detail=f"Would delete everything, use {request.url.path.rstrip('/')}?ids= for the ids")
+
+
+@router.delete("/connections/", status_code=200, dependencies=[Depends(reject_ids)])
+async def delete_all_connections(db_session: DatabaseSession = Depends(get_db_session)):
+    num_connections_deleted = await db_session.write(crud.delete_connections)
     return {"message": f"deleted {num_connections_deleted} connections"}
 
 
-@app.delete("/nodes/", status_code=200)
-def delete_all_nodes(db_session: Session = Depends(get_db_session)):
-    num_connections_deleted = crud.delete_connections(db_session)
-    num_nodes_deleted = crud.delete_nodes(db_session)
+@router.delete("/connections", response_model=schemas.DeletedConnections)
+async def delete_connections(ids: list[int] = Query(..., max_items=MAX_DELETE_IDS),
+                             db_session: DatabaseSession = Depends(get_db_session)):
+    missing_ids = await db_session.write(crud.delete_connections_by_ids, ids)
+    return schemas.DeletedConnections(deleted_ids=sorted(set(ids).difference(missing_ids)), missing_ids=missing_ids)
+
+
+@router.delete("/nodes/", status_code=200, dependencies=[Depends(reject_ids)])
+async def delete_all_nodes(db_session: DatabaseSession = Depends(get_db_session)):
+    # deleting the nodes would take the connections with them, but this way they're counted
+    num_connections_deleted = await db_session.write(crud.delete_connections)
+    num_nodes_deleted = await db_session.write(crud.delete_nodes)
     return {"message": f"deleted {num_nodes_deleted} nodes and {num_connections_deleted} connections"}
 
+
+app.include_router(router)
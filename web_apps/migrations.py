@@ -0,0 +1,232 @@
+"""
+Bring an existing database file (e.g. live.db) up to date with the models.
+
+models.Base.metadata.create_all() only creates missing tables, so any column, index or data change to an existing
+table needs a step here. Every step checks the current schema first and is safe to run on every startup.
+"""
+from sqlalchemy import Connection, Engine, inspect, text
+
+from . import models
+
+
+def _column_names(db_connection: Connection, table_name: str) -> set[str]:
+    return {column["name"] for column in inspect(db_connection).get_columns(table_name)}
+
+
+def add_normalized_node_names(db_connection: Connection) -> None:
+    """
+    Add and backfill nodes.name_normalized.
+
+    Nodes whose names only differ by case or surrounding whitespace are merged into the one with the lowest id
+    (their connections are moved across) so that the unique index can be built.
+    """
+    if "name_normalized" in _column_names(db_connection, "nodes"):
+        return
+
+    # SQLite can't add a NOT NULL column without a default, so the migrated column stays nullable
+    db_connection.execute(text("ALTER TABLE nodes ADD COLUMN name_normalized VARCHAR"))
+
+    kept_node_ids: dict[str, int] = {}
+    for node_id, name in db_connection.execute(text("SELECT id, name FROM nodes ORDER BY id")).all():
+        name_normalized = models.normalize_name(name)
+        kept_node_id = kept_node_ids.setdefault(name_normalized, node_id)
+        if kept_node_id == node_id:
+            db_connection.execute(text("UPDATE nodes SET name_normalized = :name_normalized WHERE id = :id"),
+                                  {"name_normalized": name_normalized, "id": node_id})
+        else:
+            params = {"kept_id": kept_node_id, "id": node_id}
+            db_connection.execute(text("UPDATE connections SET subject_id = :kept_id WHERE subject_id = :id"), params)
+            db_connection.execute(text("UPDATE connections SET target_id = :kept_id WHERE target_id = :id"), params)
+            db_connection.execute(text("DELETE FROM nodes WHERE id = :id"), params)
+
+
+def make_connections_unique(db_connection: Connection) -> None:
+    """
+    Remove repeated (subject, name, target) connections, keeping the lowest id, and rebuild their index as unique
+    """
+    indexes = {index["name"]: index for index in inspect(db_connection).get_indexes("connections")}
+    index = indexes.get("ix_connections_subject_id_name_target_id")
+    if index is not None and index["unique"]:
+        return
+
+    db_connection.execute(text("""
+        DELETE FROM connections WHERE id NOT IN (
+            SELECT MIN(id) FROM connections GROUP BY subject_id, name, target_id
+        )
+    """))
+    db_connection.execute(text("DROP INDEX IF EXISTS ix_connections_subject_id_name_target_id"))
+
+
+def cascade_connection_deletes(db_connection: Connection) -> None:
+    """
+    Rebuild the connections table with ON DELETE CASCADE foreign keys, as SQLite can't alter a table's constraints.
+
+    Connections to nodes that no longer exist are deleted first (through any triggers, so the tables they keep up
+    to date stay right), and the table's indexes and triggers are recreated afterwards.
+    """
+    foreign_keys = inspect(db_connection).get_foreign_keys("connections")
+    if foreign_keys and all(foreign_key["options"].get("ondelete") == "CASCADE" for foreign_key in foreign_keys):
+        return
+
+    db_connection.execute(text("""
+        DELETE FROM connections
+        WHERE subject_id NOT IN (SELECT id FROM nodes) OR target_id NOT IN (SELECT id FROM nodes)
+    """))
+    indexes_and_triggers = db_connection.execute(text("""
+        SELECT sql FROM sqlite_master WHERE tbl_name = 'connections' AND type IN ('index', 'trigger') AND sql NOT NULL
+    """)).scalars().all()
+
+    for statement in [
+        """CREATE TABLE connections_cascading (
+               id INTEGER NOT NULL,
+               name VARCHAR NOT NULL,
+               subject_id INTEGER NOT NULL,
+               target_id INTEGER NOT NULL,
+               PRIMARY KEY (id),
+               FOREIGN KEY(subject_id) REFERENCES nodes (id) ON DELETE CASCADE,
+               FOREIGN KEY(target_id) REFERENCES nodes (id) ON DELETE CASCADE
+           )""",
+        """INSERT INTO connections_cascading (id, name, subject_id, target_id)
+           SELECT id, name, subject_id, target_id FROM connections""",
+        "DROP TABLE connections",
+        "ALTER TABLE connections_cascading RENAME TO connections",
+    ] + list(indexes_and_triggers):
+        db_connection.execute(text(statement))
+
+
+def add_name_search_tables(db_connection: Connection) -> None:
+    """
+    Create the FTS5 trigram tables used by search.py over node and connection names, with triggers to keep them
+    in step with their tables, and index the names already there
+    """
+    existing_table_names = inspect(db_connection).get_table_names()
+    for table_name in ["nodes", "connections"]:
+        fts_table_name = f"{table_name}_fts"
+        if fts_table_name in existing_table_names:
+            continue
+
+        for statement in [
+            f"""CREATE VIRTUAL TABLE {fts_table_name} USING fts5(
+                    name, content='{table_name}', content_rowid='id', tokenize='trigram'
+                )""",
+            f"""CREATE TRIGGER {fts_table_name}_insert AFTER INSERT ON {table_name} BEGIN
+                    INSERT INTO {fts_table_name} (rowid, name) VALUES (new.id, new.name);
+                END""",
+            f"""CREATE TRIGGER {fts_table_name}_delete AFTER DELETE ON {table_name} BEGIN
+                    INSERT INTO {fts_table_name} ({fts_table_name}, rowid, name) VALUES ('delete', old.id, old.name);
+                END""",
+            f"""CREATE TRIGGER {fts_table_name}_update AFTER UPDATE OF name ON {table_name} BEGIN
+                    INSERT INTO {fts_table_name} ({fts_table_name}, rowid, name) VALUES ('delete', old.id, old.name);
+                    INSERT INTO {fts_table_name} (rowid, name) VALUES (new.id, new.name);
+                END""",
+            f"INSERT INTO {fts_table_name} ({fts_table_name}) VALUES ('rebuild')",
+        ]:
+            db_connection.execute(text(statement))
+
+
+def create_missing_indexes(db_connection: Connection) -> None:
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db_connection, checkfirst=True)
+
+
+def _count_connection_end(node_id: str, change: int) -> list[str]:
+    """
+    Statements for a connection trigger that add change (1 or -1) to the degree of the node at one end of it
+    """
+    if change > 0:
+        return [
+            f"""UPDATE database_stats SET value = value + 1 WHERE name = 'connected_node_count'
+                AND NOT EXISTS (SELECT 1 FROM node_degrees WHERE node_id = {node_id});""",
+            f"""INSERT INTO node_degrees (node_id, degree) VALUES ({node_id}, 1)
+                ON CONFLICT (node_id) DO UPDATE SET degree = degree + 1;""",
+        ]
+    return [
+        f"UPDATE node_degrees SET degree = degree - 1 WHERE node_id = {node_id};",
+        f"""UPDATE database_stats SET value = value - 1 WHERE name = 'connected_node_count'
+            AND EXISTS (SELECT 1 FROM node_degrees WHERE node_id = {node_id} AND degree = 0);""",
+        f"DELETE FROM node_degrees WHERE node_id = {node_id} AND degree = 0;",
+    ]
+
+
+def _count_connection(row: str, change: int) -> list[str]:
+    """
+    Statements for a connection trigger that add or remove (change 1 or -1) the new or old row in the stats
+    """
+    statements = [f"UPDATE database_stats SET value = value + {change} WHERE name = 'connection_count';"]
+    if change > 0:
+        statements.append(f"""INSERT INTO connection_name_counts (name, count) VALUES ({row}.name, 1)
+                              ON CONFLICT (name) DO UPDATE SET count = count + 1;""")
+    else:
+        statements += [
+            f"UPDATE connection_name_counts SET count = count - 1 WHERE name = {row}.name;",
+            f"DELETE FROM connection_name_counts WHERE name = {row}.name AND count = 0;",
+        ]
+    return statements + _count_connection_end(f"{row}.subject_id", change) + _count_connection_end(
+        f"{row}.target_id", change)
+
+
+def add_database_stats_tables(db_connection: Connection) -> None:
+    """
+    Create the tables behind crud.get_database_stats and the triggers that keep them up to date, and fill them in:
+
+    - database_stats: node_count, connection_count and connected_node_count (nodes with at least one connection)
+    - connection_name_counts: how many connections have each name
+    - node_degrees: how many connections each connected node is in (indexed, so the highest is one lookup)
+
+    A node's degree row goes when the node is deleted, whether or not its connections go first.
+    """
+    if "database_stats" in inspect(db_connection).get_table_names():
+        return
+
+    triggers = {
+        "nodes_stats_insert": ("AFTER INSERT ON nodes", [
+            "UPDATE database_stats SET value = value + 1 WHERE name = 'node_count';",
+        ]),
+        "nodes_stats_delete": ("AFTER DELETE ON nodes", [
+            "UPDATE database_stats SET value = value - 1 WHERE name = 'node_count';",
+            """UPDATE database_stats SET value = value - 1 WHERE name = 'connected_node_count'
+               AND EXISTS (SELECT 1 FROM node_degrees WHERE node_id = old.id);""",
+            "DELETE FROM node_degrees WHERE node_id = old.id;",
+        ]),
+        "connections_stats_insert": ("AFTER INSERT ON connections", _count_connection("new", 1)),
+        "connections_stats_delete": ("AFTER DELETE ON connections", _count_connection("old", -1)),
+        "connections_stats_update": ("AFTER UPDATE OF name, subject_id, target_id ON connections",
+                                     _count_connection("old", -1) + _count_connection("new", 1)),
+    }
+
+    for statement in [
+        "CREATE TABLE database_stats (name VARCHAR PRIMARY KEY, value INTEGER NOT NULL)",
+        "CREATE TABLE connection_name_counts (name VARCHAR PRIMARY KEY, count INTEGER NOT NULL)",
+        "CREATE TABLE node_degrees (node_id INTEGER PRIMARY KEY, degree INTEGER NOT NULL)",
+        "CREATE INDEX ix_node_degrees_degree ON node_degrees (degree)",
+        """INSERT INTO node_degrees (node_id, degree)
+           SELECT node_id, COUNT(*) FROM (
+               SELECT subject_id AS node_id FROM connections UNION ALL SELECT target_id FROM connections
+           ) WHERE node_id IN (SELECT id FROM nodes) GROUP BY node_id""",
+        """INSERT INTO connection_name_counts (name, count) SELECT name, COUNT(*) FROM connections GROUP BY name""",
+        """INSERT INTO database_stats (name, value) VALUES
+               ('node_count', (SELECT COUNT(*) FROM nodes)),
+               ('connection_count', (SELECT COUNT(*) FROM connections)),
+               ('connected_node_count', (SELECT COUNT(*) FROM node_degrees))""",
+    ] + [
+        f"CREATE TRIGGER {trigger_name} {event} BEGIN\n" + "\n".join(statements) + "\nEND"
+        for trigger_name, (event, statements) in triggers.items()
+    ]:
+        db_connection.execute(text(statement))
+
+
+MIGRATIONS = [
+    add_normalized_node_names,
+    make_connections_unique,
+    cascade_connection_deletes,
+    create_missing_indexes,
+    add_name_search_tables,
+    add_database_stats_tables,
+]
+
+
+def upgrade_database(engine: Engine) -> None:
+    with engine.begin() as db_connection:
+        for migration in MIGRATIONS:
+            migration(db_connection)
@@ -1,14 +1,21 @@
 from typing import Any
 
-from sqlalchemy import ForeignKey, func
+from sqlalchemy import ForeignKey, Index, func
 from sqlalchemy.ext.hybrid import Comparator, hybrid_property
-from sqlalchemy.orm import relationship, mapped_column, Mapped, DeclarativeBase
+from sqlalchemy.orm import relationship, mapped_column, Mapped, DeclarativeBase, validates
 
 
 class Base(DeclarativeBase):
     pass
 
 
+def normalize_name(name: str) -> str:
+    """
+    The form of a node name used for case-insensitive lookups, e.g. "  Chief ENGINEER " -> "chief engineer"
+    """
+    return name.strip().casefold()
+
+
 class CaseInsensitiveComparator(Comparator[str]):
     """
     Copied this from https://docs.sqlalchemy.org/en/20/orm/extensions/hybrid.html#building-custom-comparators
@@ -18,40 +25,61 @@ class CaseInsensitiveComparator(Comparator[str]):
         return func.lower(self.__clause_element__()) == func.lower(other)
 
 
+class NormalizedNameComparator(Comparator[str]):
+    """
+    Compares against a column that already holds normalized names, so the lookup can use the column's index
+    """
+
+    def __eq__(self, other: Any) -> bool:  # type: ignore[override]  # noqa: E501
+        return self.__clause_element__() == normalize_name(other)
+
+
 class Node(Base):
     __tablename__ = "nodes"
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column()
+    name_normalized: Mapped[str] = mapped_column(unique=True, index=True)
 
     def __repr__(self):
         return f"Node(id={self.id}, name={self.name!r})"
 
-    """
-     Copied this from https://docs.sqlalchemy.org/en/20/orm/extensions/hybrid.html#building-custom-comparators
-     """
+    @validates("name")
+    def _normalize_name(self, key: str, name: str) -> str:
+        self.name_normalized = normalize_name(name)
+        return name
 
     @hybrid_property
     def name_insensitive(self) -> str:
-        return self.name.lower()
+        return normalize_name(self.name)
 
     @name_insensitive.inplace.comparator
     @classmethod
-    def _name_insensitive_comparator(cls) -> CaseInsensitiveComparator:
-        return CaseInsensitiveComparator(cls.name)
+    def _name_insensitive_comparator(cls) -> NormalizedNameComparator:
+        return NormalizedNameComparator(cls.name_normalized)
 
 
 class Connection(Base):
     __tablename__ = "connections"
+    __table_args__ = (
+        # cover lookups and deletes from either end of a connection, and by name.
+        # The first also makes each (subject, name, target) unique
+        Index("ix_connections_subject_id_name_target_id", "subject_id", "name", "target_id", unique=True),
+        Index("ix_connections_target_id_name_subject_id", "target_id", "name", "subject_id"),
+        Index("ix_connections_name", "name"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column()
 
-    subject_id: Mapped[int] = mapped_column(ForeignKey("nodes.id"))
-    target_id: Mapped[int] = mapped_column(ForeignKey("nodes.id"))
+    # deleting a node deletes its connections (SQLite only does this with PRAGMA foreign_keys on,
+    # which database.EngineProfile sets on each connection)
+    subject_id: Mapped[int] = mapped_column(ForeignKey("nodes.id", ondelete="CASCADE"))
+    target_id: Mapped[int] = mapped_column(ForeignKey("nodes.id", ondelete="CASCADE"))
 
-    subject: Mapped["Node"] = relationship(foreign_keys=[subject_id])
-    target: Mapped["Node"] = relationship(foreign_keys=[target_id])
+    # crud loads these eagerly (see crud.CONNECTION_NODES), so a lazy load here is an N+1 query bug
+    subject: Mapped["Node"] = relationship(foreign_keys=[subject_id], lazy="raise")
+    target: Mapped["Node"] = relationship(foreign_keys=[target_id], lazy="raise")
 
     # target: Mapped["Node"] = relationship()
 
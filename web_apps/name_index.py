@@ -0,0 +1,190 @@
+"""
+Optional in-process trigram index over node and connection names, for substring searches that don't touch SQLite.
+
+Each NameIndex maps every trigram to the distinct (casefolded) names containing it, and each name to the ids of the
+rows with that name. A search intersects the posting lists of the term's trigrams, checks the candidate names really
+contain the term, and returns the ids, which crud then fetches by primary key.
+
+The indexes are built per engine with build_name_indexes() (the apps do this at startup when KNOWLEDGE_NAME_INDEX
+is set) and then kept up to date from the changes crud publishes. An index that would grow past its memory budget
+(KNOWLEDGE_NAME_INDEX_MAX_MB) empties itself and stops answering, as does any search for a term shorter than a
+trigram, and crud falls back to searching in SQL.
+"""
+import os
+from threading import RLock
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import Engine, select
+from sqlalchemy.orm import Session
+
+from . import changes, models
+
+NGRAM_LENGTH = 3
+
+# rough costs of the index's Python objects, to hold it to its memory budget
+BYTES_PER_POSTING = 64
+BYTES_PER_ID = 128
+
+
+def name_index_enabled() -> bool:
+    return os.environ.get("KNOWLEDGE_NAME_INDEX", default="0").lower() in ("1", "true", "yes", "on")
+
+
+def name_index_max_bytes() -> int:
+    return int(os.environ.get("KNOWLEDGE_NAME_INDEX_MAX_MB", default="256")) * 1024 * 1024
+
+
+def ngrams(name: str) -> set[str]:
+    return {name[start:start + NGRAM_LENGTH] for start in range(len(name) - NGRAM_LENGTH + 1)}
+
+
+class NameIndex:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # searches run on the request threads while the writes' changes are applied
+        self.lock = RLock()
+        self.over_budget = False
+        self.names_by_ngram: dict[str, set[str]] = {}
+        self.ids_by_name: dict[str, set[int]] = {}
+        self.name_by_id: dict[int, str] = {}
+        self.posting_count = 0
+
+    @property
+    def approximate_bytes(self) -> int:
+        return self.posting_count * BYTES_PER_POSTING + len(self.name_by_id) * BYTES_PER_ID
+
+    def add(self, row_id: int, name: str) -> None:
+        with self.lock:
+            if self.over_budget:
+                return
+            self.remove(row_id)
+
+            name = name.casefold()
+            self.name_by_id[row_id] = name
+            ids = self.ids_by_name.setdefault(name, set())
+            if not ids:
+                for ngram in ngrams(name):
+                    self.names_by_ngram.setdefault(ngram, set()).add(name)
+                    self.posting_count += 1
+            ids.add(row_id)
+
+            if self.approximate_bytes > self.max_bytes:
+                self.clear()
+                self.over_budget = True
+
+    def remove(self, row_id: int) -> None:
+        with self.lock:
+            name = self.name_by_id.pop(row_id, None)
+            if name is None:
+                return
+
+            ids = self.ids_by_name[name]
+            ids.discard(row_id)
+            if not ids:
+                del self.ids_by_name[name]
+                for ngram in ngrams(name):
+                    names = self.names_by_ngram[ngram]
+                    names.discard(name)
+                    self.posting_count -= 1
+                    if not names:
+                        del self.names_by_ngram[ngram]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.names_by_ngram.clear()
+            self.ids_by_name.clear()
+            self.name_by_id.clear()
+            self.posting_count = 0
+
+    def search(self, like: str) -> list[int] | None:
+        """
+        The ids, in order, of rows whose name contains like (ignoring case),
+        or None if the index can't answer and the search should be done in SQL
+        """
+        like = like.casefold()
+        if self.over_budget or len(like) < NGRAM_LENGTH:
+            return None
+
+        with self.lock:
+            posting_lists = sorted((self.names_by_ngram.get(ngram, set()) for ngram in ngrams(like)), key=len)
+            candidate_names = set(posting_lists[0]).intersection(*posting_lists[1:])
+
+            ids = set()
+            for name in candidate_names:
+                if like in name:
+                    ids.update(self.ids_by_name[name])
+        return sorted(ids)
+
+
+class NameIndexes:
+    def __init__(self, max_bytes: int):
+        self.lock = RLock()
+        self.nodes = NameIndex(max_bytes)
+        self.connections = NameIndex(max_bytes)
+
+    def load(self, engine: Engine) -> None:
+        # holding both indexes' locks, so a search never sees one part way through loading
+        with self.lock, self.nodes.lock, self.connections.lock, Session(engine) as db_session:
+            self.nodes.clear()
+            self.connections.clear()
+            for node_id, name in db_session.execute(select(models.Node.id, models.Node.name)).yield_per(10_000):
+                self.nodes.add(node_id, name)
+            for connection_id, name in db_session.execute(
+                    select(models.Connection.id, models.Connection.name)).yield_per(10_000):
+                self.connections.add(connection_id, name)
+
+    def apply(self, engine: Engine, database_changes: list[changes.Change]) -> None:
+        with self.lock:
+            for change in database_changes:
+                match change:
+                    case changes.NodeWritten(node_id, name):
+                        self.nodes.add(node_id, name)
+                    case changes.NodesDeleted(node_ids):
+                        for node_id in node_ids:
+                            self.nodes.remove(node_id)
+                    case changes.ConnectionWritten(connection_id, name):
+                        self.connections.add(connection_id, name)
+                    case changes.ConnectionsDeleted(connection_ids):
+                        for connection_id in connection_ids:
+                            self.connections.remove(connection_id)
+                    case changes.TableCleared("nodes"):
+                        self.nodes.clear()
+                    case changes.TableCleared("connections"):
+                        self.connections.clear()
+                    case changes.DatabaseReloaded():
+                        self.load(engine)
+
+
+_name_indexes: WeakKeyDictionary[Engine, NameIndexes] = WeakKeyDictionary()
+
+
+def build_name_indexes(engine: Engine, max_bytes: int | None = None) -> NameIndexes:
+    """
+    Load the indexes for this engine's database and keep them up to date from then on
+    """
+    name_indexes = NameIndexes(name_index_max_bytes() if max_bytes is None else max_bytes)
+    name_indexes.load(engine)
+    _name_indexes[engine] = name_indexes
+    return name_indexes
+
+
+def build_name_indexes_if_enabled(engine: Engine) -> None:
+    if name_index_enabled() and engine not in _name_indexes:
+        build_name_indexes(engine)
+
+
+def drop_name_indexes(engine: Engine) -> None:
+    _name_indexes.pop(engine, None)
+
+
+def get_name_indexes(db_session: Session) -> NameIndexes | None:
+    return _name_indexes.get(changes.engine_of(db_session))
+
+
+def _apply_changes(engine: Engine, database_changes: list[changes.Change]) -> None:
+    name_indexes = _name_indexes.get(engine)
+    if name_indexes is not None:
+        name_indexes.apply(engine, database_changes)
+
+
+changes.add_listener(_apply_changes)
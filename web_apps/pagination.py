@@ -0,0 +1,40 @@
+"""
+Opaque cursors for keyset pagination.
+
+Lists are ordered by id, so a cursor is just the last id on the page. It is base64 encoded so clients treat it as a
+token to hand back rather than a number to do arithmetic on.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+
+# list endpoints return the cursor for the next page in this header, keeping the response body a plain list
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+class InvalidCursorError(Exception):
+    pass
+
+
+def encode_cursor(last_id: int) -> str:
+    return urlsafe_b64encode(f"id:{last_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str | None) -> int | None:
+    if cursor is None:
+        return None
+    try:
+        prefix, last_id = urlsafe_b64decode(cursor.encode()).decode().split(":")
+        if prefix != "id":
+            raise ValueError(prefix)
+        return int(last_id)
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursorError(f"cursor: {cursor}")
+
+
+def next_cursor(page: list, limit: int) -> str | None:
+    """
+    The cursor for the page after this one, or None if this page is the last
+    """
+    if not page or len(page) < limit:
+        return None
+    return encode_cursor(page[-1].id)
@@ -0,0 +1,155 @@
+"""
+Shortest paths between two nodes by bidirectional breadth-first search.
+
+The search grows a tree from each end, always extending the one with the smaller frontier by a whole level, and
+fetches a level's connections all at once rather than one query per node: from the adjacency arrays if they've been
+built (see adjacency.py), otherwise in one query (crud.get_adjacent_connections). It stops at the first level where
+the trees meet, which is the shortest distance, and then pieces together every shortest path through the meeting
+nodes. The node budget and deadline are checked as a level is extended, not only between levels, so one level out of
+a hub can't run far past either; a big frontier's connections are fetched in chunks to check the deadline between.
+"""
+import time
+from itertools import islice
+from typing import Callable, Iterator
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from . import crud, models, schemas
+from .adjacency import get_adjacency
+
+# (node_id, connection_id, neighbour_id) for each connection from the nodes, in the direction given
+AdjacentConnections = Callable[[set[int], schemas.Direction], list[tuple[int, int, int]]]
+
+# frontier nodes whose connections are fetched at once
+FRONTIER_CHUNK_SIZE = 1000
+# connections taken in between looking at the clock
+CONNECTIONS_PER_DEADLINE_CHECK = 1000
+
+REVERSED = {
+    schemas.Direction.outgoing: schemas.Direction.incoming,
+    schemas.Direction.incoming: schemas.Direction.outgoing,
+    schemas.Direction.both: schemas.Direction.both,
+}
+
+
+class SearchTree:
+    """
+    The nodes reached from one end, with every (parent, connection) that reaches each of them at its distance
+    """
+
+    def __init__(self, root_id: int, direction: schemas.Direction):
+        self.direction = direction
+        self.depth = 0
+        self.distances = {root_id: 0}
+        self.parents: dict[int, list[tuple[int, int]]] = {root_id: []}
+        self.frontier = {root_id}
+
+    def extend(self, adjacent_connections: AdjacentConnections, max_nodes: int, deadline: float) -> bool:
+        """
+        Extend the tree by a level, or give up part way (returning False) once it has more than max_nodes nodes or
+        the deadline has passed
+        """
+        self.depth += 1
+        next_frontier = set()
+        frontier = sorted(self.frontier)
+        for start in range(0, len(frontier), FRONTIER_CHUNK_SIZE):
+            if time.monotonic() > deadline:
+                return False
+            # sorted (as the chunks are) so the paths come out in the same order whichever way the connections
+            # were found
+            connections = sorted(adjacent_connections(set(frontier[start:start + FRONTIER_CHUNK_SIZE]), self.direction))
+            for count, (node_id, connection_id, neighbour_id) in enumerate(connections, 1):
+                distance = self.distances.setdefault(neighbour_id, self.depth)
+                if distance == self.depth:
+                    self.parents.setdefault(neighbour_id, []).append((node_id, connection_id))
+                    next_frontier.add(neighbour_id)
+                if len(self.distances) > max_nodes or (count % CONNECTIONS_PER_DEADLINE_CHECK == 0 and
+                                                       time.monotonic() > deadline):
+                    return False
+        self.frontier = next_frontier
+        return True
+
+    def routes(self, node_id: int) -> Iterator[list[tuple[int, int]]]:
+        """
+        Each shortest route from the root to the node, as the (node, connection) steps leading out of the root
+        """
+        if not self.parents[node_id]:
+            yield []
+        for parent_id, connection_id in self.parents[node_id]:
+            for route in self.routes(parent_id):
+                yield route + [(parent_id, connection_id)]
+
+
+def find_shortest_paths(db_session: Session, from_id: int, to_id: int, max_depth: int,
+                        direction: schemas.Direction = schemas.Direction.both, names: list[str] | None = None,
+                        max_paths: int = 10, max_nodes: int = 100_000,
+                        timeout: float = 1.0) -> schemas.ShortestPaths:
+    """
+    Up to max_paths of the shortest paths from one node to the other, of at most max_depth connections.
+    The search gives up once it has reached max_nodes nodes or run for timeout seconds.
+    """
+    adjacency = get_adjacency(db_session)
+    if adjacency is not None:
+        name_ids = adjacency.name_ids_for(names) if names else None
+
+        def adjacent_connections(node_ids: set[int], step_direction: schemas.Direction) -> list[tuple[int, int, int]]:
+            return adjacency.adjacent(np.fromiter(node_ids, np.int64, len(node_ids)), step_direction,
+                                      name_ids).tolist()
+    else:
+        def adjacent_connections(node_ids: set[int], step_direction: schemas.Direction) -> list[tuple[int, int, int]]:
+            return [tuple(row) for row in crud.get_adjacent_connections(db_session, node_ids, step_direction, names)]
+
+    deadline = time.monotonic() + timeout
+    forward = SearchTree(from_id, direction)
+    backward = SearchTree(to_id, REVERSED[direction])
+
+    meeting_ids = {from_id} & {to_id}
+    while not meeting_ids and forward.frontier and backward.frontier and forward.depth + backward.depth < max_depth:
+        tree = forward if len(forward.frontier) <= len(backward.frontier) else backward
+        other_tree = backward if tree is forward else forward
+        if not tree.extend(adjacent_connections, max_nodes - len(other_tree.distances), deadline):
+            return schemas.ShortestPaths(paths=[], exhausted=True)
+        meeting_ids = tree.frontier & other_tree.distances.keys()
+        if meeting_ids:
+            length = min(forward.distances[node_id] + backward.distances[node_id] for node_id in meeting_ids)
+            meeting_ids = {node_id for node_id in meeting_ids
+                           if forward.distances[node_id] + backward.distances[node_id] == length}
+
+    routes = islice(((forward_route, backward_route)
+                     for meeting_id in sorted(meeting_ids)
+                     for forward_route in forward.routes(meeting_id)
+                     for backward_route in backward.routes(meeting_id)), max_paths)
+    return schemas.ShortestPaths(paths=load_paths(db_session, from_id, list(routes)), exhausted=False)
+
+
+def load_paths(db_session: Session, from_id: int,
+               routes: list[tuple[list[tuple[int, int]], list[tuple[int, int]]]]) -> list[schemas.Path]:
+    """
+    Fetch the nodes and connections along each (forward route, backward route) pair meeting in the middle
+    """
+    paths_connection_ids = [[connection_id for _, connection_id in forward_route] +
+                            [connection_id for _, connection_id in reversed(backward_route)]
+                            for forward_route, backward_route in routes]
+
+    connection_ids = sorted({connection_id for ids in paths_connection_ids for connection_id in ids})
+    connections = crud.get_by_ids(db_session, select(models.Connection), models.Connection.id, connection_ids)
+    node_ids = {from_id}
+    for connection in connections:
+        node_ids.update((connection.subject_id, connection.target_id))
+    nodes = {node.id: node for node in crud.get_by_ids(db_session, select(models.Node), models.Node.id,
+                                                       sorted(node_ids))}
+    connections = {connection.id: crud.with_nodes(connection, nodes[connection.subject_id],
+                                                  nodes[connection.target_id]) for connection in connections}
+
+    paths = []
+    for connection_ids in paths_connection_ids:
+        path_node_ids = [from_id]
+        for connection_id in connection_ids:
+            connection = connections[connection_id]
+            path_node_ids.append(connection.target_id if connection.subject_id == path_node_ids[-1]
+                                 else connection.subject_id)
+        paths.append(schemas.Path(nodes=[nodes[node_id] for node_id in path_node_ids],
+                                  connections=[connections[connection_id] for connection_id in connection_ids]))
+    return paths
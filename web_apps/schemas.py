@@ -1,5 +1,15 @@
+from enum import Enum
+
 from pydantic import BaseModel
 
+# limits on what one request to the json app can ask for
+MAX_NEIGHBOURHOOD_DEPTH = 6
+MAX_NEIGHBOURHOOD_LIMIT = 10_000
+MAX_PATH_DEPTH = 12
+MAX_PATH_TIMEOUT_MS = 30_000
+MAX_DELETE_IDS = 10_000
+MAX_PAGE_LIMIT = 1000
+
 
 class NodeBase(BaseModel):
     name: str
@@ -33,3 +43,105 @@ class Connection(ConnectionBase):  # this is a fully-populated valid connection
 
     class Config:
         orm_mode = True
+
+
+class ConnectionBatchResult(BaseModel):
+    created: int
+    existing: int
+
+
+class NodeSuggestion(Node):
+    degree: int
+
+
+class ConnectionNameSuggestion(BaseModel):
+    name: str
+    count: int
+
+
+class Direction(str, Enum):
+    outgoing = "out"  # from subject to target
+    incoming = "in"  # from target to subject
+    both = "both"
+
+
+class NeighbourhoodNode(Node):
+    depth: int  # the fewest connections from the starting node
+
+
+class Neighbourhood(BaseModel):
+    nodes: list[NeighbourhoodNode]
+    connections: list[Connection]
+    truncated: bool  # the walk stopped at its limit, so there may be more nodes within the depth
+
+
+class Path(BaseModel):
+    nodes: list[Node]  # from the first node to the last
+    connections: list[Connection]  # connections[i] joins nodes[i] and nodes[i + 1]
+
+
+class ShortestPaths(BaseModel):
+    paths: list[Path]
+    exhausted: bool  # the search ran out of its node or time budget before finding a path
+
+
+class AdjacencyStats(BaseModel):
+    edge_count: int
+    csr_edge_count: int  # edges in the CSR arrays, including dead ones
+    recent_edge_count: int  # edges written since the CSR arrays were built
+    dead_edge_count: int  # deleted or replaced edges not yet compacted away
+    name_count: int
+    memory_bytes: int
+
+
+class NodeImpact(BaseModel):
+    node_id: int
+    connection_count: int  # how many connections deleting the node would delete with it
+
+
+class DeletedNodes(BaseModel):
+    deleted_ids: list[int]
+    missing_ids: list[int]  # asked for but not found
+    connection_count: int  # connections deleted with the nodes
+
+
+class DeletedConnections(BaseModel):
+    deleted_ids: list[int]
+    missing_ids: list[int]  # asked for but not found
+
+
+class IdentityCacheStats(BaseModel):
+    node_count: int
+    connection_count: int
+    max_size: int  # of each
+    hits: int
+    misses: int
+
+
+class WriteQueueStats(BaseModel):
+    queue_depth: int  # writes waiting for the writer
+    max_queue_depth: int
+    batch_count: int  # transactions committed
+    write_count: int  # writes in them, including those that failed and were rolled back
+    largest_batch: int
+    max_batch_size: int
+    max_latency_ms: float
+
+
+class DatabaseStats(BaseModel):
+    node_count: int
+    connection_count: int
+    max_degree: int  # the most connections any node is in
+    orphan_node_count: int  # nodes in no connections
+    connection_name_counts: dict[str, int] | None = None  # the number of connections with each name, in detail
+
+
+class Metric(str, Enum):
+    degree = "degree"
+    in_degree = "in_degree"  # connections with the node as their target
+    out_degree = "out_degree"  # connections with the node as their subject
+    pagerank = "pagerank"
+
+
+class NodeScore(Node):
+    score: float
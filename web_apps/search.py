@@ -0,0 +1,58 @@
+"""
+Name search through the SQLite FTS5 tables nodes_fts and connections_fts (see migrations.add_name_search_tables).
+
+The tables use the trigram tokenizer, so a quoted term matches anywhere inside a name, ignoring case, and is answered
+from the index. Terms shorter than a trigram can't use the index, so they fall back to LIKE over the FTS table.
+"""
+import re
+
+from sqlalchemy import ColumnElement, TableClause, and_, column, literal_column, table, true
+
+nodes_fts = table("nodes_fts", column("rowid"), column("name"), column("rank"))
+connections_fts = table("connections_fts", column("rowid"), column("name"), column("rank"))
+
+TRIGRAM_LENGTH = 3
+
+# a "quoted phrase" or a single word
+SEARCH_TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def quote(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+def matches(fts_table: TableClause, match_expression: str) -> ColumnElement[bool]:
+    return literal_column(fts_table.name).op("MATCH")(match_expression)
+
+
+def name_contains(fts_table: TableClause, like: str) -> ColumnElement[bool]:
+    """
+    Rows whose name contains the whole of like, the same as name.ilike(f"%{like}%") but using the index
+    """
+    if len(like) >= TRIGRAM_LENGTH:
+        return matches(fts_table, quote(like))
+    return fts_table.c.name.like(f"%{like}%")
+
+
+def search_condition(fts_table: TableClause, query: str) -> tuple[ColumnElement[bool], bool]:
+    """
+    Rows whose name contains every term of the query. A term is a word or a "quoted phrase", and a word ending
+    in * only matches at the start of the name, e.g. 'engineer "senior eng"' or 'chief*'.
+    :return: the condition, and whether it ranks the rows (i.e. the FTS table's rank column can be ordered by)
+    """
+    match_terms = []
+    like_conditions = []
+    for phrase, word in SEARCH_TERM.findall(query):
+        starts_with = word.endswith("*")
+        term = word[:-1] if starts_with else phrase or word
+        if not term:
+            continue
+        if len(term) >= TRIGRAM_LENGTH:
+            match_terms.append(("^" if starts_with else "") + quote(term))
+        else:
+            like_conditions.append(fts_table.c.name.like(f"{term}%" if starts_with else f"%{term}%"))
+
+    conditions = like_conditions
+    if match_terms:
+        conditions = [matches(fts_table, " AND ".join(match_terms))] + like_conditions
+    return and_(true(), *conditions), bool(match_terms)
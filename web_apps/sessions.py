@@ -0,0 +1,91 @@
+"""
+The database sessions the apps' endpoints are given, so one set of endpoints serves both the sync engines in
+database.py and (with KNOWLEDGE_ASYNC_DB set) the async ones in async_database.py.
+
+An endpoint calls crud (or any function taking a Session first) through its DatabaseSession: run for reads, and
+write for writes, which go through the write queue when there is one (see write_queue.py). On a sync session the call
+runs on a threadpool thread, as a sync endpoint would have. On an async session it runs on the AsyncSession's own
+Session with run_sync, so waiting on SQLite awaits rather than holding a thread. Either way the SQL, the changes
+recorded for the in-memory indexes and the errors raised are crud's own.
+"""
+import asyncio
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Callable, Concatenate, ParamSpec, TypeVar
+
+from sqlalchemy import Engine
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import changes, write_queue
+from .async_database import AsyncLocalSession, AsyncReadLocalSession, async_database_enabled, async_engine, \
+    async_read_engine
+from .database import LocalSession, ReadLocalSession, engine, open_session_slot, read_engine
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+class DatabaseSession(ABC):
+    def __init__(self, sync_session: Session):
+        # the Session crud is given, for looking up the in-memory indexes and caches
+        self.sync_session = sync_session
+
+    @property
+    def engine(self) -> Engine:
+        """
+        The engine the session's indexes and caches are kept for (see changes.engine_of)
+        """
+        return changes.engine_of(self.sync_session)
+
+    @abstractmethod
+    async def run(self, function: Callable[Concatenate[Session, P], R], *args: P.args, **kwargs: P.kwargs) -> R:
+        """
+        function(session, *args, **kwargs)
+        """
+
+    async def write(self, function: Callable[Concatenate[Session, P], R], *args: P.args, **kwargs: P.kwargs) -> R:
+        """
+        function(session, *args, **kwargs), a crud write, run through the engine's write queue if it has one
+        (awaiting its batch's commit) or on the session itself if not
+        """
+        db_write_queue = write_queue.get_write_queue(self.sync_session)
+        if db_write_queue is None:
+            return await self.run(function, *args, **kwargs)
+        return await asyncio.wrap_future(db_write_queue.submit(function, *args, **kwargs))
+
+
+class SyncDatabaseSession(DatabaseSession):
+    async def run(self, function: Callable[Concatenate[Session, P], R], *args: P.args, **kwargs: P.kwargs) -> R:
+        return await run_in_threadpool(function, self.sync_session, *args, **kwargs)
+
+
+class AsyncDatabaseSession(DatabaseSession):
+    def __init__(self, async_session: AsyncSession):
+        super().__init__(async_session.sync_session)
+        self.async_session = async_session
+
+    async def run(self, function: Callable[Concatenate[Session, P], R], *args: P.args, **kwargs: P.kwargs) -> R:
+        return await self.async_session.run_sync(function, *args, **kwargs)
+
+
+# Dependency
+async def get_db_session() -> AsyncIterator[DatabaseSession]:
+    if async_database_enabled():
+        async with open_session_slot(async_engine.sync_engine), AsyncLocalSession() as db_session:
+            yield AsyncDatabaseSession(db_session)
+    else:
+        async with open_session_slot(engine):
+            with LocalSession() as db_session:
+                yield SyncDatabaseSession(db_session)
+
+
+# Dependency for routes that only read
+async def get_read_db_session() -> AsyncIterator[DatabaseSession]:
+    if async_database_enabled():
+        async with open_session_slot(async_read_engine.sync_engine), AsyncReadLocalSession() as db_session:
+            yield AsyncDatabaseSession(db_session)
+    else:
+        async with open_session_slot(read_engine):
+            with ReadLocalSession() as db_session:
+                yield SyncDatabaseSession(db_session)
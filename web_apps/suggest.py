@@ -0,0 +1,320 @@
+"""
+Optional in-process typeahead over node and connection names.
+
+A PrefixIndex keeps its items' casefolded names in a sorted list, so the items starting with a prefix are one
+contiguous slice found by bisection. The best matches for each prefix asked for are cached (the one and two letter
+prefixes when the index is loaded, others on first use), and writes keep the cached lists in order rather than
+throwing them away, so a suggestion is normally just a dictionary lookup. A write that pushes an item down out of a
+full list leaves the list short, as whatever now belongs at its end is unknown; it is still right as far as it goes,
+and is only ranked again (outside the indexes' lock) when a suggestion asks for more than it holds.
+
+Nodes are ranked by degree (how many connections they are in) and connection names by how many connections use
+them. The indexes are built per engine with build_suggest_indexes() (the apps do this at startup when
+KNOWLEDGE_SUGGEST_INDEX is set) and then kept up to date from the changes crud publishes. They never hear of commits
+made by other processes, so they're only for a database the one process writes to; without them crud asks SQLite
+(see crud.suggest_nodes).
+"""
+import os
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from collections.abc import Hashable, Iterable
+from heapq import nsmallest
+from itertools import groupby
+from threading import RLock
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import Engine, select
+from sqlalchemy.orm import Session
+
+from . import changes, models, schemas
+
+MAX_SUGGESTIONS = 50
+PRELOADED_PREFIX_LENGTH = 2
+MAX_CACHED_PREFIXES = 100_000
+
+# sorts after any character that can follow a prefix
+LAST_CHARACTER = "\U0010ffff"
+
+
+def suggest_index_enabled() -> bool:
+    return os.environ.get("KNOWLEDGE_SUGGEST_INDEX", default="0").lower() in ("1", "true", "yes", "on")
+
+
+def normalize_prefix(prefix: str) -> str:
+    return prefix.lstrip().casefold()
+
+
+class PrefixIndex:
+    def __init__(self):
+        self.keys: list[tuple[str, Hashable]] = []  # (casefolded name, item), sorted
+        self.names: dict[Hashable, str] = {}
+        self.scores: dict[Hashable, int] = {}
+        # prefix -> the best MAX_SUGGESTIONS ranks starting with it, best first
+        self.top_by_prefix: OrderedDict[str, list[tuple]] = OrderedDict()
+        # the cached prefixes whose lists have lost items from their end, and hold just the best few
+        self.short_prefixes: set[str] = set()
+        # counts the writes, so a ranking worked out outside the lock can tell if it's stale
+        self.version = 0
+
+    def rank(self, item: Hashable) -> tuple:
+        return -self.scores[item], self.names[item].casefold(), item
+
+    def load(self, names: dict[Hashable, str], scores: dict[Hashable, int]) -> None:
+        self.names = dict(names)
+        self.scores = {item: scores.get(item, 0) for item in self.names}
+        self.keys = sorted((name.casefold(), item) for item, name in self.names.items())
+        self.top_by_prefix.clear()
+        self.short_prefixes.clear()
+        self.version += 1
+
+        for length in range(PRELOADED_PREFIX_LENGTH + 1):
+            for prefix, keys in groupby(self.keys, key=lambda key: key[0][:length]):
+                self.top_by_prefix[prefix] = nsmallest(MAX_SUGGESTIONS, (self.rank(item) for _, item in keys))
+
+    def clear(self) -> None:
+        self.load({}, {})
+
+    def top(self, prefix: str, limit: int) -> list[Hashable]:
+        """
+        The best items (highest score first) whose name starts with the prefix, ignoring case
+        """
+        top = self.cached_top(prefix, limit)
+        if top is None:
+            ranks = self.rank_keys(self.keys_starting_with(prefix))
+            self.cache_top(prefix, ranks)
+            top = [rank[-1] for rank in ranks[:limit]]
+        return top
+
+    def cached_top(self, prefix: str, limit: int) -> list[Hashable] | None:
+        """
+        The best items for the prefix from its cached list, or None if it has no list or too short a one
+        """
+        limit = min(limit, MAX_SUGGESTIONS)
+        ranks = self.top_by_prefix.get(prefix)
+        if ranks is None or (len(ranks) < limit and prefix in self.short_prefixes):
+            return None
+        self.top_by_prefix.move_to_end(prefix)
+        return [rank[-1] for rank in ranks[:limit]]
+
+    def keys_starting_with(self, prefix: str) -> list[tuple[str, Hashable]]:
+        start = bisect_left(self.keys, (prefix,))
+        end = bisect_left(self.keys, (prefix + LAST_CHARACTER,), lo=start)
+        return self.keys[start:end]
+
+    def rank_keys(self, keys: list[tuple[str, Hashable]]) -> list[tuple]:
+        """
+        The best MAX_SUGGESTIONS ranks of the keys' items, skipping any removed since the keys were taken
+        (so it can be run without the lock, on a copy of the keys)
+        """
+        scores = self.scores
+        return nsmallest(MAX_SUGGESTIONS, ((-score, name, item) for name, item in keys
+                                           if (score := scores.get(item)) is not None))
+
+    def cache_top(self, prefix: str, ranks: list[tuple]) -> None:
+        self.top_by_prefix[prefix] = ranks
+        self.top_by_prefix.move_to_end(prefix)
+        self.short_prefixes.discard(prefix)
+        if len(self.top_by_prefix) > MAX_CACHED_PREFIXES:
+            evicted_prefix, _ = self.top_by_prefix.popitem(last=False)
+            self.short_prefixes.discard(evicted_prefix)
+
+    def cached_prefixes(self, key: str) -> Iterable[tuple[str, list[tuple]]]:
+        for length in range(len(key) + 1):
+            ranks = self.top_by_prefix.get(key[:length])
+            if ranks is not None:
+                yield key[:length], ranks
+
+    def _unlist(self, item: Hashable, improving: bool) -> None:
+        old_rank = self.rank(item)
+        for prefix, ranks in self.cached_prefixes(old_rank[1]):
+            position = bisect_left(ranks, old_rank)
+            if position < len(ranks) and ranks[position] == old_rank:
+                if len(ranks) == MAX_SUGGESTIONS and not improving:
+                    # something outside the list might belong in its last place now, so it stays one short
+                    self.short_prefixes.add(prefix)
+                del ranks[position]
+
+    def _list(self, item: Hashable) -> None:
+        new_rank = self.rank(item)
+        for prefix, ranks in self.cached_prefixes(new_rank[1]):
+            if prefix in self.short_prefixes:
+                # only an item ranked above the end of the list is known to belong in it
+                if ranks and new_rank < ranks[-1]:
+                    insort(ranks, new_rank)
+                    if len(ranks) == MAX_SUGGESTIONS:
+                        self.short_prefixes.discard(prefix)
+            elif len(ranks) < MAX_SUGGESTIONS:
+                insort(ranks, new_rank)
+            elif new_rank < ranks[-1]:
+                insort(ranks, new_rank)
+                ranks.pop()
+
+    def set(self, item: Hashable, name: str, score: int | None = None) -> None:
+        old_name = self.names.get(item)
+        if score is None:
+            score = self.scores.get(item, 0)
+        if old_name == name and self.scores[item] == score:
+            return
+
+        self.version += 1
+        if old_name is not None and old_name == name:
+            self._unlist(item, improving=score > self.scores[item])
+        else:
+            self.remove(item)
+            insort(self.keys, (name.casefold(), item))
+            self.names[item] = name
+        self.scores[item] = score
+        self._list(item)
+
+    def remove(self, item: Hashable) -> None:
+        if item not in self.names:
+            return
+        self.version += 1
+        self._unlist(item, improving=False)
+        del self.keys[bisect_left(self.keys, (self.names[item].casefold(), item))]
+        del self.names[item]
+        del self.scores[item]
+
+    def add_to_score(self, item: Hashable, amount: int) -> None:
+        if item in self.names:
+            self.set(item, self.names[item], self.scores[item] + amount)
+
+
+class SuggestIndexes:
+    def __init__(self):
+        self.lock = RLock()
+        self.nodes = PrefixIndex()  # node id -> node name, scored by degree
+        self.connection_names = PrefixIndex()  # connection name -> itself, scored by number of connections
+        self.connections: dict[int, tuple[str, int, int]] = {}  # connection id -> (name, subject id, target id)
+
+    def load(self, engine: Engine) -> None:
+        with self.lock, Session(engine) as db_session:
+            self.connections = {connection_id: (name, subject_id, target_id)
+                                for connection_id, name, subject_id, target_id in db_session.execute(
+                    select(models.Connection.id, models.Connection.name, models.Connection.subject_id,
+                           models.Connection.target_id)).yield_per(10_000)}
+
+            node_names = dict(db_session.execute(select(models.Node.id, models.Node.name)).yield_per(10_000).all())
+            degrees: dict[int, int] = {}
+            name_counts: dict[str, int] = {}
+            for name, subject_id, target_id in self.connections.values():
+                degrees[subject_id] = degrees.get(subject_id, 0) + 1
+                degrees[target_id] = degrees.get(target_id, 0) + 1
+                name_counts[name] = name_counts.get(name, 0) + 1
+
+            self.nodes.load(node_names, degrees)
+            self.connection_names.load({name: name for name in name_counts}, name_counts)
+
+    def _add_connection(self, connection_id: int, connection: tuple[str, int, int]) -> None:
+        name, subject_id, target_id = connection
+        self.connections[connection_id] = connection
+        self.connection_names.set(name, name, self.connection_names.scores.get(name, 0) + 1)
+        self.nodes.add_to_score(subject_id, 1)
+        self.nodes.add_to_score(target_id, 1)
+
+    def _remove_connection(self, connection_id: int) -> None:
+        connection = self.connections.pop(connection_id, None)
+        if connection is None:
+            return
+        name, subject_id, target_id = connection
+        if self.connection_names.scores.get(name, 0) > 1:
+            self.connection_names.add_to_score(name, -1)
+        else:
+            self.connection_names.remove(name)
+        self.nodes.add_to_score(subject_id, -1)
+        self.nodes.add_to_score(target_id, -1)
+
+    def apply(self, engine: Engine, database_changes: list[changes.Change]) -> None:
+        with self.lock:
+            for change in database_changes:
+                match change:
+                    case changes.NodeWritten(node_id, name):
+                        self.nodes.set(node_id, name)
+                    case changes.NodesDeleted(node_ids):
+                        for node_id in node_ids:
+                            self.nodes.remove(node_id)
+                    case changes.ConnectionWritten(connection_id, name, subject_id, target_id):
+                        connection = (name, subject_id, target_id)
+                        if self.connections.get(connection_id) != connection:
+                            self._remove_connection(connection_id)
+                            self._add_connection(connection_id, connection)
+                    case changes.ConnectionsDeleted(connection_ids):
+                        for connection_id in connection_ids:
+                            self._remove_connection(connection_id)
+                    case changes.TableCleared("nodes"):
+                        self.nodes.clear()
+                    case changes.TableCleared("connections"):
+                        self.connections.clear()
+                        self.connection_names.clear()
+                        self.nodes.load(self.nodes.names, {})
+                    case changes.DatabaseReloaded():
+                        self.load(engine)
+
+    def _top(self, index: PrefixIndex, prefix: str, limit: int) -> list[Hashable]:
+        """
+        index.top, ranking the prefix's items (when its list is missing or short) without holding the lock,
+        so a long prefix doesn't hold up other suggestions and writes
+        """
+        prefix = normalize_prefix(prefix)
+        with self.lock:
+            top = index.cached_top(prefix, limit)
+            if top is not None:
+                return top
+            keys, version = index.keys_starting_with(prefix), index.version
+
+        ranks = index.rank_keys(keys)
+        with self.lock:
+            # a write meanwhile may have changed the ranking, so it's used this once but not kept
+            if index.version == version:
+                index.cache_top(prefix, ranks)
+            return [rank[-1] for rank in ranks[:limit] if rank[-1] in index.names]
+
+    def suggest_nodes(self, prefix: str, limit: int) -> list[schemas.NodeSuggestion]:
+        node_ids = self._top(self.nodes, prefix, limit)
+        with self.lock:
+            return [schemas.NodeSuggestion(id=node_id, name=self.nodes.names[node_id],
+                                           degree=self.nodes.scores[node_id])
+                    for node_id in node_ids if node_id in self.nodes.names]
+
+    def suggest_connection_names(self, prefix: str, limit: int) -> list[schemas.ConnectionNameSuggestion]:
+        names = self._top(self.connection_names, prefix, limit)
+        with self.lock:
+            return [schemas.ConnectionNameSuggestion(name=name, count=self.connection_names.scores[name])
+                    for name in names if name in self.connection_names.names]
+
+
+_suggest_indexes: WeakKeyDictionary[Engine, SuggestIndexes] = WeakKeyDictionary()
+
+
+def build_suggest_indexes(engine: Engine) -> SuggestIndexes:
+    """
+    Load the indexes for this engine's database and keep them up to date from then on
+    """
+    suggest_indexes = SuggestIndexes()
+    with suggest_indexes.lock:
+        # registered before loading so no write committed meanwhile is missed (applying it again is harmless)
+        _suggest_indexes[engine] = suggest_indexes
+        suggest_indexes.load(engine)
+    return suggest_indexes
+
+
+def build_suggest_indexes_if_enabled(engine: Engine) -> None:
+    if suggest_index_enabled() and engine not in _suggest_indexes:
+        build_suggest_indexes(engine)
+
+
+def drop_suggest_indexes(engine: Engine) -> None:
+    _suggest_indexes.pop(engine, None)
+
+
+def get_suggest_indexes(db_session: Session) -> SuggestIndexes | None:
+    return _suggest_indexes.get(changes.engine_of(db_session))
+
+
+def _apply_changes(engine: Engine, database_changes: list[changes.Change]) -> None:
+    suggest_indexes = _suggest_indexes.get(engine)
+    if suggest_indexes is not None:
+        suggest_indexes.apply(engine, database_changes)
+
+
+changes.add_listener(_apply_changes)
@@ -0,0 +1,179 @@
+"""
+Optional single-writer queue that group-commits the apps' writes.
+
+With KNOWLEDGE_WRITE_QUEUE set, the apps' write endpoints hand their crud call to a queue (see
+sessions.DatabaseSession.write) instead of running it on their own session, whether that's on a sync or async engine.
+One writer thread takes the calls off the queue in batches: as many as are waiting, up to
+KNOWLEDGE_WRITE_QUEUE_MAX_BATCH, having waited up to KNOWLEDGE_WRITE_QUEUE_MAX_LATENCY_MS for more to arrive. It runs
+the whole batch in one SQLite transaction and commits it once, so concurrent writes no longer compete for the database
+lock or pay a commit each.
+
+Each call gets a session of its own in which its commits only release a savepoint, so a call that fails (or rolls
+back) undoes just its own work. Its result, or its exception, reaches the caller through a Future once the batch has
+committed, and the changes it recorded are published then too. The queue holds at most KNOWLEDGE_WRITE_QUEUE_SIZE
+calls; beyond that submit raises WriteQueueFullError rather than waiting.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import Engine
+from sqlalchemy.orm import Session
+
+from . import changes, schemas
+
+DEFAULT_MAX_BATCH_SIZE = 100
+DEFAULT_MAX_LATENCY_MS = 2
+DEFAULT_MAX_QUEUE_SIZE = 1000
+
+
+class WriteQueueFullError(Exception):
+    pass
+
+
+def write_queue_enabled() -> bool:
+    return os.environ.get("KNOWLEDGE_WRITE_QUEUE", default="0").lower() in ("1", "true", "yes", "on")
+
+
+class WriteQueue:
+    def __init__(self, engine: Engine, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_latency: float = DEFAULT_MAX_LATENCY_MS / 1000, max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue: queue.Queue[tuple[Future, Callable, tuple, dict] | None] = queue.Queue(maxsize=max_queue_size)
+
+        self.lock = threading.Lock()
+        self.max_queue_depth = 0
+        self.batch_count = 0
+        self.write_count = 0
+        self.largest_batch = 0
+
+        self.writer = threading.Thread(target=self._write_batches, name="write-queue", daemon=True)
+        self.writer.start()
+
+    def submit(self, function: Callable[..., Any], *args, **kwargs) -> Future:
+        """
+        Queue function(db_session, *args, **kwargs) to be run and committed by the writer
+        """
+        future = Future()
+        try:
+            self.queue.put_nowait((future, function, args, kwargs))
+        except queue.Full:
+            raise WriteQueueFullError(f"{self.queue.maxsize} writes already queued")
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return future
+
+    def stop(self) -> None:
+        """
+        Finish the writes already queued, then stop the writer
+        """
+        self.queue.put(None)
+        self.writer.join()
+
+    def _next_batch(self) -> tuple[list[tuple[Future, Callable, tuple, dict]], bool]:
+        """
+        The next batch of writes (waiting for the first as long as it takes), and whether to stop after it
+        """
+        item = self.queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            try:
+                item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _write_batches(self) -> None:
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch: list[tuple[Future, Callable, tuple, dict]]) -> None:
+        results = []
+        batch_changes: list[changes.Change] = []
+        try:
+            with self.engine.connect() as db_connection:
+                # the driver only begins a transaction before DML, and releasing a savepoint that began one commits
+                # it, so begin the batch's transaction explicitly (IMMEDIATE takes the write lock up front)
+                db_connection.exec_driver_sql("BEGIN IMMEDIATE")
+                for future, function, args, kwargs in batch:
+                    with Session(bind=db_connection, join_transaction_mode="create_savepoint", autoflush=False,
+                                 expire_on_commit=False) as db_session:
+                        changes.defer_publishing(db_session, batch_changes)
+                        try:
+                            results.append((future, function(db_session, *args, **kwargs), None))
+                        except Exception as error:
+                            db_session.rollback()
+                            results.append((future, None, error))
+                db_connection.commit()
+        except Exception as error:
+            for future, _, _, _ in batch:
+                future.set_exception(error)
+            return
+
+        with self.lock:
+            self.batch_count += 1
+            self.write_count += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+        if batch_changes:
+            changes.publish(self.engine, batch_changes)
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stats(self) -> schemas.WriteQueueStats:
+        with self.lock:
+            return schemas.WriteQueueStats(queue_depth=self.queue.qsize(), max_queue_depth=self.max_queue_depth,
+                                           batch_count=self.batch_count, write_count=self.write_count,
+                                           largest_batch=self.largest_batch, max_batch_size=self.max_batch_size,
+                                           max_latency_ms=self.max_latency * 1000)
+
+
+_write_queues: WeakKeyDictionary[Engine, WriteQueue] = WeakKeyDictionary()
+
+
+def start_write_queue(engine: Engine, **options) -> WriteQueue:
+    """
+    Start a write queue for the engine, stopping any it already had
+    """
+    stop_write_queue(engine)
+    write_queue = _write_queues[engine] = WriteQueue(engine, **options)
+    return write_queue
+
+
+def start_write_queue_if_enabled(engine: Engine) -> None:
+    if write_queue_enabled() and engine not in _write_queues:
+        start_write_queue(engine,
+                          max_batch_size=int(os.environ.get("KNOWLEDGE_WRITE_QUEUE_MAX_BATCH",
+                                                            default=DEFAULT_MAX_BATCH_SIZE)),
+                          max_latency=float(os.environ.get("KNOWLEDGE_WRITE_QUEUE_MAX_LATENCY_MS",
+                                                           default=DEFAULT_MAX_LATENCY_MS)) / 1000,
+                          max_queue_size=int(os.environ.get("KNOWLEDGE_WRITE_QUEUE_SIZE",
+                                                            default=DEFAULT_MAX_QUEUE_SIZE)))
+
+
+def stop_write_queue(engine: Engine) -> None:
+    write_queue = _write_queues.pop(engine, None)
+    if write_queue is not None:
+        write_queue.stop()
+
+
+def get_write_queue(db_session: Session) -> WriteQueue | None:
+    return _write_queues.get(changes.engine_of(db_session))
+